@@ -2,10 +2,13 @@ import logging
 import time
 
 import typer
+from clock import ManualClock, MonotonicClock
 from context import Context
 from rate_limiter import RateLimiter
-from sliding_window_logs_rate_limiter import SlidingWindowLogsRateLimiter
+from rate_limiter_algorithms import RATE_LIMITER_ALGORITHMS, get_rate_limiter_class
 from typing_extensions import Annotated
+from user_loader import load_users
+from user_registry import ShardedUserRegistry
 
 logging.basicConfig(level=logging.DEBUG)
 app = typer.Typer()
@@ -14,29 +17,59 @@ app = typer.Typer()
 @app.command()
 def rate_limiter_app(
     rate_limiter_algorithm: Annotated[
-        str, typer.Option(help="Rate Limiter algorithm Options 0: Sliding Window Log")
-    ] = None,
+        str,
+        typer.Option(
+            help="Rate Limiter algorithm Options "
+            + ", ".join(
+                "%d: %s" % option for option in enumerate(RATE_LIMITER_ALGORITHMS)
+            )
+        ),
+    ] = "0",
+    num_shards: Annotated[
+        int, typer.Option(help="Number of shards of the in-memory user registry")
+    ] = ShardedUserRegistry.DEFAULT_NUM_SHARDS,
+    simulated_time: Annotated[
+        bool, typer.Option(help="Advance a manual clock instead of sleeping")
+    ] = False,
+    users_file: Annotated[
+        str,
+        typer.Option(
+            help="CSV or JSONL file of users "
+            "(user_id, num_requests, window_time_in_sec) to add instead of demo ones"
+        ),
+    ] = "",
 ):
     # Init Rate Limiter Implementation
-    rate_limiter = SlidingWindowLogsRateLimiter()
+    try:
+        rate_limiter_class = get_rate_limiter_class(rate_limiter_algorithm)
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
+    clock = ManualClock(time.monotonic()) if simulated_time else MonotonicClock()
+    sleep = clock.advance if simulated_time else time.sleep
+    rate_limiter = rate_limiter_class(num_shards, clock)
     # Init context
     context = Context(rate_limiter)
 
     # Add users
-    users = [
-        {"user_id": "user1", "num_requests": 2, "window_time_in_sec": 30},
-        {"user_id": "user2", "num_requests": 3, "window_time_in_sec": 30},
-    ]
-    context.add_users(users)
+    if users_file:
+        start = time.perf_counter()
+        num_users = load_users(rate_limiter, users_file)
+        logging.info("Added %d users in %.2fs", num_users, time.perf_counter() - start)
+    else:
+        users = [
+            {"user_id": "user1", "num_requests": 2, "window_time_in_sec": 30},
+            {"user_id": "user2", "num_requests": 3, "window_time_in_sec": 30},
+        ]
+        context.add_users(users)
 
     # Send requests and see if they are throttled beyond limit
-    logging.info(context.send_request(user_id="user1"))
-    time.sleep(5)
-    logging.info(context.send_request(user_id="user1"))
-    time.sleep(5)
-    logging.info(context.send_request(user_id="user1"))
-    time.sleep(30)
-    logging.info(context.send_request(user_id="user1"))
+    logging.info("%s %s", *context.send_request_with_headers(user_id="user1"))
+    sleep(5)
+    logging.info("%s %s", *context.send_request_with_headers(user_id="user1"))
+    sleep(5)
+    logging.info("%s %s", *context.send_request_with_headers(user_id="user1"))
+    sleep(30)
+    logging.info("%s %s", *context.send_request_with_headers(user_id="user1"))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+from clock import MonotonicClock
+from in_memory_rate_limiter import check_user_state, try_acquire_tiered
+from rate_limiter import AsyncRateLimiter
+from sliding_window_logs_rate_limiter import SlidingWindowLogsRateLimiter
+
+
+class AsyncInMemoryRateLimiter(AsyncRateLimiter):
+    """
+    asyncio rate limiter keeping each user's state in process memory
+    Algorithm is picked by passing one of the InMemoryRateLimiter implementations,
+    whose user state is reused. Deciding a request never awaits, so requests
+    on an event loop can't interleave and user state is accessed without locks.
+    Instance must only be used from the thread running its event loop.
+    """
+
+    def __init__(self, rate_limiter_class=SlidingWindowLogsRateLimiter, clock=None):
+        """
+        clock: source of timestamps (Clock), defaults to MonotonicClock
+        """
+        self.rate_limiter_class = rate_limiter_class
+        self.clock = MonotonicClock() if clock is None else clock
+        self.user_map = {}
+
+    async def add_user(self, user_id, num_requests, window_time_in_sec, **options):
+        if user_id in self.user_map:
+            raise Exception("User already present")
+        self.user_map[user_id] = self.rate_limiter_class.create_user_state(
+            num_requests, window_time_in_sec, self.clock.now(), **options
+        )
+
+    async def add_users_bulk(self, users, **options):
+        """
+        None of the users is added if any is already present
+        """
+        current_timestamp = self.clock.now()
+        user_states = {}
+        for user_id, num_requests, window_time_in_sec in users:
+            if user_id in self.user_map or user_id in user_states:
+                raise Exception("User already present")
+            user_states[user_id] = self.rate_limiter_class.create_user_state(
+                num_requests, window_time_in_sec, current_timestamp, **options
+            )
+        self.user_map.update(user_states)
+
+    async def add_user_limits(self, user_id, limits, **options):
+        if user_id in self.user_map:
+            raise Exception("User already present")
+        self.user_map[user_id] = self.rate_limiter_class.create_user_limit_tiers(
+            limits, self.clock.now(), **options
+        )
+
+    async def remove_user(self, user_id):
+        self.user_map.pop(user_id, None)
+
+    def get_user_state(self, user_id):
+        user_state = self.user_map.get(user_id)
+        if user_state is None:
+            raise Exception("User not present")
+        return user_state
+
+    async def is_allowed(self, user_id):
+        allowed = self.get_user_state(user_id).try_acquire(self.clock.now())
+        if self.metrics is not None:
+            self.metrics.record_decision(allowed)
+        return allowed
+
+    async def is_allowed_tiered(self, user_id):
+        allowed, tripped_tier = try_acquire_tiered(
+            self.get_user_state(user_id), self.clock.now()
+        )
+        if self.metrics is not None:
+            self.metrics.record_decision(allowed)
+        return allowed, tripped_tier
+
+    async def check(self, user_id):
+        decision = check_user_state(self.get_user_state(user_id), self.clock.now())
+        if self.metrics is not None:
+            self.metrics.record_decision(decision.allowed)
+        return decision
+
+    async def is_allowed_many(self, user_ids):
+        current_timestamp = self.clock.now()
+        decisions = [
+            self.get_user_state(user_id).try_acquire(current_timestamp)
+            for user_id in user_ids
+        ]
+        if self.metrics is not None:
+            self.metrics.record_decisions(decisions)
+        return decisions
@@ -0,0 +1,140 @@
+import asyncio
+
+import redis
+from rate_limiter import AsyncRateLimiter
+from redis_connection import get_async_connection
+from sliding_window_logs_redis_rate_limiter import SlidingWindowLogsRedisScript
+
+
+class AsyncSlidingWindowLogsRedisRateLimiter(
+    SlidingWindowLogsRedisScript, AsyncRateLimiter
+):
+    """
+    asyncio implementation of Sliding window Log rate limiter on redis.asyncio
+    Uses the same data layout as SlidingWindowLogsRedisRateLimiter.
+    Requests are always decided with the Lua script, so each is_allowed
+    (or is_allowed_many batch) is a single awaited round trip.
+    """
+
+    def __init__(self, conn=None, near_cache_size=0, near_cache_ttl_sec=1, clock=None):
+        """
+        conn: redis.asyncio client, defaults to one backed by the shared connection pool
+            of the event loop the rate limiter is used on
+        near_cache_size: max users remembered in the local near cache, 0 disables it
+        near_cache_ttl_sec: max time a near cache entry is trusted without asking redis
+        clock: source of timestamps (Clock), defaults to WallClock
+        """
+        super().__init__(near_cache_size, near_cache_ttl_sec, clock)
+        self._conn = conn
+        self._loop = None
+        self._loop_conn = None
+
+    @property
+    def conn(self):
+        """
+        Given client, or the one of the running event loop's shared connection pool
+        """
+        if self._conn is not None:
+            return self._conn
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop_conn = get_async_connection()
+            self._loop = loop
+        return self._loop_conn
+
+    async def add_user(self, user_id, num_requests, window_time_in_sec):
+        await self.conn.hset(
+            user_id + self.METADATA_SUFFIX,
+            mapping={"requests": num_requests, "window_time": window_time_in_sec},
+        )
+        self.invalidate_near_cache(user_id)
+
+    async def add_users_bulk(self, users):
+        pipe = self.conn.pipeline(transaction=False)
+        user_ids = []
+        for user_id, num_requests, window_time_in_sec in users:
+            pipe.hset(
+                user_id + self.METADATA_SUFFIX,
+                mapping={"requests": num_requests, "window_time": window_time_in_sec},
+            )
+            user_ids.append(user_id)
+        with self.time_round_trip():
+            await pipe.execute()
+        for user_id in user_ids:
+            self.invalidate_near_cache(user_id)
+
+    async def add_user_limits(self, user_id, limits):
+        await self.conn.hset(
+            user_id + self.METADATA_SUFFIX, mapping=self.get_limits_mapping(limits)
+        )
+        self.invalidate_near_cache(user_id)
+
+    async def remove_user(self, user_id):
+        await self.conn.delete(
+            user_id + self.METADATA_SUFFIX, user_id + self.TIMESTAMPS_SUFFIX
+        )
+        self.invalidate_near_cache(user_id)
+
+    async def get_user_rate(self, user_id):
+        with self.time_round_trip():
+            val = await self.conn.hmget(
+                user_id + self.METADATA_SUFFIX, "requests", "window_time"
+            )
+        return self._parse_user_rate(user_id, val)
+
+    async def is_allowed(self, user_id):
+        allowed, _ = await self.is_allowed_tiered(user_id)
+        return allowed
+
+    async def is_allowed_tiered(self, user_id):
+        current_timestamp = self.get_current_timestamp_sec()
+        tripped_tier, _ = self.get_locally_denied_decision(user_id, current_timestamp)
+        if tripped_tier is None:
+            decisions = await self._run_is_allowed_script([user_id], current_timestamp)
+            tripped_tier, _ = decisions[0]
+        if self.metrics is not None:
+            self.metrics.record_decision(tripped_tier is None)
+        return tripped_tier is None, tripped_tier
+
+    async def check(self, user_id):
+        current_timestamp = self.get_current_timestamp_sec()
+        _, decision = self.get_locally_denied_decision(user_id, current_timestamp)
+        if decision is None:
+            decisions = await self._run_is_allowed_script(
+                [user_id], current_timestamp, detailed=True
+            )
+            _, decision = decisions[0]
+        if self.metrics is not None:
+            self.metrics.record_decision(decision.allowed)
+        return decision
+
+    async def is_allowed_many(self, user_ids):
+        current_timestamp = self.get_current_timestamp_sec()
+        decisions, indices = self.reject_locally_denied(user_ids, current_timestamp)
+        if indices:
+            remote_decisions = await self._run_is_allowed_script(
+                [user_ids[index] for index in indices], current_timestamp
+            )
+            for index, (tripped_tier, _) in zip(indices, remote_decisions):
+                decisions[index] = tripped_tier is None
+        if self.metrics is not None:
+            self.metrics.record_decisions(decisions)
+        return decisions
+
+    async def _run_is_allowed_script(self, user_ids, current_timestamp, detailed=False):
+        keys, args, user_indices = self.get_script_keys_and_args(
+            user_ids, current_timestamp, detailed
+        )
+        try:
+            with self.time_round_trip():
+                result = await self.conn.evalsha(
+                    self.IS_ALLOWED_SCRIPT_SHA, len(keys), *keys, *args
+                )
+        except redis.exceptions.NoScriptError:
+            with self.time_round_trip():
+                result = await self.conn.eval(
+                    self.IS_ALLOWED_SCRIPT, len(keys), *keys, *args
+                )
+        return self.parse_script_result(
+            result, user_ids, user_indices, current_timestamp
+        )
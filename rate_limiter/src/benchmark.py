@@ -0,0 +1,242 @@
+import gc
+import importlib.util
+import logging
+import random
+import threading
+import time
+import tracemalloc
+from concurrent import futures
+from typing import List
+
+import typer
+from rate_limiter_algorithms import RATE_LIMITER_ALGORITHMS
+from typing_extensions import Annotated
+
+logging.basicConfig(level=logging.INFO)
+app = typer.Typer()
+
+
+def create_redis_rate_limiter(use_script):
+    """
+    Redis limiter on an in-process Redis stand-in (fakeredis)
+    Imported here, so in-memory limiters can be benchmarked without redis installed
+    """
+    import fakeredis
+    from sliding_window_logs_redis_rate_limiter import SlidingWindowLogsRedisRateLimiter
+
+    return SlidingWindowLogsRedisRateLimiter(
+        conn=fakeredis.FakeRedis(decode_responses=True), use_script=use_script
+    )
+
+
+def create_hybrid_redis_rate_limiter():
+    """
+    Hybrid limiter leasing quota from an in-process Redis stand-in (fakeredis)
+    """
+    import fakeredis
+    from hybrid_redis_rate_limiter import HybridRedisRateLimiter
+
+    return HybridRedisRateLimiter(conn=fakeredis.FakeRedis(decode_responses=True))
+
+
+REDIS_RATE_LIMITER_FACTORIES = {
+    "redis": lambda: create_redis_rate_limiter(use_script=False),
+    "redis_script": lambda: create_redis_rate_limiter(use_script=True),
+    "redis_hybrid": create_hybrid_redis_rate_limiter,
+}
+
+RATE_LIMITER_FACTORIES = {**RATE_LIMITER_ALGORITHMS, **REDIS_RATE_LIMITER_FACTORIES}
+
+
+def get_default_rate_limiter_algorithms():
+    """
+    Every rate limiter, leaving out Redis ones when fakeredis isn't installed
+    """
+    if importlib.util.find_spec("fakeredis") is None:
+        return list(RATE_LIMITER_ALGORITHMS)
+    return list(RATE_LIMITER_FACTORIES)
+
+
+def generate_requests(num_users, num_requests, skew, zipf_exponent, seed):
+    """
+    User ids and the sequence of users sending requests
+    skew: "uniform" or "zipfian", where user of rank k sends requests
+    in proportion to 1 / k ** zipf_exponent
+    """
+    user_ids = ["user" + str(i) for i in range(num_users)]
+    if skew == "uniform":
+        weights = None
+    elif skew == "zipfian":
+        weights = [1 / rank**zipf_exponent for rank in range(1, num_users + 1)]
+    else:
+        raise ValueError("skew must be uniform or zipfian")
+    return user_ids, random.Random(seed).choices(user_ids, weights, k=num_requests)
+
+
+def get_percentile(sorted_values, percentile):
+    index = min(len(sorted_values) - 1, int(percentile / 100 * len(sorted_values)))
+    return sorted_values[index]
+
+
+def add_users(rate_limiter, user_ids, limit, window_time_in_sec):
+    for user_id in user_ids:
+        rate_limiter.add_user(user_id, limit, window_time_in_sec)
+
+
+def send_requests(rate_limiter, requests, num_threads):
+    """
+    Send requests from num_threads threads,
+    returns elapsed time (sec), latencies (ns) and number of allowed requests
+    """
+    chunks = [requests[i::num_threads] for i in range(num_threads)]
+    barrier = threading.Barrier(num_threads + 1)
+
+    def _send_chunk(chunk):
+        is_allowed = rate_limiter.is_allowed
+        perf_counter_ns = time.perf_counter_ns
+        latencies = []
+        num_allowed = 0
+        barrier.wait()
+        for user_id in chunk:
+            start = perf_counter_ns()
+            allowed = is_allowed(user_id)
+            latencies.append(perf_counter_ns() - start)
+            num_allowed += allowed
+        return latencies, num_allowed
+
+    with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        results = [executor.submit(_send_chunk, chunk) for chunk in chunks]
+        barrier.wait()
+        start = time.perf_counter()
+        results = [result.result() for result in results]
+        elapsed = time.perf_counter() - start
+
+    latencies = [
+        latency for chunk_latencies, _ in results for latency in chunk_latencies
+    ]
+    return elapsed, latencies, sum(num_allowed for _, num_allowed in results)
+
+
+def measure_memory_per_user(factory, user_ids, requests, limit, window_time_in_sec):
+    """
+    Peak memory traced while adding users and sending all requests, per user
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        rate_limiter = factory()
+        add_users(rate_limiter, user_ids, limit, window_time_in_sec)
+        for user_id in requests:
+            rate_limiter.is_allowed(user_id)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / len(user_ids)
+
+
+def benchmark_rate_limiter(
+    factory,
+    user_ids,
+    requests,
+    num_threads,
+    limit,
+    window_time_in_sec,
+    measure_memory=True,
+):
+    rate_limiter = factory()
+    add_users(rate_limiter, user_ids, limit, window_time_in_sec)
+    elapsed, latencies, num_allowed = send_requests(rate_limiter, requests, num_threads)
+    latencies.sort()
+    result = {
+        "decisions_per_sec": len(requests) / elapsed,
+        "p50_us": get_percentile(latencies, 50) / 1000,
+        "p99_us": get_percentile(latencies, 99) / 1000,
+        "p999_us": get_percentile(latencies, 99.9) / 1000,
+        "allowed_ratio": num_allowed / len(requests),
+        "memory_per_user_bytes": None,
+    }
+    if measure_memory:
+        result["memory_per_user_bytes"] = measure_memory_per_user(
+            factory, user_ids, requests, limit, window_time_in_sec
+        )
+    return result
+
+
+@app.command()
+def benchmark(
+    rate_limiter_algorithms: Annotated[
+        List[str],
+        typer.Option(
+            "--rate-limiter-algorithm",
+            help="Rate limiter to benchmark, can be repeated. Options: "
+            + ", ".join(RATE_LIMITER_FACTORIES),
+        ),
+    ] = get_default_rate_limiter_algorithms(),
+    num_users: Annotated[int, typer.Option(help="Number of users")] = 1000,
+    num_requests: Annotated[int, typer.Option(help="Total requests sent")] = 100000,
+    num_threads: Annotated[int, typer.Option(help="Threads sending requests")] = 4,
+    skew: Annotated[
+        str, typer.Option(help="Distribution of requests over users: uniform, zipfian")
+    ] = "uniform",
+    zipf_exponent: Annotated[
+        float, typer.Option(help="Exponent of zipfian skew")
+    ] = 1.1,
+    limit: Annotated[int, typer.Option(help="Requests allowed per window")] = 100,
+    window_time_in_sec: Annotated[int, typer.Option(help="Window of the limit")] = 60,
+    measure_memory: Annotated[
+        bool, typer.Option(help="Measure peak memory per user (separate pass)")
+    ] = True,
+    seed: Annotated[int, typer.Option(help="Seed of the request generator")] = 0,
+):
+    user_ids, requests = generate_requests(
+        num_users, num_requests, skew, zipf_exponent, seed
+    )
+    logging.info(
+        "%d requests from %d users (%s), %d threads, limit %d per %d sec",
+        num_requests,
+        num_users,
+        skew,
+        num_threads,
+        limit,
+        window_time_in_sec,
+    )
+    logging.info(
+        "%-24s %14s %10s %10s %10s %8s %14s",
+        "algorithm",
+        "decisions/s",
+        "p50 us",
+        "p99 us",
+        "p999 us",
+        "allowed",
+        "bytes/user",
+    )
+    for rate_limiter_algorithm in rate_limiter_algorithms:
+        if rate_limiter_algorithm not in RATE_LIMITER_FACTORIES:
+            raise typer.BadParameter(
+                "Unknown rate limiter algorithm: " + rate_limiter_algorithm
+            )
+        result = benchmark_rate_limiter(
+            RATE_LIMITER_FACTORIES[rate_limiter_algorithm],
+            user_ids,
+            requests,
+            num_threads,
+            limit,
+            window_time_in_sec,
+            measure_memory,
+        )
+        logging.info(
+            "%-24s %14.0f %10.2f %10.2f %10.2f %7.1f%% %14s",
+            rate_limiter_algorithm,
+            result["decisions_per_sec"],
+            result["p50_us"],
+            result["p99_us"],
+            result["p999_us"],
+            100 * result["allowed_ratio"],
+            "-"
+            if result["memory_per_user_bytes"] is None
+            else "%.0f" % result["memory_per_user_bytes"],
+        )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,52 @@
+import time
+from abc import abstractmethod
+
+
+class Clock:
+    """
+    Interface for clocks used by rate limiters
+    Timestamps are in seconds, with sub-second precision
+    """
+
+    @abstractmethod
+    def now(self):
+        pass
+
+
+class MonotonicClock(Clock):
+    """
+    Nanosecond resolution clock which never goes backwards (CLOCK_MONOTONIC),
+    shared by processes on a host but not comparable across hosts
+    """
+
+    def now(self):
+        return time.monotonic_ns() / 1e9
+
+
+class WallClock(Clock):
+    """
+    Unix time with millisecond resolution,
+    comparable across processes and hosts (e.g. when state is shared in redis)
+    """
+
+    def now(self):
+        return time.time_ns() // 1_000_000 / 1000
+
+
+class ManualClock(Clock):
+    """
+    Clock which only moves when told to,
+    used to run simulated time scenarios without sleeping
+    """
+
+    def __init__(self, timestamp=0.0):
+        self.timestamp = timestamp
+
+    def now(self):
+        return self.timestamp
+
+    def advance(self, seconds):
+        self.timestamp += seconds
+
+    def set(self, timestamp):
+        self.timestamp = timestamp
@@ -1,4 +1,6 @@
-from rate_limiter import RateLimiter
+import math
+
+from rate_limiter import AsyncRateLimiter, RateLimiter
 
 
 class Context:
@@ -6,14 +8,72 @@ class Context:
         self.rate_limiter = rate_limiter
 
     def add_users(self, users):
-        for user in users:
-            self.rate_limiter.add_user(
-                user["user_id"], user["num_requests"], user["window_time_in_sec"]
-            )
+        self.rate_limiter.add_users_bulk(
+            [
+                (user["user_id"], user["num_requests"], user["window_time_in_sec"])
+                for user in users
+            ]
+        )
 
     def send_request(self, user_id):
-        return (
-            "HTTP 200"
-            if self.rate_limiter.is_allowed(user_id)
-            else "HTTP 429: Too Many Requests"
+        return self.get_response(self.rate_limiter.is_allowed(user_id))
+
+    def send_requests(self, user_ids):
+        return [
+            self.get_response(is_allowed)
+            for is_allowed in self.rate_limiter.is_allowed_many(user_ids)
+        ]
+
+    def send_request_with_headers(self, user_id):
+        """
+        Response along with headers telling the client its quota and when to retry
+        """
+        decision = self.rate_limiter.check(user_id)
+        return self.get_response(decision.allowed), self.get_headers(decision)
+
+    @classmethod
+    def get_response(cls, is_allowed):
+        return "HTTP 200" if is_allowed else "HTTP 429: Too Many Requests"
+
+    @classmethod
+    def get_headers(cls, decision):
+        """
+        X-RateLimit-* headers of a RateLimitDecision, and Retry-After for throttled requests
+        Durations are in whole seconds, rounded up so clients don't come back too early
+        """
+        headers = {
+            "X-RateLimit-Limit": str(decision.limit),
+            "X-RateLimit-Remaining": str(decision.remaining),
+            "X-RateLimit-Reset": str(
+                math.ceil(max(0, decision.reset_at - decision.timestamp))
+            ),
+        }
+        if not decision.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(decision.retry_after)))
+        return headers
+
+
+class AsyncContext:
+    def __init__(self, rate_limiter: AsyncRateLimiter):
+        self.rate_limiter = rate_limiter
+
+    async def add_users(self, users):
+        await self.rate_limiter.add_users_bulk(
+            [
+                (user["user_id"], user["num_requests"], user["window_time_in_sec"])
+                for user in users
+            ]
         )
+
+    async def send_request(self, user_id):
+        return Context.get_response(await self.rate_limiter.is_allowed(user_id))
+
+    async def send_request_with_headers(self, user_id):
+        decision = await self.rate_limiter.check(user_id)
+        return Context.get_response(decision.allowed), Context.get_headers(decision)
+
+    async def send_requests(self, user_ids):
+        return [
+            Context.get_response(is_allowed)
+            for is_allowed in await self.rate_limiter.is_allowed_many(user_ids)
+        ]
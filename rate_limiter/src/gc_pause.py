@@ -0,0 +1,17 @@
+import contextlib
+import gc
+
+
+@contextlib.contextmanager
+def paused_gc():
+    """
+    Pause cyclic garbage collection while millions of long lived objects are
+    created, each of which would otherwise be scanned by repeated collections
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
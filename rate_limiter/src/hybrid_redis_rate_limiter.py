@@ -0,0 +1,278 @@
+import hashlib
+import threading
+
+import redis
+from clock import WallClock
+from metrics import NOT_TIMED
+from rate_limiter import RateLimitDecision, RateLimiter
+from redis_connection import get_connection
+
+
+class UserLease:
+    """
+    Tokens of a user leased from redis by this process, spent without round trips
+    """
+
+    __slots__ = (
+        "lock",
+        "tokens",
+        "expires_at",
+        "denied_until",
+        "limit",
+        "refill_rate",
+        "shared_tokens",
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.expires_at = 0
+        self.denied_until = 0
+        # As of last lease: user's limit, its refill rate (tokens per second)
+        # and tokens left in the shared bucket
+        self.limit = None
+        self.refill_rate = None
+        self.shared_tokens = 0
+
+
+class HybridRedisRateLimiter(RateLimiter):
+    """
+    Token bucket rate limiter shared through redis, whose tokens are leased
+    to each process in chunks and spent locally
+        Representation of data stored in redis
+        metadata
+        --------
+        "userid_metadata": {
+            "requests": 100,
+            "window_time": 60
+        }
+
+        bucket
+        ------
+        "userid_bucket": {
+            "tokens": 42.5,
+            "last_refill": 1700000000.123
+        }
+    Bucket holds upto num_requests tokens, refilled at num_requests / window_time_in_sec
+    per second. A process goes to redis only when its lease runs out of tokens or
+    expires (after lease_ttl_sec), returning what is left of the old lease and leasing
+    a new chunk in the same script call. Leased tokens are taken from the shared bucket
+    upfront, so all processes together never admit more than the bucket allows;
+    in exchange tokens sitting in other processes' leases (upto chunk_size each,
+    for upto lease_ttl_sec) can't be spent by a process which has run out.
+    """
+
+    METADATA_SUFFIX = "_metadata"
+    BUCKET_SUFFIX = "_bucket"
+
+    # Refill the user's bucket, take back returned tokens and lease upto requested ones
+    # KEYS: metadata and bucket keys of the user
+    # ARGV: current timestamp, tokens returned, tokens requested
+    # Returns (tokens leased, tokens left in bucket, limit, window time),
+    # as strings where integer replies would truncate them,
+    # or -1 if user is un-registered
+    LEASE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rate = redis.call('HMGET', KEYS[1], 'requests', 'window_time')
+if not rate[1] then
+    return -1
+end
+local bucket_size = tonumber(rate[1])
+local window_time = tonumber(rate[2])
+local refill_rate = bucket_size / window_time
+local bucket = redis.call('HMGET', KEYS[2], 'tokens', 'last_refill')
+local tokens = tonumber(bucket[1]) or bucket_size
+local last_refill = tonumber(bucket[2]) or now
+if now > last_refill then
+    tokens = math.min(bucket_size, tokens + (now - last_refill) * refill_rate)
+    last_refill = now
+end
+tokens = math.min(bucket_size, tokens + tonumber(ARGV[2]))
+local leased = math.max(0, math.min(tonumber(ARGV[3]), math.floor(tokens)))
+tokens = tokens - leased
+redis.call('HSET', KEYS[2], 'tokens', tostring(tokens), 'last_refill', tostring(last_refill))
+-- untouched for a window, bucket would be full again
+redis.call('EXPIRE', KEYS[2], math.ceil(window_time) + 1)
+return {leased, tostring(tokens), bucket_size, tostring(window_time)}
+"""
+    LEASE_SCRIPT_SHA = hashlib.sha1(LEASE_SCRIPT.encode()).hexdigest()
+
+    def __init__(self, conn=None, chunk_size=10, lease_ttl_sec=1, clock=None):
+        """
+        conn: redis client, defaults to one backed by the shared connection pool
+        chunk_size: tokens leased per round trip
+        lease_ttl_sec: max time a lease is spent before syncing with redis
+        clock: source of timestamps (Clock), defaults to WallClock
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        self.conn = get_connection() if conn is None else conn
+        self.chunk_size = chunk_size
+        self.lease_ttl_sec = lease_ttl_sec
+        # Buckets are shared by all processes through redis,
+        # so clock defaults to wall clock rather than a per process monotonic one
+        self.clock = WallClock() if clock is None else clock
+        self.leases_lock = threading.Lock()
+        self.leases = {}
+
+    def get_current_timestamp_sec(self):
+        return self.clock.now()
+
+    def time_round_trip(self):
+        if self.metrics is None:
+            return NOT_TIMED
+        return self.metrics.timer("redis_round_trip_seconds")
+
+    def add_user(self, user_id, num_requests, window_time_in_sec):
+        pipe = self.conn.pipeline(transaction=True)
+        pipe.hset(
+            user_id + self.METADATA_SUFFIX,
+            mapping={"requests": num_requests, "window_time": window_time_in_sec},
+        )
+        pipe.delete(user_id + self.BUCKET_SUFFIX)
+        pipe.execute()
+        self.leases.pop(user_id, None)
+
+    def add_users_bulk(self, users):
+        """
+        Users are written in a single pipeline, i.e. one round trip
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        user_ids = []
+        for user_id, num_requests, window_time_in_sec in users:
+            pipe.hset(
+                user_id + self.METADATA_SUFFIX,
+                mapping={"requests": num_requests, "window_time": window_time_in_sec},
+            )
+            pipe.delete(user_id + self.BUCKET_SUFFIX)
+            user_ids.append(user_id)
+        with self.time_round_trip():
+            pipe.execute()
+        for user_id in user_ids:
+            self.leases.pop(user_id, None)
+
+    def add_user_limits(self, user_id, limits):
+        if len(limits) != 1:
+            raise ValueError("Only a single limit per user is supported")
+        num_requests, window_time_in_sec = limits[0]
+        self.add_user(user_id, num_requests, window_time_in_sec)
+
+    def remove_user(self, user_id):
+        self.conn.delete(user_id + self.METADATA_SUFFIX, user_id + self.BUCKET_SUFFIX)
+        self.leases.pop(user_id, None)
+
+    def get_lease(self, user_id):
+        lease = self.leases.get(user_id)
+        if lease is None:
+            with self.leases_lock:
+                lease = self.leases.setdefault(user_id, UserLease())
+        return lease
+
+    def renew_lease(self, user_id, lease, current_timestamp):
+        """
+        Return unspent tokens of the lease and lease a new chunk,
+        caller must hold the lease's lock
+        """
+        keys = [user_id + self.METADATA_SUFFIX, user_id + self.BUCKET_SUFFIX]
+        args = [current_timestamp, lease.tokens, self.chunk_size]
+        try:
+            with self.time_round_trip():
+                result = self.conn.evalsha(self.LEASE_SCRIPT_SHA, 2, *keys, *args)
+        except redis.exceptions.NoScriptError:
+            with self.time_round_trip():
+                result = self.conn.eval(self.LEASE_SCRIPT, 2, *keys, *args)
+        if not isinstance(result, list):
+            self.leases.pop(user_id, None)
+            raise Exception("Un-registered user: " + user_id)
+        leased, shared_tokens, limit, window_time = result
+        lease.tokens = int(leased)
+        lease.expires_at = current_timestamp + self.lease_ttl_sec
+        lease.limit = int(limit)
+        lease.refill_rate = lease.limit / float(window_time)
+        lease.shared_tokens = float(shared_tokens)
+        if lease.tokens < 1:
+            # no point asking redis again before a token is refilled,
+            # users with a zero limit never get one so only the lease TTL applies
+            retry_after = self.lease_ttl_sec
+            if lease.refill_rate > 0:
+                retry_after = min(
+                    retry_after, (1 - lease.shared_tokens) / lease.refill_rate
+                )
+            lease.denied_until = current_timestamp + retry_after
+
+    def try_acquire(self, user_id, lease, current_timestamp):
+        """
+        Spend a leased token, renewing the lease if it has run out or expired,
+        caller must hold the lease's lock
+        """
+        if lease.tokens >= 1 and current_timestamp < lease.expires_at:
+            lease.tokens -= 1
+            return True
+        if current_timestamp < lease.denied_until:
+            return False
+        self.renew_lease(user_id, lease, current_timestamp)
+        if lease.tokens < 1:
+            return False
+        lease.tokens -= 1
+        return True
+
+    def is_allowed(self, user_id):
+        lease = self.get_lease(user_id)
+        with lease.lock:
+            allowed = self.try_acquire(user_id, lease, self.get_current_timestamp_sec())
+        if self.metrics is not None:
+            self.metrics.record_decision(allowed)
+        return allowed
+
+    def is_allowed_tiered(self, user_id):
+        allowed = self.is_allowed(user_id)
+        return allowed, None if allowed else 0
+
+    def check(self, user_id):
+        """
+        Remaining quota is what this process holds plus what was left in
+        the shared bucket when it last synced
+        """
+        lease = self.get_lease(user_id)
+        with lease.lock:
+            current_timestamp = self.get_current_timestamp_sec()
+            allowed = self.try_acquire(user_id, lease, current_timestamp)
+            remaining = int(lease.tokens + lease.shared_tokens)
+            reset_at = current_timestamp
+            if lease.refill_rate > 0:
+                reset_at += (lease.limit - remaining) / lease.refill_rate
+            decision = RateLimitDecision(
+                allowed,
+                lease.limit,
+                remaining,
+                reset_at,
+                0 if allowed else max(0, lease.denied_until - current_timestamp),
+                current_timestamp,
+            )
+        if self.metrics is not None:
+            self.metrics.record_decision(allowed)
+        return decision
+
+    def release_leases(self):
+        """
+        Return unspent tokens of all leases to redis, e.g. on shutdown
+        """
+        with self.leases_lock:
+            leases = list(self.leases.items())
+            self.leases.clear()
+        pipe = self.conn.pipeline(transaction=False)
+        current_timestamp = self.get_current_timestamp_sec()
+        for user_id, lease in leases:
+            with lease.lock:
+                if lease.tokens >= 1:
+                    pipe.eval(
+                        self.LEASE_SCRIPT,
+                        2,
+                        user_id + self.METADATA_SUFFIX,
+                        user_id + self.BUCKET_SUFFIX,
+                        current_timestamp,
+                        lease.tokens,
+                        0,
+                    )
+                    lease.tokens = 0
+        pipe.execute()
@@ -0,0 +1,277 @@
+import threading
+from abc import abstractmethod
+
+from clock import MonotonicClock
+from rate_limiter import RateLimitDecision, RateLimiter, group_by_user
+from user_registry import ShardedUserRegistry
+
+
+class UserLimitTiers:
+    """
+    State of a user with multiple limits (e.g. 10 per second and 1000 per hour),
+    one user state per limit tier guarded by a single lock
+    Request is allowed only if every tier allows it, and then counts against all of them.
+    """
+
+    __slots__ = ("lock", "tiers")
+
+    def __init__(self, tiers):
+        self.lock = threading.Lock()
+        self.tiers = tiers
+
+    def try_acquire_tiered(self, current_timestamp):
+        """
+        Decide a single request, returns index of the first tier denying it
+        or None if it is allowed
+        """
+        for index, tier in enumerate(self.tiers):
+            if not tier.can_acquire(current_timestamp):
+                return index
+        for tier in self.tiers:
+            tier.acquire(current_timestamp)
+        return None
+
+    def try_acquire(self, current_timestamp):
+        return self.try_acquire_tiered(current_timestamp) is None
+
+
+def try_acquire_tiered(user_state, current_timestamp):
+    """
+    Decide a single request of a user with one or more limit tiers,
+    returns (is allowed, index of tier which denied it or None)
+    """
+    if isinstance(user_state, UserLimitTiers):
+        tripped_tier = user_state.try_acquire_tiered(current_timestamp)
+        return tripped_tier is None, tripped_tier
+    if user_state.try_acquire(current_timestamp):
+        return True, None
+    return False, 0
+
+
+def check_user_state(user_state, current_timestamp):
+    """
+    Decide a single request of a user with one or more limit tiers,
+    returns RateLimitDecision reporting quota of the tier with least of it remaining
+    """
+    allowed, _ = try_acquire_tiered(user_state, current_timestamp)
+    if isinstance(user_state, UserLimitTiers):
+        quotas = [tier.get_quota(current_timestamp) for tier in user_state.tiers]
+    else:
+        quotas = [user_state.get_quota(current_timestamp)]
+    limit, remaining, reset_at, _ = min(quotas, key=lambda quota: quota[1])
+    retry_after = 0 if allowed else max(quota[3] for quota in quotas)
+    return RateLimitDecision(
+        allowed, limit, remaining, reset_at, retry_after, current_timestamp
+    )
+
+
+class InMemoryRateLimiter(RateLimiter):
+    """
+    Base class of rate limiters keeping each user's state in process memory
+    User state added by the implementations is expected to have a lock,
+    a try_acquire(current_timestamp) method deciding a single request,
+    can_acquire / acquire methods splitting it so multiple limit tiers can be
+    checked before any of them is consumed, and a get_quota(current_timestamp)
+    method reporting what is left of the user's quota.
+    """
+
+    def __init__(
+        self,
+        num_shards=ShardedUserRegistry.DEFAULT_NUM_SHARDS,
+        clock=None,
+        max_users=None,
+        idle_ttl_sec=None,
+    ):
+        """
+        clock: source of timestamps (Clock), defaults to MonotonicClock
+        max_users: bound on users tracked, least recently used ones are dropped beyond it
+        idle_ttl_sec: users who made no request for this long are dropped
+        """
+        self._init_user_map(
+            clock,
+            lambda clock: ShardedUserRegistry(
+                num_shards, max_users, idle_ttl_sec, clock
+            ),
+        )
+
+    def _init_user_map(self, clock, create_user_map):
+        """
+        Set up clock, user registry (created by create_user_map given the clock)
+        and sweeper state, shared by limiters keeping users in other registries
+        """
+        self.clock = MonotonicClock() if clock is None else clock
+        self.user_map = create_user_map(self.clock)
+        self.sweeper = None
+        self.sweeper_stopped = threading.Event()
+
+    def get_current_timestamp_sec(self):
+        return self.clock.now()
+
+    @classmethod
+    @abstractmethod
+    def create_user_state(
+        cls, num_requests, window_time_in_sec, current_timestamp, **options
+    ):
+        """
+        New state of a user, options are specific to the implementation
+        """
+        pass
+
+    def add_user(self, user_id, num_requests, window_time_in_sec, **options):
+        self.user_map.add(
+            user_id,
+            self.create_user_state(
+                num_requests,
+                window_time_in_sec,
+                self.get_current_timestamp_sec(),
+                **options,
+            ),
+        )
+
+    def add_users_bulk(self, users, **options):
+        """
+        Users are created as of a single timestamp and added taking each shard's
+        lock once, none of them is added if any is already present
+        """
+        current_timestamp = self.get_current_timestamp_sec()
+        self.user_map.add_many(
+            [
+                (
+                    user_id,
+                    self.create_user_state(
+                        num_requests, window_time_in_sec, current_timestamp, **options
+                    ),
+                )
+                for user_id, num_requests, window_time_in_sec in users
+            ]
+        )
+
+    @classmethod
+    def create_user_limit_tiers(cls, limits, current_timestamp, **options):
+        """
+        New state of a user with a (num_requests, window_time_in_sec) limit per tier
+        """
+        if not limits:
+            raise ValueError("At least one limit is required")
+        return UserLimitTiers(
+            [
+                cls.create_user_state(
+                    num_requests, window_time_in_sec, current_timestamp, **options
+                )
+                for num_requests, window_time_in_sec in limits
+            ]
+        )
+
+    def add_user_limits(self, user_id, limits, **options):
+        self.user_map.add(
+            user_id,
+            self.create_user_limit_tiers(
+                limits, self.get_current_timestamp_sec(), **options
+            ),
+        )
+
+    def remove_user(self, user_id):
+        self.user_map.remove(user_id)
+
+    def trim_user_state(self, user_state, current_timestamp):
+        """
+        Free memory held by user state for requests outside the window,
+        implementations keeping per request state override this
+        """
+        pass
+
+    def sweep(self):
+        """
+        Drop idle users and trim state of the remaining ones
+        """
+        self.user_map.evict_idle_users()
+        for user_state in self.user_map.values():
+            tier_states = (
+                user_state.tiers
+                if isinstance(user_state, UserLimitTiers)
+                else (user_state,)
+            )
+            with user_state.lock:
+                for tier_state in tier_states:
+                    self.trim_user_state(tier_state, self.get_current_timestamp_sec())
+
+    def start_sweeper(self, interval_sec):
+        """
+        Sweep every interval_sec in a background daemon thread
+        """
+        if self.sweeper is not None:
+            raise Exception("Sweeper already running")
+        self.sweeper_stopped.clear()
+
+        def _sweep_periodically():
+            while not self.sweeper_stopped.wait(interval_sec):
+                self.sweep()
+
+        self.sweeper = threading.Thread(target=_sweep_periodically, daemon=True)
+        self.sweeper.start()
+
+    def stop_sweeper(self):
+        if self.sweeper is not None:
+            self.sweeper_stopped.set()
+            self.sweeper.join()
+            self.sweeper = None
+
+    def enable_metrics(self, metrics=None):
+        metrics = super().enable_metrics(metrics)
+        self.user_map.metrics = metrics
+        return metrics
+
+    def lock_user_state(self, user_state):
+        """
+        User state's lock, timed while metrics are enabled
+        """
+        if self.metrics is None:
+            return user_state.lock
+        return self.metrics.timed_lock(user_state.lock, "user_lock_wait_seconds")
+
+    def is_allowed(self, user_id):
+        user_state = self.user_map.get(user_id)
+
+        with self.lock_user_state(user_state):
+            allowed = user_state.try_acquire(self.get_current_timestamp_sec())
+        if self.metrics is not None:
+            self.metrics.record_decision(allowed)
+        return allowed
+
+    def is_allowed_tiered(self, user_id):
+        user_state = self.user_map.get(user_id)
+
+        with self.lock_user_state(user_state):
+            allowed, tripped_tier = try_acquire_tiered(
+                user_state, self.get_current_timestamp_sec()
+            )
+        if self.metrics is not None:
+            self.metrics.record_decision(allowed)
+        return allowed, tripped_tier
+
+    def check(self, user_id):
+        user_state = self.user_map.get(user_id)
+
+        with self.lock_user_state(user_state):
+            decision = check_user_state(user_state, self.get_current_timestamp_sec())
+        if self.metrics is not None:
+            self.metrics.record_decision(decision.allowed)
+        return decision
+
+    def is_allowed_many(self, user_ids):
+        """
+        Requests are grouped by user, so each user's state is looked up
+        and locked once per batch. Decisions of a user's requests are made
+        in the order they appear in user_ids.
+        """
+        decisions = [False] * len(user_ids)
+        for user_id, indices in group_by_user(user_ids).items():
+            user_state = self.user_map.get(user_id)
+
+            with self.lock_user_state(user_state):
+                current_timestamp = self.get_current_timestamp_sec()
+                for index in indices:
+                    decisions[index] = user_state.try_acquire(current_timestamp)
+        if self.metrics is not None:
+            self.metrics.record_decisions(decisions)
+        return decisions
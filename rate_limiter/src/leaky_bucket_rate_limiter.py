@@ -0,0 +1,96 @@
+import threading
+
+from in_memory_rate_limiter import InMemoryRateLimiter
+
+
+class UserLeakyBucket:
+    """
+    Leaky bucket of each user, leaked lazily on every request
+    """
+
+    __slots__ = (
+        "lock",
+        "bucket_size",
+        "leak_rate",
+        "window_time_in_sec",
+        "level",
+        "last_leak",
+    )
+
+    def __init__(self, bucket_size, leak_rate, window_time_in_sec, current_timestamp):
+        self.lock = threading.Lock()
+        self.bucket_size = bucket_size
+        # Requests drained per second
+        self.leak_rate = leak_rate
+        self.window_time_in_sec = window_time_in_sec
+        self.level = 0
+        self.last_leak = current_timestamp
+
+    def leak(self, current_timestamp):
+        """
+        Drain requests leaked out since last leak, bucket level can't go below 0
+        """
+        elapsed = current_timestamp - self.last_leak
+        if elapsed > 0:
+            self.level = max(0, self.level - elapsed * self.leak_rate)
+            self.last_leak = current_timestamp
+
+    def can_acquire(self, current_timestamp):
+        self.leak(current_timestamp)
+        # Check if there is room in the bucket for the request
+        return self.level + 1 <= self.bucket_size
+
+    def acquire(self, current_timestamp):
+        self.level += 1
+
+    def get_quota(self, current_timestamp):
+        """
+        (limit, remaining, reset_at, retry_after) as of current timestamp
+        """
+        self.leak(current_timestamp)
+        retry_after = 0
+        if self.leak_rate <= 0:
+            # Bucket of a zero quota user never leaks
+            reset_at = current_timestamp
+            if self.level:
+                reset_at += self.window_time_in_sec
+            if self.level + 1 > self.bucket_size:
+                retry_after = self.window_time_in_sec
+        else:
+            reset_at = current_timestamp + self.level / self.leak_rate
+            if self.level + 1 > self.bucket_size:
+                retry_after = (self.level + 1 - self.bucket_size) / self.leak_rate
+        return (
+            self.bucket_size,
+            max(0, int(self.bucket_size - self.level)),
+            reset_at,
+            retry_after,
+        )
+
+    def try_acquire(self, current_timestamp):
+        if not self.can_acquire(current_timestamp):
+            return False
+        self.acquire(current_timestamp)
+        return True
+
+
+class LeakyBucketRateLimiter(InMemoryRateLimiter):
+    """
+    Implementation of Leaky bucket (as a meter) rate limiter
+    Each allowed request adds one unit to the bucket, which leaks at
+    num_requests / window_time_in_sec units per second.
+    Request is allowed only if it fits in the bucket of size bucket_size.
+    Leak is computed from the limiter's clock when user makes a request,
+    so there are no background timers.
+    """
+
+    @classmethod
+    def create_user_state(
+        cls, num_requests, window_time_in_sec, current_timestamp, bucket_size=None
+    ):
+        return UserLeakyBucket(
+            num_requests if bucket_size is None else bucket_size,
+            num_requests / window_time_in_sec,
+            window_time_in_sec,
+            current_timestamp,
+        )
@@ -0,0 +1,177 @@
+import contextlib
+import threading
+import time
+from bisect import bisect_left
+
+
+class Histogram:
+    """
+    Counts of observed values in fixed buckets, along with their sum and count
+    Bucket i counts values <= buckets[i], last one counts values beyond all buckets.
+    """
+
+    __slots__ = ("lock", "buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """
+        Cumulative counts per bucket upper bound (None for +Inf), sum and count
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = []
+        running = 0
+        for bucket, bucket_count in zip(self.buckets + (None,), counts):
+            running += bucket_count
+            cumulative.append((bucket, running))
+        return {"buckets": cumulative, "sum": total, "count": count}
+
+
+class TimedLock:
+    """
+    Context manager acquiring a lock and recording how long it waited for it
+    """
+
+    __slots__ = ("lock", "histogram")
+
+    def __init__(self, lock, histogram):
+        self.lock = lock
+        self.histogram = histogram
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.histogram.observe(time.perf_counter() - start)
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+class Timer:
+    """
+    Context manager recording how long its block took
+    """
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+# Stands in for a Timer while metrics are disabled
+NOT_TIMED = contextlib.nullcontext()
+
+
+class RateLimiterMetrics:
+    """
+    Instrumentation of a rate limiter, enabled with RateLimiter.enable_metrics
+        requests: allowed and denied decisions
+        registry_lock_wait_seconds: wait for user registry shard locks (in-memory)
+        user_lock_wait_seconds: wait for per user state locks (in-memory)
+        redis_round_trip_seconds: time of each call to redis
+    Rate limiters only record into it while enabled, disabled instrumentation
+    costs a single attribute check on the hot path.
+    """
+
+    # Upper bounds (in seconds) of histogram buckets, 1us to 1s
+    LATENCY_BUCKETS = (
+        0.000001,
+        0.000005,
+        0.00001,
+        0.00005,
+        0.0001,
+        0.0005,
+        0.001,
+        0.005,
+        0.01,
+        0.05,
+        0.1,
+        0.5,
+        1,
+    )
+    HISTOGRAMS = (
+        "registry_lock_wait_seconds",
+        "user_lock_wait_seconds",
+        "redis_round_trip_seconds",
+    )
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.denied = 0
+        self.histograms = {name: Histogram(buckets) for name in self.HISTOGRAMS}
+
+    def record_decision(self, allowed):
+        with self.lock:
+            if allowed:
+                self.allowed += 1
+            else:
+                self.denied += 1
+
+    def record_decisions(self, decisions):
+        num_allowed = sum(decisions)
+        with self.lock:
+            self.allowed += num_allowed
+            self.denied += len(decisions) - num_allowed
+
+    def timed_lock(self, lock, name):
+        return TimedLock(lock, self.histograms[name])
+
+    def timer(self, name):
+        return Timer(self.histograms[name])
+
+    def to_dict(self):
+        with self.lock:
+            metrics = {"allowed": self.allowed, "denied": self.denied}
+        for name, histogram in self.histograms.items():
+            metrics[name] = histogram.snapshot()
+        return metrics
+
+    def to_prometheus(self, namespace="rate_limiter"):
+        """
+        Snapshot in Prometheus text exposition format
+        """
+        metrics = self.to_dict()
+        lines = [
+            "# HELP %s_requests_total Requests decided by the rate limiter" % namespace,
+            "# TYPE %s_requests_total counter" % namespace,
+            '%s_requests_total{decision="allowed"} %d'
+            % (namespace, metrics["allowed"]),
+            '%s_requests_total{decision="denied"} %d' % (namespace, metrics["denied"]),
+        ]
+        for name in self.HISTOGRAMS:
+            histogram = metrics[name]
+            lines.append("# TYPE %s_%s histogram" % (namespace, name))
+            for bucket, count in histogram["buckets"]:
+                lines.append(
+                    '%s_%s_bucket{le="%s"} %d'
+                    % (
+                        namespace,
+                        name,
+                        "+Inf" if bucket is None else repr(bucket),
+                        count,
+                    )
+                )
+            lines.append("%s_%s_sum %r" % (namespace, name, histogram["sum"]))
+            lines.append("%s_%s_count %d" % (namespace, name, histogram["count"]))
+        return "\n".join(lines) + "\n"
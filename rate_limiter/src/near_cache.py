@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+
+
+class NearCache:
+    """
+    Bounded in-process LRU cache whose entries expire after a TTL
+    Used in front of remote rate limiter state to answer repeated lookups
+    without network I/O. Timestamps are passed in by the caller, so entries
+    expire on the same clock the rate limiter decides requests with.
+    """
+
+    def __init__(self, max_size, ttl_sec):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        # key: (value, expires_at), least recently used first
+        self.entries = OrderedDict()
+
+    def get(self, key, current_timestamp):
+        """
+        Cached value of key, None if it is missing or has expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if current_timestamp >= expires_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, current_timestamp, expires_at=None):
+        """
+        Cache value till expires_at, but never longer than the TTL
+        """
+        expires_at_ttl = current_timestamp + self.ttl_sec
+        if expires_at is None or expires_at > expires_at_ttl:
+            expires_at = expires_at_ttl
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
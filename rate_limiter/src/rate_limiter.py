@@ -1,15 +1,85 @@
 from abc import ABCMeta, abstractmethod
 
+from metrics import RateLimiterMetrics
+
+
+class RateLimitDecision:
+    """
+    Decision of a single request along with the user's quota after it
+    Timestamps are in seconds on the clock of the rate limiter making the decision.
+        limit: requests allowed per window (of the most constrained tier)
+        remaining: requests the user can still make right away
+        reset_at: timestamp by which full quota is available again
+        retry_after: seconds till a request could be allowed, 0 if this one was
+        timestamp: when the decision was made
+    """
+
+    __slots__ = (
+        "allowed",
+        "limit",
+        "remaining",
+        "reset_at",
+        "retry_after",
+        "timestamp",
+    )
+
+    def __init__(self, allowed, limit, remaining, reset_at, retry_after, timestamp):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset_at = reset_at
+        self.retry_after = retry_after
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return (
+            "RateLimitDecision(allowed=%r, limit=%r, remaining=%r, reset_at=%r, "
+            "retry_after=%r)"
+            % (
+                self.allowed,
+                self.limit,
+                self.remaining,
+                self.reset_at,
+                self.retry_after,
+            )
+        )
+
 
 class RateLimiter:
     """
     Interface for Rate Limiters
     """
 
+    # Instrumentation (RateLimiterMetrics), disabled till enable_metrics is called
+    metrics = None
+
+    def enable_metrics(self, metrics=None):
+        """
+        Start recording decisions, lock waits and redis round trips,
+        returns the metrics recorded into
+        """
+        self.metrics = RateLimiterMetrics() if metrics is None else metrics
+        return self.metrics
+
     @abstractmethod
     def add_user(self, user_id, num_requests, window_time_in_sec):
         pass
 
+    @abstractmethod
+    def add_user_limits(self, user_id, limits):
+        """
+        Register a user with a (num_requests, window_time_in_sec) limit per tier
+        """
+        pass
+
+    def add_users_bulk(self, users):
+        """
+        Register many users, given as (user_id, num_requests, window_time_in_sec)
+        Implementations override this to amortize locking / network round trips
+        """
+        for user_id, num_requests, window_time_in_sec in users:
+            self.add_user(user_id, num_requests, window_time_in_sec)
+
     @abstractmethod
     def remove_user(self, user_id):
         pass
@@ -17,3 +87,85 @@ class RateLimiter:
     @abstractmethod
     def is_allowed(self, user_id):
         pass
+
+    @abstractmethod
+    def is_allowed_tiered(self, user_id):
+        """
+        Decide a request, returns (is allowed, index of tier which denied it or None)
+        """
+        pass
+
+    @abstractmethod
+    def check(self, user_id):
+        """
+        Decide a request, returns RateLimitDecision with user's remaining quota
+        """
+        pass
+
+    def is_allowed_many(self, user_ids):
+        """
+        Decide a batch of requests, one decision per entry of user_ids
+        Implementations override this to amortize locking / network round trips
+        """
+        return [self.is_allowed(user_id) for user_id in user_ids]
+
+
+class AsyncRateLimiter:
+    """
+    Interface for Rate Limiters used from an asyncio event loop
+    """
+
+    metrics = None
+
+    def enable_metrics(self, metrics=None):
+        self.metrics = RateLimiterMetrics() if metrics is None else metrics
+        return self.metrics
+
+    @abstractmethod
+    async def add_user(self, user_id, num_requests, window_time_in_sec):
+        pass
+
+    @abstractmethod
+    async def add_user_limits(self, user_id, limits):
+        pass
+
+    async def add_users_bulk(self, users):
+        """
+        Register many users, given as (user_id, num_requests, window_time_in_sec)
+        Implementations override this to amortize network round trips
+        """
+        for user_id, num_requests, window_time_in_sec in users:
+            await self.add_user(user_id, num_requests, window_time_in_sec)
+
+    @abstractmethod
+    async def remove_user(self, user_id):
+        pass
+
+    @abstractmethod
+    async def is_allowed(self, user_id):
+        pass
+
+    @abstractmethod
+    async def is_allowed_tiered(self, user_id):
+        pass
+
+    @abstractmethod
+    async def check(self, user_id):
+        pass
+
+    async def is_allowed_many(self, user_ids):
+        """
+        Decide a batch of requests, one decision per entry of user_ids
+        Implementations override this to amortize network round trips
+        """
+        return [await self.is_allowed(user_id) for user_id in user_ids]
+
+
+def group_by_user(user_ids):
+    """
+    Map each user_id to positions of its requests in the batch, in order
+    """
+    user_indices = {}
+    for index, user_id in enumerate(user_ids):
+        user_indices.setdefault(user_id, []).append(index)
+    return user_indices
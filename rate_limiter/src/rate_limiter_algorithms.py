@@ -0,0 +1,25 @@
+from leaky_bucket_rate_limiter import LeakyBucketRateLimiter
+from sliding_window_counter_rate_limiter import SlidingWindowCounterRateLimiter
+from sliding_window_logs_rate_limiter import SlidingWindowLogsRateLimiter
+from token_bucket_rate_limiter import TokenBucketRateLimiter
+
+# In-memory rate limiter classes by name, shared by the command line tools
+RATE_LIMITER_ALGORITHMS = {
+    "sliding_window_log": SlidingWindowLogsRateLimiter,
+    "sliding_window_counter": SlidingWindowCounterRateLimiter,
+    "token_bucket": TokenBucketRateLimiter,
+    "leaky_bucket": LeakyBucketRateLimiter,
+}
+
+
+def get_rate_limiter_class(rate_limiter_algorithm):
+    """
+    Rate limiter class of an algorithm given by name, or by its position
+    in RATE_LIMITER_ALGORITHMS (e.g. "0" for sliding_window_log)
+    """
+    names = list(RATE_LIMITER_ALGORITHMS)
+    if rate_limiter_algorithm.isdigit() and int(rate_limiter_algorithm) < len(names):
+        rate_limiter_algorithm = names[int(rate_limiter_algorithm)]
+    if rate_limiter_algorithm not in RATE_LIMITER_ALGORITHMS:
+        raise ValueError("Unknown rate limiter algorithm: " + rate_limiter_algorithm)
+    return RATE_LIMITER_ALGORITHMS[rate_limiter_algorithm]
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import weakref
+
+import redis
+import redis.asyncio
+
+DEFAULT_REDIS_URL = "redis://localhost:6379/0"
+DEFAULT_MAX_CONNECTIONS = 50
+# Seconds to wait for a free connection from the pool once max_connections are in use
+DEFAULT_POOL_TIMEOUT = 1.0
+# Seconds to wait for connecting to / a response from redis
+DEFAULT_SOCKET_TIMEOUT = 1.0
+
+_pools_lock = threading.Lock()
+_pools = {}
+# asyncio connections are bound to the event loop they were opened in,
+# so asyncio pools are kept per event loop and dropped along with it
+_async_pools = weakref.WeakKeyDictionary()
+
+
+def _get_pool(
+    pools,
+    pool_class,
+    url,
+    max_connections,
+    pool_timeout,
+    socket_timeout,
+):
+    """
+    Pools are shared by all callers asking for the same configuration
+    """
+    key = (url, max_connections, pool_timeout, socket_timeout)
+    with _pools_lock:
+        if key not in pools:
+            pools[key] = pool_class.from_url(
+                url,
+                max_connections=max_connections,
+                timeout=pool_timeout,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_timeout,
+                decode_responses=True,
+            )
+        return pools[key]
+
+
+def get_connection_pool(
+    url=DEFAULT_REDIS_URL,
+    max_connections=DEFAULT_MAX_CONNECTIONS,
+    pool_timeout=DEFAULT_POOL_TIMEOUT,
+    socket_timeout=DEFAULT_SOCKET_TIMEOUT,
+):
+    return _get_pool(
+        _pools,
+        redis.BlockingConnectionPool,
+        url,
+        max_connections,
+        pool_timeout,
+        socket_timeout,
+    )
+
+
+def get_async_connection_pool(
+    url=DEFAULT_REDIS_URL,
+    max_connections=DEFAULT_MAX_CONNECTIONS,
+    pool_timeout=DEFAULT_POOL_TIMEOUT,
+    socket_timeout=DEFAULT_SOCKET_TIMEOUT,
+):
+    """
+    Pools are shared by callers on the same event loop, must be called
+    with an event loop running (from a coroutine)
+    """
+    loop = asyncio.get_running_loop()
+    with _pools_lock:
+        loop_pools = _async_pools.setdefault(loop, {})
+    return _get_pool(
+        loop_pools,
+        redis.asyncio.BlockingConnectionPool,
+        url,
+        max_connections,
+        pool_timeout,
+        socket_timeout,
+    )
+
+
+def get_connection(**pool_options):
+    """
+    Redis client backed by the shared connection pool of given pool options
+    """
+    return redis.Redis(connection_pool=get_connection_pool(**pool_options))
+
+
+def get_async_connection(**pool_options):
+    """
+    redis.asyncio client backed by the shared connection pool of given pool options
+    on the running event loop
+    """
+    return redis.asyncio.Redis(
+        connection_pool=get_async_connection_pool(**pool_options)
+    )
@@ -0,0 +1,479 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import time
+from urllib.parse import unquote
+
+import typer
+from context import Context
+from rate_limiter_algorithms import RATE_LIMITER_ALGORITHMS, get_rate_limiter_class
+from sliding_window_logs_rate_limiter import SlidingWindowLogsRateLimiter
+from snapshot import Snapshotter, restore_snapshot
+from typing_extensions import Annotated
+from user_loader import load_users
+
+logging.basicConfig(level=logging.INFO)
+app = typer.Typer()
+
+REASONS = {
+    200: "OK",
+    201: "Created",
+    204: "No Content",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class HttpRequest:
+    __slots__ = ("method", "path", "version", "headers", "body")
+
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def keep_alive(self):
+        """
+        HTTP/1.1 connections are persistent unless closed, HTTP/1.0 ones only if asked
+        """
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise HttpError(400, "Body is not valid JSON")
+
+
+async def read_head(reader):
+    """
+    Start line and headers of a HTTP message, None if connection was closed
+    """
+    start_line = await reader.readline()
+    if not start_line.strip():
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return start_line.decode("latin-1").split(None, 2), headers
+
+
+async def read_body(reader, headers, max_body_size):
+    length = int(headers.get("content-length", 0))
+    if length > max_body_size:
+        raise HttpError(413, "Body larger than %d bytes" % max_body_size)
+    return await reader.readexactly(length) if length else b""
+
+
+def encode_response(status, headers, body, keep_alive):
+    head = ["HTTP/1.1 %d %s" % (status, REASONS[status])]
+    head.extend("%s: %s" % header for header in headers.items())
+    head.append("Content-Length: %d" % len(body))
+    if not keep_alive:
+        head.append("Connection: close")
+    return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+
+def json_response(status, payload, headers=None):
+    headers = {} if headers is None else dict(headers)
+    headers["Content-Type"] = "application/json"
+    return status, headers, json.dumps(payload).encode()
+
+
+class RateLimiterServer:
+    """
+    HTTP/1.1 front end of a rate limiter shared by services written in any language
+        POST /users                body: user (or list of users) as in Context.add_users
+        DELETE /users/<user_id>
+        GET /check/<user_id>       200 or 429 with Retry-After / X-RateLimit-* headers
+        POST /batch                body: {"user_ids": [...]}, returns {"allowed": [...]}
+        GET /metrics               Prometheus text snapshot of the rate limiter
+    Connections are kept alive and requests pipelined on a connection are
+    answered in order. Rate limiter is called from the event loop, so it should
+    be an in-memory one whose decisions don't block.
+    """
+
+    MAX_BODY_SIZE = 1 << 20
+
+    def __init__(self, rate_limiter):
+        self.rate_limiter = rate_limiter
+        self.context = Context(rate_limiter)
+        if rate_limiter.metrics is None:
+            rate_limiter.enable_metrics()
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    head = await read_head(reader)
+                    if head is None:
+                        break
+                    (method, path, version), headers = head
+                    request = HttpRequest(
+                        method,
+                        path,
+                        version,
+                        headers,
+                        await read_body(reader, headers, self.MAX_BODY_SIZE),
+                    )
+                    keep_alive = request.keep_alive()
+                    status, headers, body = self.handle_request(request)
+                except HttpError as e:
+                    status, headers, body = json_response(e.status, {"error": str(e)})
+                except ValueError:
+                    status, headers, body = json_response(
+                        400, {"error": "Malformed request"}
+                    )
+                except Exception:
+                    logging.exception("Failed to handle request")
+                    status, headers, body = json_response(
+                        500, {"error": "Internal server error"}
+                    )
+                writer.write(encode_response(status, headers, body, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def handle_request(self, request):
+        parts = request.path.split("?", 1)[0].strip("/").split("/")
+        route = parts[0]
+        if route == "check" and len(parts) == 2:
+            self.require_method(request, "GET")
+            return self.check(unquote(parts[1]))
+        if route == "batch" and len(parts) == 1:
+            self.require_method(request, "POST")
+            return self.batch(request.json())
+        if route == "users" and len(parts) == 1:
+            self.require_method(request, "POST")
+            return self.add_users(request.json())
+        if route == "users" and len(parts) == 2:
+            self.require_method(request, "DELETE")
+            with user_not_found():
+                self.rate_limiter.remove_user(unquote(parts[1]))
+            return 204, {}, b""
+        if route == "metrics" and len(parts) == 1:
+            self.require_method(request, "GET")
+            return (
+                200,
+                {"Content-Type": "text/plain; version=0.0.4"},
+                self.rate_limiter.metrics.to_prometheus().encode(),
+            )
+        raise HttpError(404, "No such endpoint: " + request.path)
+
+    @classmethod
+    def require_method(cls, request, method):
+        if request.method != method:
+            raise HttpError(405, "Expected " + method)
+
+    def check(self, user_id):
+        with user_not_found():
+            decision = self.rate_limiter.check(user_id)
+        return json_response(
+            200 if decision.allowed else 429,
+            {
+                "allowed": decision.allowed,
+                "remaining": decision.remaining,
+                "retry_after": decision.retry_after,
+            },
+            Context.get_headers(decision),
+        )
+
+    def batch(self, payload):
+        if (
+            not isinstance(payload, dict)
+            or not isinstance(payload.get("user_ids"), list)
+            or not all(isinstance(user_id, str) for user_id in payload["user_ids"])
+        ):
+            raise HttpError(400, 'Expected {"user_ids": [...]} of strings')
+        with user_not_found():
+            decisions = self.rate_limiter.is_allowed_many(payload["user_ids"])
+        return json_response(200, {"allowed": decisions})
+
+    def add_users(self, payload):
+        users = payload if isinstance(payload, list) else [payload]
+        if not all(is_valid_user(user) for user in users):
+            raise HttpError(
+                400,
+                "Users need a string user_id, whole positive num_requests "
+                "and positive window_time_in_sec",
+            )
+        try:
+            self.context.add_users(users)
+        except Exception as e:
+            if str(e) != "User already present":
+                raise
+            raise HttpError(409, str(e))
+        return json_response(201, {"added": len(users)})
+
+
+def is_valid_user(user):
+    """
+    Whether a user added over HTTP has a user_id and limits the rate limiter
+    can work with, JSON numbers can be of any type and size
+    """
+    if not isinstance(user, dict) or not isinstance(user.get("user_id"), str):
+        return False
+    num_requests = user.get("num_requests")
+    window_time_in_sec = user.get("window_time_in_sec")
+    return (
+        type(num_requests) is int
+        and num_requests > 0
+        and type(window_time_in_sec) in (int, float)
+        and 0 < window_time_in_sec < float("inf")
+    )
+
+
+@contextlib.contextmanager
+def user_not_found():
+    """
+    Turn the rate limiter's error for an unknown user into a 404,
+    anything else is left to surface as a 500
+    """
+    try:
+        yield
+    except Exception as e:
+        if str(e) != "User not present":
+            raise
+        raise HttpError(404, str(e))
+
+
+async def request(reader, writer, method, path, payload=None):
+    """
+    Send a single request on a kept alive connection and read its response
+    """
+    send_request(writer, method, path, payload)
+    await writer.drain()
+    return await read_response(reader)
+
+
+def send_request(writer, method, path, payload=None):
+    body = b"" if payload is None else json.dumps(payload).encode()
+    writer.write(
+        (
+            "%s %s HTTP/1.1\r\nHost: rate-limiter\r\nContent-Length: %d\r\n\r\n"
+            % (method, path, len(body))
+        ).encode("latin-1")
+        + body
+    )
+
+
+async def read_response(reader):
+    """
+    Status, headers and body of the next response on a connection
+    """
+    head = await read_head(reader)
+    if head is None:
+        raise ConnectionError("Connection closed by server")
+    (_, status, _), headers = head
+    return int(status), headers, await read_body(reader, headers, float("inf"))
+
+
+async def run_load(
+    host,
+    port,
+    user_ids,
+    num_requests,
+    num_connections,
+    pipeline_depth,
+    batch_size,
+    seed=0,
+):
+    """
+    Send num_requests decisions (in batches of batch_size when above 1) over
+    num_connections connections, each keeping pipeline_depth requests in flight.
+    Returns elapsed time (sec), number of HTTP requests and allowed decisions
+    """
+    generator = random.Random(seed)
+    requests_per_connection = -(-num_requests // (num_connections * batch_size))
+    num_allowed = 0
+    num_http_requests = 0
+
+    async def _send_requests():
+        nonlocal num_allowed, num_http_requests
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            remaining = requests_per_connection
+            while remaining:
+                depth = min(pipeline_depth, remaining)
+                for _ in range(depth):
+                    if batch_size == 1:
+                        send_request(
+                            writer, "GET", "/check/" + generator.choice(user_ids)
+                        )
+                    else:
+                        batch = generator.choices(user_ids, k=batch_size)
+                        send_request(writer, "POST", "/batch", {"user_ids": batch})
+                await writer.drain()
+                for _ in range(depth):
+                    status, _, body = await read_response(reader)
+                    if batch_size == 1:
+                        num_allowed += status == 200
+                    else:
+                        num_allowed += sum(json.loads(body)["allowed"])
+                num_http_requests += depth
+                remaining -= depth
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_send_requests() for _ in range(num_connections)))
+    return time.perf_counter() - start, num_http_requests, num_allowed
+
+
+@app.command()
+def serve(
+    host: Annotated[str, typer.Option(help="Address to listen on")] = "127.0.0.1",
+    port: Annotated[int, typer.Option(help="Port to listen on")] = 8080,
+    rate_limiter_algorithm: Annotated[
+        str,
+        typer.Option(help="Options: " + ", ".join(RATE_LIMITER_ALGORITHMS)),
+    ] = "sliding_window_log",
+    snapshot_path: Annotated[
+        str,
+        typer.Option(
+            help="Restore users from this snapshot at startup and save them to it "
+            "periodically (sliding_window_log only)"
+        ),
+    ] = "",
+    snapshot_interval_sec: Annotated[
+        float,
+        typer.Option(
+            help="Time between snapshots, each costs about 1.5 us of CPU "
+            "(holding the GIL) per user"
+        ),
+    ] = Snapshotter.DEFAULT_INTERVAL_SEC,
+    users_file: Annotated[
+        str,
+        typer.Option(
+            help="CSV or JSONL file of users "
+            "(user_id, num_requests, window_time_in_sec) to add at startup"
+        ),
+    ] = "",
+):
+    try:
+        rate_limiter = get_rate_limiter_class(rate_limiter_algorithm)()
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
+    server = RateLimiterServer(rate_limiter)
+    if users_file:
+        start = time.perf_counter()
+        num_users = load_users(rate_limiter, users_file)
+        logging.info("Added %d users in %.2fs", num_users, time.perf_counter() - start)
+    snapshotter = None
+    if snapshot_path:
+        if not isinstance(rate_limiter, SlidingWindowLogsRateLimiter):
+            raise typer.BadParameter("Snapshots need sliding_window_log algorithm")
+        if os.path.exists(snapshot_path):
+            start = time.perf_counter()
+            num_users = restore_snapshot(rate_limiter, snapshot_path)
+            logging.info(
+                "Restored %d users in %.2fs", num_users, time.perf_counter() - start
+            )
+        snapshotter = Snapshotter(rate_limiter, snapshot_path, snapshot_interval_sec)
+        snapshotter.start()
+
+    async def _serve():
+        http_server = await server.start(host, port)
+        logging.info("Serving %s on %s:%d", rate_limiter_algorithm, host, port)
+        async with http_server:
+            await http_server.serve_forever()
+
+    try:
+        asyncio.run(_serve())
+    finally:
+        if snapshotter is not None:
+            snapshotter.stop()
+
+
+@app.command()
+def load(
+    host: Annotated[str, typer.Option(help="Address of the server")] = "127.0.0.1",
+    port: Annotated[int, typer.Option(help="Port of the server")] = 8080,
+    num_users: Annotated[int, typer.Option(help="Number of users")] = 1000,
+    num_requests: Annotated[int, typer.Option(help="Total decisions asked")] = 100000,
+    num_connections: Annotated[int, typer.Option(help="Kept alive connections")] = 8,
+    pipeline_depth: Annotated[
+        int, typer.Option(help="Requests in flight per connection")
+    ] = 16,
+    batch_size: Annotated[
+        int, typer.Option(help="Decisions per request, above 1 uses /batch")
+    ] = 1,
+    limit: Annotated[int, typer.Option(help="Requests allowed per window")] = 100,
+    window_time_in_sec: Annotated[int, typer.Option(help="Window of the limit")] = 60,
+):
+    user_ids = ["user" + str(i) for i in range(num_users)]
+
+    async def _load():
+        reader, writer = await asyncio.open_connection(host, port)
+        users = [
+            {
+                "user_id": user_id,
+                "num_requests": limit,
+                "window_time_in_sec": window_time_in_sec,
+            }
+            for user_id in user_ids
+        ]
+        status, _, body = await request(reader, writer, "POST", "/users", users)
+        if status != 201:
+            logging.info("Users not added: %s", body.decode())
+        writer.close()
+        return await run_load(
+            host,
+            port,
+            user_ids,
+            num_requests,
+            num_connections,
+            pipeline_depth,
+            batch_size,
+        )
+
+    elapsed, num_http_requests, num_allowed = asyncio.run(_load())
+    num_decisions = num_http_requests * batch_size
+    logging.info(
+        "%d decisions in %d requests over %d connections (pipeline depth %d)",
+        num_decisions,
+        num_http_requests,
+        num_connections,
+        pipeline_depth,
+    )
+    logging.info(
+        "%.0f requests/s, %.0f decisions/s, %.1f%% allowed",
+        num_http_requests / elapsed,
+        num_decisions / elapsed,
+        100 * num_allowed / num_decisions,
+    )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,245 @@
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
+
+from sliding_window_counter_rate_limiter import (
+    SlidingWindowCounterRateLimiter,
+    UserCounter,
+)
+
+
+def _shared_field(index, cast=float):
+    def get(self):
+        return cast(self.fields[self.offset + index])
+
+    def set(self, value):
+        self.fields[self.offset + index] = value
+
+    return property(get, set)
+
+
+class SharedUserCounter(UserCounter):
+    """
+    UserCounter whose counters live in a slot of shared memory,
+    so the sliding window counter logic is shared with the in-process limiter
+    """
+
+    __slots__ = ("fields", "offset")
+
+    num_requests = _shared_field(0, int)
+    window_time_in_sec = _shared_field(1)
+    current_window = _shared_field(2, int)
+    current_count = _shared_field(3, int)
+    previous_count = _shared_field(4, int)
+
+    def __init__(self, lock, fields, offset):
+        self.lock = lock
+        self.fields = fields
+        self.offset = offset
+
+
+class SharedMemoryUserRegistry:
+    """
+    Fixed number of user slots in a shared memory block, found by hash of user_id
+    (open addressing with linear probing)
+        keys: 8 byte hash of the user_id in each slot, or EMPTY / REMOVED
+        fields: FIELDS of the user's UserCounter in each slot, as doubles
+    Slots are guarded by a fixed pool of process shared locks (slot % num_locks),
+    adding and removing users is serialized by another one.
+    Each process remembers slots of users it has seen, and only probes again
+    when the slot has since been given to another user.
+    """
+
+    FIELDS = (
+        "num_requests",
+        "window_time_in_sec",
+        "current_window",
+        "current_count",
+        "previous_count",
+    )
+    EMPTY = 0
+    REMOVED = 1
+
+    def __init__(self, num_slots, num_locks, name=None):
+        if num_slots < 1:
+            raise ValueError("num_slots must be at least 1")
+        if num_locks < 1:
+            raise ValueError("num_locks must be at least 1")
+        self.num_slots = num_slots
+        self.shared_memory = shared_memory.SharedMemory(
+            name=name, create=True, size=num_slots * 8 * (1 + len(self.FIELDS))
+        )
+        self.keys_buffer = self.shared_memory.buf[: num_slots * 8]
+        self.fields_buffer = self.shared_memory.buf[num_slots * 8 :]
+        self.keys = self.keys_buffer.cast("Q")
+        self.fields = self.fields_buffer.cast("d")
+        self.lock = multiprocessing.Lock()
+        self.slot_locks = [multiprocessing.Lock() for _ in range(num_locks)]
+        # user_id: (key, slot, user state) of users looked up by this process
+        self.user_slots = {}
+        # Rate limiter instrumentation, kept for parity with ShardedUserRegistry
+        self.metrics = None
+
+    @classmethod
+    def get_key(cls, user_id):
+        """
+        Hash of user_id which is the same in every process (unlike hash()),
+        users whose hashes collide share a slot
+        """
+        key = int.from_bytes(
+            hashlib.blake2b(user_id.encode(), digest_size=8).digest(), "little"
+        )
+        return key if key > cls.REMOVED else key + 2
+
+    def get_slot_lock(self, slot):
+        return self.slot_locks[slot % len(self.slot_locks)]
+
+    def _probe(self, key):
+        """
+        Slot holding key (None if absent) and first slot free to hold it
+        """
+        free_slot = None
+        for i in range(self.num_slots):
+            slot = (key + i) % self.num_slots
+            slot_key = self.keys[slot]
+            if slot_key == key:
+                return slot, free_slot
+            if slot_key == self.EMPTY:
+                return None, slot if free_slot is None else free_slot
+            if slot_key == self.REMOVED and free_slot is None:
+                free_slot = slot
+        return None, free_slot
+
+    def _add(self, user_id, key, user_state):
+        """
+        Write user state into a free slot, caller must hold the structural lock
+        """
+        slot, free_slot = self._probe(key)
+        if slot is not None:
+            raise Exception("User already present")
+        if free_slot is None:
+            raise Exception("No free slot for user: " + user_id)
+        offset = free_slot * len(self.FIELDS)
+        with self.get_slot_lock(free_slot):
+            for index, field in enumerate(self.FIELDS):
+                self.fields[offset + index] = getattr(user_state, field)
+            self.keys[free_slot] = key
+
+    def add(self, user_id, user_state):
+        if not isinstance(user_state, UserCounter):
+            raise ValueError("Only a single limit per user is supported")
+        key = self.get_key(user_id)
+        with self.lock:
+            self._add(user_id, key, user_state)
+
+    def add_many(self, items):
+        """
+        Add many (user_id, user state) pairs taking the structural lock once,
+        none of them is added if any is already present
+        """
+        keys = {}
+        for user_id, user_state in items:
+            if not isinstance(user_state, UserCounter):
+                raise ValueError("Only a single limit per user is supported")
+            keys.setdefault(self.get_key(user_id), (user_id, user_state))
+        if len(keys) < len(items):
+            raise Exception("User already present")
+        with self.lock:
+            if any(self._probe(key)[0] is not None for key in keys):
+                raise Exception("User already present")
+            for key, (user_id, user_state) in keys.items():
+                self._add(user_id, key, user_state)
+
+    def remove(self, user_id):
+        key = self.get_key(user_id)
+        with self.lock:
+            slot, _ = self._probe(key)
+            if slot is not None:
+                with self.get_slot_lock(slot):
+                    self.keys[slot] = self.REMOVED
+        self.user_slots.pop(user_id, None)
+
+    def get(self, user_id):
+        user_slot = self.user_slots.get(user_id)
+        if user_slot is not None:
+            key, slot, user_state = user_slot
+            if self.keys[slot] == key:
+                return user_state
+        key = self.get_key(user_id)
+        slot, _ = self._probe(key)
+        if slot is None:
+            self.user_slots.pop(user_id, None)
+            raise Exception("User not present")
+        user_state = SharedUserCounter(
+            self.get_slot_lock(slot), self.fields, slot * len(self.FIELDS)
+        )
+        self.user_slots[user_id] = (key, slot, user_state)
+        return user_state
+
+    def evict_idle_users(self):
+        return 0
+
+    def values(self):
+        return [
+            SharedUserCounter(
+                self.get_slot_lock(slot), self.fields, slot * len(self.FIELDS)
+            )
+            for slot in range(self.num_slots)
+            if self.keys[slot] > self.REMOVED
+        ]
+
+    def __contains__(self, user_id):
+        slot, _ = self._probe(self.get_key(user_id))
+        return slot is not None
+
+    def __len__(self):
+        return sum(1 for slot_key in self.keys if slot_key > self.REMOVED)
+
+    def close(self):
+        self.user_slots.clear()
+        self.keys.release()
+        self.fields.release()
+        self.keys_buffer.release()
+        self.fields_buffer.release()
+        self.shared_memory.close()
+
+    def unlink(self):
+        self.shared_memory.unlink()
+
+
+class SharedMemoryRateLimiter(SlidingWindowCounterRateLimiter):
+    """
+    Sliding window Counter rate limiter keeping user state in shared memory
+    Worker processes forked after it is created (e.g. by a pre-fork server)
+    share its users, so limits hold for the host rather than per process,
+    without a round trip to redis. State of each user is a fixed size slot,
+    so memory is allocated upfront for num_slots users.
+    Default MonotonicClock is system wide, so timestamps agree across processes.
+    Creating process should close and unlink it on shutdown.
+    """
+
+    DEFAULT_NUM_SLOTS = 65536
+    DEFAULT_NUM_LOCKS = 256
+
+    def __init__(
+        self,
+        num_slots=DEFAULT_NUM_SLOTS,
+        num_locks=DEFAULT_NUM_LOCKS,
+        clock=None,
+        name=None,
+    ):
+        """
+        num_slots: max users, keep well above expected users as slots are probed linearly
+        num_locks: process shared locks striped over the slots
+        clock: source of timestamps (Clock), defaults to MonotonicClock
+        name: name of the shared memory block, random if not given
+        """
+        self._init_user_map(
+            clock, lambda clock: SharedMemoryUserRegistry(num_slots, num_locks, name)
+        )
+
+    def close(self):
+        self.user_map.close()
+
+    def unlink(self):
+        self.user_map.unlink()
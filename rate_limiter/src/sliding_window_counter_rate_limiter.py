@@ -0,0 +1,118 @@
+import threading
+
+from in_memory_rate_limiter import InMemoryRateLimiter
+
+
+class UserCounter:
+    """
+    Request counters of the current and previous fixed windows of each user
+    """
+
+    __slots__ = (
+        "lock",
+        "num_requests",
+        "window_time_in_sec",
+        "current_window",
+        "current_count",
+        "previous_count",
+    )
+
+    def __init__(self, num_requests, window_time_in_sec):
+        self.lock = threading.Lock()
+        self.num_requests = num_requests
+        self.window_time_in_sec = window_time_in_sec
+        # Index of current fixed window, counting windows from timestamp 0
+        self.current_window = 0
+        self.current_count = 0
+        self.previous_count = 0
+
+    def roll_window(self, current_timestamp):
+        """
+        Move counters forward if current timestamp falls in a new fixed window
+        """
+        window = int(current_timestamp // self.window_time_in_sec)
+        if window == self.current_window:
+            return
+        # Current window becomes previous one only if they are adjacent,
+        # otherwise there were no requests in the previous window
+        if window == self.current_window + 1:
+            self.previous_count = self.current_count
+        else:
+            self.previous_count = 0
+        self.current_count = 0
+        self.current_window = window
+
+    def estimate_count(self, current_timestamp):
+        """
+        Approximate number of requests in the sliding window ending at current timestamp,
+        previous window's count is weighted by its overlap with the sliding window
+        """
+        elapsed = current_timestamp - self.current_window * self.window_time_in_sec
+        weight = (self.window_time_in_sec - elapsed) / self.window_time_in_sec
+        return self.previous_count * weight + self.current_count
+
+    def can_acquire(self, current_timestamp):
+        self.roll_window(current_timestamp)
+        # Check if weighted count including current request is within the rate defined
+        return self.estimate_count(current_timestamp) + 1 <= self.num_requests
+
+    def acquire(self, current_timestamp):
+        self.current_count += 1
+
+    def get_quota(self, current_timestamp):
+        """
+        (limit, remaining, reset_at, retry_after) as of current timestamp
+        Full quota is back once the windows holding counted requests have slid by.
+        """
+        self.roll_window(current_timestamp)
+        window_start = self.current_window * self.window_time_in_sec
+        estimate = self.estimate_count(current_timestamp)
+        if self.current_count:
+            reset_at = window_start + 2 * self.window_time_in_sec
+        elif self.previous_count:
+            reset_at = window_start + self.window_time_in_sec
+        else:
+            reset_at = current_timestamp
+        if estimate + 1 <= self.num_requests:
+            retry_after = 0
+        elif self.num_requests < 1:
+            retry_after = self.window_time_in_sec
+        elif self.current_count + 1 <= self.num_requests:
+            # wait for previous window's weight to drop enough in this window
+            room = self.num_requests - 1 - self.current_count
+            elapsed = self.window_time_in_sec * (1 - room / self.previous_count)
+            retry_after = window_start + elapsed - current_timestamp
+        else:
+            # current window's count has to become the previous one and drop enough
+            elapsed = self.window_time_in_sec * (
+                1 - (self.num_requests - 1) / self.current_count
+            )
+            retry_after = (
+                window_start + self.window_time_in_sec + elapsed - current_timestamp
+            )
+        return (
+            self.num_requests,
+            max(0, int(self.num_requests - estimate)),
+            reset_at,
+            max(0, retry_after),
+        )
+
+    def try_acquire(self, current_timestamp):
+        if not self.can_acquire(current_timestamp):
+            return False
+        self.acquire(current_timestamp)
+        return True
+
+
+class SlidingWindowCounterRateLimiter(InMemoryRateLimiter):
+    """
+    Implementation of Sliding window Counter rate limiter
+    Keeps only two counters per user instead of a log of timestamps,
+    so memory per user is constant irrespective of the rate limit.
+    Only allowed requests are counted.
+    Ref: https://blog.cloudflare.com/counting-things-a-lot-of-different-things/
+    """
+
+    @classmethod
+    def create_user_state(cls, num_requests, window_time_in_sec, current_timestamp):
+        return UserCounter(num_requests, window_time_in_sec)
@@ -1,67 +1,152 @@
 import threading
-import time
-from collections import deque
+from array import array
 
-from rate_limiter import RateLimiter
+from in_memory_rate_limiter import InMemoryRateLimiter
 
 
 class UserLog:
     """
     Log of each user's request timestamps
+    Only allowed requests are logged, so log never holds more than num_requests
+    timestamps. It is a ring buffer over a flat array of doubles, allocated on
+    the first request and grown (by doubling) upto num_requests only as the
+    user's traffic needs it.
     """
 
+    __slots__ = (
+        "lock",
+        "num_requests",
+        "window_time_in_sec",
+        "log",
+        "head",
+        "size",
+    )
+
+    INITIAL_CAPACITY = 8
+
     def __init__(self, num_requests, window_time_in_sec):
         self.lock = threading.Lock()
         self.num_requests = num_requests
         self.window_time_in_sec = window_time_in_sec
-        self.log = deque()
+        self.log = array("d")
+        # Position of the oldest timestamp in log and number of timestamps held
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def timestamps(self):
+        """
+        Timestamps in log, oldest first
+        """
+        timestamps = array("d")
+        self.copy_timestamps(timestamps)
+        return timestamps.tolist()
+
+    def copy_timestamps(self, timestamps):
+        """
+        Append timestamps in log, oldest first, to an array("d")
+        """
+        end = self.head + self.size
+        if end <= len(self.log):
+            timestamps.extend(self.log[self.head : end])
+        else:
+            timestamps.extend(self.log[self.head :])
+            timestamps.extend(self.log[: end - len(self.log)])
 
     def evict_older_timestamps(self, current_timestamp):
         """
         Removing timestamps that are older than current window
+        Timestamps are in increasing order, so first one within the window
+        is found by binary search over the ring buffer
+        """
+        oldest_allowed = current_timestamp - self.window_time_in_sec
+        capacity = len(self.log)
+        low, high = 0, self.size
+        while low < high:
+            mid = (low + high) // 2
+            if self.log[(self.head + mid) % capacity] < oldest_allowed:
+                low = mid + 1
+            else:
+                high = mid
+        if low:
+            self.head = (self.head + low) % capacity
+            self.size -= low
+
+    def resize(self, capacity):
+        """
+        Move timestamps into a new buffer of given capacity, oldest first
         """
-        while self.log and current_timestamp - self.log[0] > self.window_time_in_sec:
-            self.log.popleft()
+        timestamps = self.timestamps()
+        self.log = array("d", bytes(8 * capacity))
+        self.log[: self.size] = array("d", timestamps)
+        self.head = 0
+
+    def shrink(self):
+        """
+        Release buffer space no longer needed after timestamps were evicted
+        """
+        capacity = max(self.INITIAL_CAPACITY, 2 * self.size)
+        if capacity < len(self.log):
+            self.resize(capacity)
+
+    def can_acquire(self, current_timestamp):
+        # Remove older timestamps beyond current window
+        self.evict_older_timestamps(current_timestamp)
+        # Check if number of requests in current window is less than the rate defined
+        return self.size < self.num_requests
+
+    def acquire(self, current_timestamp):
+        if self.size == len(self.log):
+            self.resize(
+                min(self.num_requests, max(self.INITIAL_CAPACITY, 2 * len(self.log)))
+            )
+        # Append current request's timestamp to user log
+        self.log[(self.head + self.size) % len(self.log)] = current_timestamp
+        self.size += 1
+
+    def get_quota(self, current_timestamp):
+        """
+        (limit, remaining, reset_at, retry_after) as of current timestamp
+        """
+        self.evict_older_timestamps(current_timestamp)
+        capacity = len(self.log)
+        reset_at = current_timestamp
+        if self.size:
+            newest = self.log[(self.head + self.size - 1) % capacity]
+            reset_at = newest + self.window_time_in_sec
+        retry_after = 0
+        if self.num_requests < 1:
+            retry_after = self.window_time_in_sec
+        elif self.size >= self.num_requests:
+            # a slot frees up once the oldest timestamp leaves the window
+            oldest = self.log[(self.head + self.size - self.num_requests) % capacity]
+            retry_after = oldest + self.window_time_in_sec - current_timestamp
+        return (
+            self.num_requests,
+            max(0, self.num_requests - self.size),
+            reset_at,
+            max(0, retry_after),
+        )
+
+    def try_acquire(self, current_timestamp):
+        if not self.can_acquire(current_timestamp):
+            return False
+        self.acquire(current_timestamp)
+        return True
 
 
-class SlidingWindowLogsRateLimiter(RateLimiter):
+class SlidingWindowLogsRateLimiter(InMemoryRateLimiter):
     """
     Implemenatation of Sliding window Log rate limiter
     Ref: https://medium.com/@saisandeepmopuri/system-design-rate-limiter-and-data-modelling-9304b0d18250
     """
 
-    def __init__(self):
-        self.lock = threading.Lock()
-        self.user_log_map = {}
-
     @classmethod
-    def get_current_timestamp_sec(cls):
-        return int(round(time.time()))
-
-    def add_user(self, user_id, num_requests, window_time_in_sec):
-        with self.lock:
-            if user_id in self.user_log_map:
-                raise Exception("User already present")
-            self.user_log_map[user_id] = UserLog(num_requests, window_time_in_sec)
-
-    def remove_user(self, user_id):
-        with self.lock:
-            if user_id in self.user_log_map:
-                del self.user_log_map[user_id]
-
-    def is_allowed(self, user_id):
-        with self.lock:
-            if user_id not in self.user_log_map:
-                raise Exception("User not present")
-            user_log = self.user_log_map[user_id]
-
-        with user_log.lock:
-            current_timestamp = SlidingWindowLogsRateLimiter.get_current_timestamp_sec()
-            # Remove older timestamps beyond current window
-            user_log.evict_older_timestamps(current_timestamp)
-            # Append current request's timestamp to user log
-            user_log.log.append(current_timestamp)
-            # Check if number of requests in current window is less than the rate defined
-            if len(user_log.log) > user_log.num_requests:
-                return False
-            return True
+    def create_user_state(cls, num_requests, window_time_in_sec, current_timestamp):
+        return UserLog(num_requests, window_time_in_sec)
+
+    def trim_user_state(self, user_state, current_timestamp):
+        user_state.evict_older_timestamps(current_timestamp)
+        user_state.shrink()
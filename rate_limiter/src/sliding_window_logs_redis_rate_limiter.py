@@ -1,10 +1,311 @@
-import time
+import hashlib
+import itertools
+import uuid
 
 import redis
-from rate_limiter import RateLimiter
+from clock import WallClock
+from metrics import NOT_TIMED
+from near_cache import NearCache
+from rate_limiter import RateLimitDecision, RateLimiter
+from redis_connection import get_connection
 
 
-class SlidingWindowLogsRedisRateLimiter(RateLimiter):
+class SlidingWindowLogsRedisScript:
+    """
+    Redis key layout and Lua script shared by the blocking and asyncio
+    Redis sliding window log rate limiters
+    """
+
+    METADATA_SUFFIX = "_metadata"
+    TIMESTAMPS_SUFFIX = "_timestamps"
+
+    # Evict, count and add for a batch of requests in a single atomic step
+    # Users with multiple limit tiers have comma separated requests and window_time,
+    # timestamps are kept for the longest window and counted per tier
+    # Every tier is counted before the request is logged, and it is only logged
+    # if all of them allow it, so denied requests don't use up quota of other tiers
+    # (same as the in-memory sliding window log rate limiter)
+    # KEYS: metadata and timestamps keys of each distinct user, interleaved
+    # ARGV: current timestamp, 1 to detail allowed decisions (else 0),
+    # followed by (user's index in KEYS, member) of each request
+    # Returns for each request 0 if it is allowed (and not detailed), else
+    # (index of the first tier denying it or -1, limit, remaining, reset at, denied till)
+    # with limit, remaining and reset at being of the tier with least quota remaining,
+    # and timestamps as strings as integer replies would truncate them
+    # Returns -index of the first un-registered user
+    IS_ALLOWED_SCRIPT = """
+local now = tonumber(ARGV[1])
+local detailed = ARGV[2] == '1'
+-- Lua's default number to string conversion keeps only 14 digits,
+-- which would move window boundaries of sub-second timestamps
+local function to_score(timestamp)
+    return string.format('%.17g', timestamp)
+end
+local limits = {}
+local max_windows = {}
+for i = 1, #KEYS / 2 do
+    local rate = redis.call('HMGET', KEYS[2 * i - 1], 'requests', 'window_time')
+    if not rate[1] then
+        return -i
+    end
+    local tiers = {}
+    for max_requests in string.gmatch(rate[1], '[^,]+') do
+        tiers[#tiers + 1] = {tonumber(max_requests)}
+    end
+    local t = 1
+    max_windows[i] = 0
+    for window_time in string.gmatch(rate[2], '[^,]+') do
+        tiers[t][2] = tonumber(window_time)
+        max_windows[i] = math.max(max_windows[i], tiers[t][2])
+        t = t + 1
+    end
+    limits[i] = tiers
+    redis.call('ZREMRANGEBYSCORE', KEYS[2 * i], 0, to_score(now - max_windows[i]))
+end
+local decisions = {}
+for j = 3, #ARGV, 2 do
+    local i = tonumber(ARGV[j])
+    local key = KEYS[2 * i]
+    local total = redis.call('ZCARD', key)
+    local counts = {}
+    local tripped_tier = nil
+    local denied_until = 0
+    for t, tier in ipairs(limits[i]) do
+        local count = total
+        if tier[2] < max_windows[i] then
+            count = redis.call('ZCOUNT', key, '(' .. to_score(now - tier[2]), '+inf')
+        end
+        counts[t] = count
+        if count >= tier[1] then
+            if tier[1] < 1 then
+                denied_until = math.max(denied_until, now + tier[2])
+            else
+                -- throttled till the oldest timestamp holding up a slot of the tier
+                -- leaves its window
+                local oldest = redis.call(
+                    'ZRANGE', key, total - tier[1], total - tier[1], 'WITHSCORES'
+                )
+                denied_until = math.max(denied_until, tonumber(oldest[2]) + tier[2])
+            end
+            tripped_tier = tripped_tier or t - 1
+        end
+    end
+    local newest = now
+    if tripped_tier then
+        local newest_entry = redis.call('ZRANGE', key, -1, -1, 'WITHSCORES')
+        if newest_entry[2] then
+            newest = tonumber(newest_entry[2])
+        end
+    else
+        redis.call('ZADD', key, now, ARGV[j + 1])
+    end
+    if tripped_tier or detailed then
+        local limit, remaining, reset_at
+        for t, tier in ipairs(limits[i]) do
+            local count = counts[t]
+            if not tripped_tier then
+                count = count + 1
+            end
+            if not remaining or tier[1] - count < remaining then
+                -- full quota is back a window after the newest timestamp
+                limit = tier[1]
+                remaining = tier[1] - count
+                reset_at = now
+                if count > 0 then
+                    reset_at = newest + tier[2]
+                end
+            end
+        end
+        decisions[#decisions + 1] = {
+            tripped_tier or -1,
+            limit,
+            math.max(remaining, 0),
+            to_score(reset_at),
+            to_score(denied_until),
+        }
+    else
+        decisions[#decisions + 1] = 0
+    end
+end
+for i = 1, #KEYS / 2 do
+    redis.call('EXPIRE', KEYS[2 * i], math.ceil(max_windows[i]) + 1)
+end
+return decisions
+"""
+    IS_ALLOWED_SCRIPT_SHA = hashlib.sha1(IS_ALLOWED_SCRIPT.encode()).hexdigest()
+
+    def __init__(self, near_cache_size=0, near_cache_ttl_sec=1, clock=None):
+        # Timestamps are shared by all processes through redis,
+        # so clock defaults to wall clock rather than a per process monotonic one
+        self.clock = WallClock() if clock is None else clock
+        # Sorted set members must be unique per request, otherwise requests
+        # in the same second would collapse into a single entry
+        self.member_prefix = uuid.uuid4().hex
+        self.member_counter = itertools.count()
+        # Near cache of throttled users (denied till timestamp) and user metadata,
+        # so throttled users are rejected without a round trip to redis
+        self.denied_users = None
+        self.user_rates = None
+        if near_cache_size > 0:
+            self.denied_users = NearCache(near_cache_size, near_cache_ttl_sec)
+            self.user_rates = NearCache(near_cache_size, near_cache_ttl_sec)
+
+    def get_current_timestamp_sec(self):
+        return self.clock.now()
+
+    @classmethod
+    def get_limits_mapping(cls, limits):
+        """
+        Metadata of a user with a (num_requests, window_time_in_sec) limit per tier
+        """
+        if not limits:
+            raise ValueError("At least one limit is required")
+        return {
+            "requests": ",".join(str(num_requests) for num_requests, _ in limits),
+            "window_time": ",".join(str(window_time) for _, window_time in limits),
+        }
+
+    @classmethod
+    def _parse_user_rate(cls, user_id, val):
+        requests, window_time = val
+        if requests is None:
+            raise Exception("Un-registered user: " + user_id)
+        if "," in requests:
+            raise Exception("Multiple limit tiers of user need script: " + user_id)
+        return int(requests), float(window_time)
+
+    def time_round_trip(self):
+        """
+        Times a call to redis while metrics are enabled
+        """
+        if self.metrics is None:
+            return NOT_TIMED
+        return self.metrics.timer("redis_round_trip_seconds")
+
+    def get_timestamp_member(self, timestamp):
+        return "%s:%s:%d" % (timestamp, self.member_prefix, next(self.member_counter))
+
+    def invalidate_near_cache(self, user_id):
+        if self.denied_users is not None:
+            self.denied_users.remove(user_id)
+            self.user_rates.remove(user_id)
+
+    def get_cached_user_rate(self, user_id, current_timestamp):
+        if self.user_rates is None:
+            return None
+        return self.user_rates.get(user_id, current_timestamp)
+
+    def cache_user_rate(self, user_id, user_rate, current_timestamp):
+        if self.user_rates is not None:
+            self.user_rates.put(user_id, user_rate, current_timestamp)
+
+    def get_locally_denied_decision(self, user_id, current_timestamp):
+        """
+        Tier which throttled the user and RateLimitDecision of its requests
+        as per near cache, (None, None) if user isn't throttled
+        """
+        if self.denied_users is None:
+            return None, None
+        denial = self.denied_users.get(user_id, current_timestamp)
+        if denial is None:
+            return None, None
+        tripped_tier, limit, reset_at, denied_until = denial
+        return tripped_tier, RateLimitDecision(
+            False,
+            limit,
+            0,
+            reset_at,
+            max(0, denied_until - current_timestamp),
+            current_timestamp,
+        )
+
+    def is_denied_locally(self, user_id, current_timestamp):
+        return (
+            self.denied_users is not None
+            and self.denied_users.get(user_id, current_timestamp) is not None
+        )
+
+    def cache_denial(self, user_id, decision, tripped_tier=0):
+        """
+        Remember user is throttled till a request could be allowed again
+        """
+        if self.denied_users is not None:
+            self.denied_users.put(
+                user_id,
+                (
+                    tripped_tier,
+                    decision.limit,
+                    decision.reset_at,
+                    decision.timestamp + decision.retry_after,
+                ),
+                decision.timestamp,
+                decision.timestamp + decision.retry_after,
+            )
+
+    def get_script_keys_and_args(self, user_ids, current_timestamp, detailed=False):
+        """
+        KEYS and ARGV of IS_ALLOWED_SCRIPT for given requests,
+        along with the position of each distinct user in KEYS
+        """
+        user_indices = {}
+        keys = []
+        args = [current_timestamp, int(detailed)]
+        for user_id in user_ids:
+            if user_id not in user_indices:
+                keys.append(user_id + self.METADATA_SUFFIX)
+                keys.append(user_id + self.TIMESTAMPS_SUFFIX)
+                user_indices[user_id] = len(user_indices) + 1
+            args.append(user_indices[user_id])
+            args.append(self.get_timestamp_member(current_timestamp))
+        return keys, args, user_indices
+
+    def parse_script_result(self, result, user_ids, user_indices, current_timestamp):
+        """
+        (tier which denied the request or None, RateLimitDecision) of each request,
+        decision is None for allowed requests which weren't detailed
+        """
+        if not isinstance(result, list):
+            raise Exception("Un-registered user: " + list(user_indices)[-result - 1])
+        decisions = []
+        for user_id, decision in zip(user_ids, result):
+            if decision == 0:
+                decisions.append((None, None))
+                continue
+            tripped_tier, limit, remaining, reset_at, denied_until = decision
+            tripped_tier = int(tripped_tier)
+            allowed = tripped_tier < 0
+            decision = RateLimitDecision(
+                allowed,
+                int(limit),
+                int(remaining),
+                float(reset_at),
+                0 if allowed else max(0, float(denied_until) - current_timestamp),
+                current_timestamp,
+            )
+            if allowed:
+                decisions.append((None, decision))
+            else:
+                self.cache_denial(user_id, decision, tripped_tier)
+                decisions.append((tripped_tier, decision))
+        return decisions
+
+    def reject_locally_denied(self, user_ids, current_timestamp):
+        """
+        Requests of users throttled as per near cache are rejected locally,
+        returns decisions so far and positions of requests still to be decided
+        """
+        decisions = [False] * len(user_ids)
+        if self.denied_users is None:
+            return decisions, list(range(len(user_ids)))
+        indices = [
+            index
+            for index, user_id in enumerate(user_ids)
+            if not self.is_denied_locally(user_id, current_timestamp)
+        ]
+        return decisions, indices
+
+
+class SlidingWindowLogsRedisRateLimiter(SlidingWindowLogsRedisScript, RateLimiter):
     """
     Implemenatation of Sliding window Log rate limiter
         Representation of data stored in redis
@@ -14,88 +315,350 @@ class SlidingWindowLogsRedisRateLimiter(RateLimiter):
                 "requests": 2,
             "window_time": 30
         }
+        (comma separated "requests": "10,1000", "window_time": "1,3600"
+        for a user with multiple limit tiers, script mode only)
 
         timestamps
         ----------
         "userid_timestamps": sorted_set([
-            "ts1": "ts1",
-            "ts2": "ts2"
+            "ts1:<instance id>:<request no>": "ts1",
+            "ts2:<instance id>:<request no>": "ts2"
         ])
     Ref: https://medium.com/@saisandeepmopuri/system-design-rate-limiter-and-data-modelling-9304b0d18250
     """
 
-    METADATA_SUFFIX = "_metadata"
-    TIMESTAMPS_SUFFIX = "_timestamps"
-
-    def __init__(self):
-        self.conn = get_connection()
-
-    @classmethod
-    def get_current_timestamp_sec(cls):
-        return int(round(time.time()))
+    def __init__(
+        self,
+        conn=None,
+        use_script=False,
+        near_cache_size=0,
+        near_cache_ttl_sec=1,
+        clock=None,
+    ):
+        """
+        conn: redis client, defaults to one backed by the shared connection pool
+        use_script: decide each request (or batch) with one server side Lua script call,
+        instead of the multiple round trips and optimistic locking of a transaction
+        near_cache_size: max users remembered in the local near cache, 0 disables it
+        near_cache_ttl_sec: max time a near cache entry is trusted without asking redis
+        clock: source of timestamps (Clock), defaults to WallClock
+        """
+        super().__init__(near_cache_size, near_cache_ttl_sec, clock)
+        self.conn = get_connection() if conn is None else conn
+        self.use_script = use_script
 
     def add_user(self, user_id, num_requests, window_time_in_sec):
         self.conn.hset(
             user_id + self.METADATA_SUFFIX,
-            {"requests": num_requests, "window_time": window_time_in_sec},
+            mapping={"requests": num_requests, "window_time": window_time_in_sec},
         )
+        self.invalidate_near_cache(user_id)
+
+    def add_users_bulk(self, users):
+        """
+        # Users are written in a single pipeline, i.e. one round trip
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        user_ids = []
+        for user_id, num_requests, window_time_in_sec in users:
+            pipe.hset(
+                user_id + self.METADATA_SUFFIX,
+                mapping={"requests": num_requests, "window_time": window_time_in_sec},
+            )
+            user_ids.append(user_id)
+        with self.time_round_trip():
+            pipe.execute()
+        for user_id in user_ids:
+            self.invalidate_near_cache(user_id)
+
+    def add_user_limits(self, user_id, limits):
+        """
+        # Multiple limit tiers are only enforced by the Lua script,
+        # a single tier is stored the same way as with add_user
+        """
+        if len(limits) > 1 and not self.use_script:
+            raise ValueError("Multiple limit tiers need use_script")
+        self.conn.hset(
+            user_id + self.METADATA_SUFFIX, mapping=self.get_limits_mapping(limits)
+        )
+        self.invalidate_near_cache(user_id)
 
     def remove_user(self, user_id):
         self.conn.delete(
             user_id + self.METADATA_SUFFIX, user_id + self.TIMESTAMPS_SUFFIX
         )
+        self.invalidate_near_cache(user_id)
 
     # get the user metadata (number of requests, window time)
     def get_user_rate(self, user_id):
-        val = self.con.hgetall(user_id + self.METADATA_SUFFIX)
-        if val is None:
-            raise Exception("Un-registered user: " + user_id)
-        return int(val["requests"]), int(val["window_time"])
+        current_timestamp = self.get_current_timestamp_sec()
+        user_rate = self.get_cached_user_rate(user_id, current_timestamp)
+        if user_rate is None:
+            with self.time_round_trip():
+                val = self.conn.hmget(
+                    user_id + self.METADATA_SUFFIX, "requests", "window_time"
+                )
+            user_rate = self._parse_user_rate(user_id, val)
+            self.cache_user_rate(user_id, user_rate, current_timestamp)
+        return user_rate
 
-    def add_timestamp_atomically_and_return_size(self, user_id, timestamp):
+    def get_denied_until(self, user_id, request_count, max_requests, unit_time):
         """
-        # Atomically add an element to the timestamps and return the total number of requests
-        # in the current window time.
-        # Transaction holds an optimistic lock over the redis entries userId + self.METADATA_SUFFIX
-        # and userId + self.TIMESTAMPS. The changes in _addNewTimestampAndReturnTotalCount
-        # are committed only if none of these entries get changed through out
+        # user is throttled till enough of the oldest timestamps leave the window,
+        # request_count includes the throttled request, which wasn't logged
         """
-        _, size = self.conn.transaction(
-            lambda pipe: self._add_new_timestamp_and_return_total_count(
-                user_id, timestamp, pipe
-            ),
-            user_id + self.METADATA_SUFFIX,
-            user_id + self.TIMESTAMPS_SUFFIX,
-        )
-        return size
+        index = request_count - 1 - max_requests
+        with self.time_round_trip():
+            oldest = self.conn.zrange(
+                user_id + self.TIMESTAMPS_SUFFIX, index, index, withscores=True
+            )
+        return oldest[0][1] + unit_time if oldest else None
 
-    def _add_new_timestamp_and_return_total_count(
-        self, user_id, timestamp, redis_pipeline
-    ):
+    def count_and_add_timestamps(self, user_ids, user_rates, current_timestamp):
         """
-        # A two element array with first one representing success of adding an element into
-        # sorted set and other as the count of the sorted set is returned by this method
+        # Count each request against its user's window and add its timestamp only
+        # if it is allowed, so throttled requests don't use up quota (same as the
+        # script and the in-memory rate limiter). Returns the number of requests
+        # in the window including each one; a user's requests in the batch see the
+        # ones before them, same as sequential is_allowed calls.
+        # Transaction holds an optimistic lock over the users' metadata and timestamps
+        # keys: counts are read once they are WATCHed, and the evictions and adds
+        # are committed in a MULTI/EXEC only if none of the keys changed in between
+        # (retried otherwise)
         """
-        redis_pipeline.multi()
-        redis_pipeline.zadd(user_id + self.TIMESTAMPS_SUFFIX, timestamp, timestamp)
-        redis_pipeline.zcount(user_id + self.TIMESTAMPS_SUFFIX, 0, self.INF)
+        unique_user_ids = list(dict.fromkeys(user_ids))
+
+        def _count_and_add(transaction_pipe):
+            # WATCHed connection runs commands one round trip at a time,
+            # so counts are read in a single pipeline of another connection
+            pipe = self.conn.pipeline(transaction=False)
+            for user_id in unique_user_ids:
+                _, unit_time = user_rates[user_id]
+                pipe.zcount(
+                    user_id + self.TIMESTAMPS_SUFFIX,
+                    "(%r" % (current_timestamp - unit_time),
+                    "+inf",
+                )
+            counts = dict(zip(unique_user_ids, pipe.execute()))
+            transaction_pipe.multi()
+            for user_id in unique_user_ids:
+                _, unit_time = user_rates[user_id]
+                transaction_pipe.zremrangebyscore(
+                    user_id + self.TIMESTAMPS_SUFFIX, 0, current_timestamp - unit_time
+                )
+            request_counts = []
+            for user_id in user_ids:
+                max_requests, _ = user_rates[user_id]
+                request_counts.append(counts[user_id] + 1)
+                if counts[user_id] < max_requests:
+                    counts[user_id] += 1
+                    transaction_pipe.zadd(
+                        user_id + self.TIMESTAMPS_SUFFIX,
+                        {
+                            self.get_timestamp_member(
+                                current_timestamp
+                            ): current_timestamp
+                        },
+                    )
+            return request_counts
+
+        watched_keys = []
+        for user_id in unique_user_ids:
+            watched_keys.append(user_id + self.METADATA_SUFFIX)
+            watched_keys.append(user_id + self.TIMESTAMPS_SUFFIX)
+        with self.time_round_trip():
+            return self.conn.transaction(
+                _count_and_add, *watched_keys, value_from_callable=True
+            )
 
     def is_allowed(self, user_id):
         """
         # decide to allow a service call or not
         # we use sorted sets datastructure in redis for storing our timestamps.
         """
+        allowed = self._is_allowed(user_id)
+        if self.metrics is not None:
+            self.metrics.record_decision(allowed)
+        return allowed
+
+    def _is_allowed(self, user_id):
+        current_timestamp = self.get_current_timestamp_sec()
+        if self.is_denied_locally(user_id, current_timestamp):
+            return False
+        if self.use_script:
+            decisions = self.run_is_allowed_script([user_id], current_timestamp)
+            tripped_tier, _ = decisions[0]
+            return tripped_tier is None
+        return self._decide_with_transaction(user_id, current_timestamp).allowed
+
+    def _decide_with_transaction(self, user_id, current_timestamp, detailed=False):
         max_requests, unit_time = self.get_user_rate(user_id)
+        (current_request_count,) = self.count_and_add_timestamps(
+            [user_id], {user_id: (max_requests, unit_time)}, current_timestamp
+        )
+        return self.get_decision(
+            user_id,
+            current_request_count,
+            max_requests,
+            unit_time,
+            current_timestamp,
+            detailed,
+        )
+
+    def get_decision(
+        self,
+        user_id,
+        request_count,
+        max_requests,
+        unit_time,
+        current_timestamp,
+        detailed=False,
+    ):
+        """
+        # decision of a request given the count of requests in the window including it
+        # timestamp till which a throttled user stays throttled costs another round trip,
+        # so it is only looked up when detailed or for the near cache
+        """
+        allowed = request_count <= max_requests
+        retry_after = 0
+        if not allowed and max_requests < 1:
+            retry_after = unit_time
+        elif not allowed and (detailed or self.denied_users is not None):
+            denied_until = self.get_denied_until(
+                user_id, request_count, max_requests, unit_time
+            )
+            if denied_until is not None:
+                retry_after = max(0, denied_until - current_timestamp)
+        decision = RateLimitDecision(
+            allowed,
+            max_requests,
+            max(0, max_requests - request_count),
+            # newest timestamp is the current one, full quota is back a window later
+            current_timestamp + unit_time,
+            retry_after,
+            current_timestamp,
+        )
+        if not allowed:
+            self.cache_denial(user_id, decision)
+        return decision
+
+    def is_allowed_tiered(self, user_id):
         current_timestamp = self.get_current_timestamp_sec()
-        # evict older entries
-        oldest_possible_entry = current_timestamp - unit_time
-        # removes all the keys from start to oldest bucket
-        self.con.zremrangebyscore(
-            user_id + self.TIMESTAMPS_SUFFIX, 0, oldest_possible_entry
+        tripped_tier, _ = self.get_locally_denied_decision(user_id, current_timestamp)
+        if tripped_tier is None:
+            if self.use_script:
+                decisions = self.run_is_allowed_script([user_id], current_timestamp)
+                tripped_tier, _ = decisions[0]
+            elif not self._is_allowed(user_id):
+                # users without the script have a single tier
+                tripped_tier = 0
+        if self.metrics is not None:
+            self.metrics.record_decision(tripped_tier is None)
+        return tripped_tier is None, tripped_tier
+
+    def check(self, user_id):
+        current_timestamp = self.get_current_timestamp_sec()
+        _, decision = self.get_locally_denied_decision(user_id, current_timestamp)
+        if decision is None:
+            if self.use_script:
+                decisions = self.run_is_allowed_script(
+                    [user_id], current_timestamp, detailed=True
+                )
+                _, decision = decisions[0]
+            else:
+                decision = self._decide_with_transaction(
+                    user_id, current_timestamp, detailed=True
+                )
+        if self.metrics is not None:
+            self.metrics.record_decision(decision.allowed)
+        return decision
+
+    def is_allowed_many(self, user_ids):
+        """
+        # decide a batch of service calls with a fixed number of round trips irrespective
+        # of batch size, first pipeline fetches metadata of the distinct users in the batch,
+        # then their timestamps are WATCHed, counted in a pipeline, and evicted and
+        # added (for allowed requests) in a MULTI/EXEC, see count_and_add_timestamps
+        # In script mode whole batch is decided in a single round trip
+        # With near cache, throttled users are rejected locally and
+        # metadata already cached isn't fetched again
+        """
+        current_timestamp = self.get_current_timestamp_sec()
+        decisions, indices = self.reject_locally_denied(user_ids, current_timestamp)
+        if indices:
+            remote_decisions = self._decide_many(
+                [user_ids[index] for index in indices], current_timestamp
+            )
+            for index, decision in zip(indices, remote_decisions):
+                decisions[index] = decision
+        if self.metrics is not None:
+            self.metrics.record_decisions(decisions)
+        return decisions
+
+    def _decide_many(self, user_ids, current_timestamp):
+        if self.use_script:
+            return [
+                tripped_tier is None
+                for tripped_tier, _ in self.run_is_allowed_script(
+                    user_ids, current_timestamp
+                )
+            ]
+        unique_user_ids = list(dict.fromkeys(user_ids))
+        user_rates = {}
+        for user_id in unique_user_ids:
+            user_rate = self.get_cached_user_rate(user_id, current_timestamp)
+            if user_rate is not None:
+                user_rates[user_id] = user_rate
+        missing_user_ids = [
+            user_id for user_id in unique_user_ids if user_id not in user_rates
+        ]
+        if missing_user_ids:
+            pipe = self.conn.pipeline(transaction=False)
+            for user_id in missing_user_ids:
+                pipe.hmget(user_id + self.METADATA_SUFFIX, "requests", "window_time")
+            with self.time_round_trip():
+                user_metadata = pipe.execute()
+            for user_id, val in zip(missing_user_ids, user_metadata):
+                user_rates[user_id] = self._parse_user_rate(user_id, val)
+                self.cache_user_rate(user_id, user_rates[user_id], current_timestamp)
+
+        request_counts = self.count_and_add_timestamps(
+            user_ids, user_rates, current_timestamp
         )
-        current_request_count = self.add_timestamp_atomically_and_return_size(
-            user_id, current_timestamp
+        decisions = []
+        denied_request_counts = {}
+        for user_id, request_count in zip(user_ids, request_counts):
+            max_requests, _ = user_rates[user_id]
+            decisions.append(request_count <= max_requests)
+            if request_count > max_requests:
+                denied_request_counts[user_id] = request_count
+
+        if self.denied_users is not None:
+            for user_id, request_count in denied_request_counts.items():
+                max_requests, unit_time = user_rates[user_id]
+                self.get_decision(
+                    user_id, request_count, max_requests, unit_time, current_timestamp
+                )
+        return decisions
+
+    def run_is_allowed_script(self, user_ids, current_timestamp, detailed=False):
+        """
+        # decide requests with a single EVALSHA of the registered script,
+        # falling back to EVAL (which also caches the script) if redis doesn't have it yet
+        # returns (tier which denied it or None, RateLimitDecision) of each request,
+        # see parse_script_result
+        """
+        keys, args, user_indices = self.get_script_keys_and_args(
+            user_ids, current_timestamp, detailed
+        )
+        try:
+            with self.time_round_trip():
+                result = self.conn.evalsha(
+                    self.IS_ALLOWED_SCRIPT_SHA, len(keys), *keys, *args
+                )
+        except redis.exceptions.NoScriptError:
+            with self.time_round_trip():
+                result = self.conn.eval(self.IS_ALLOWED_SCRIPT, len(keys), *keys, *args)
+        return self.parse_script_result(
+            result, user_ids, user_indices, current_timestamp
         )
-        if current_request_count > max_requests:
-            return False
-        return True
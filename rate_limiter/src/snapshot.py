@@ -0,0 +1,266 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from functools import partial
+from itertools import accumulate, compress
+from operator import attrgetter
+
+from gc_pause import paused_gc
+from in_memory_rate_limiter import UserLimitTiers
+from sliding_window_logs_rate_limiter import SlidingWindowLogsRateLimiter, UserLog
+from user_registry import LazyUserState
+
+# File starts with magic, number of users, tiers and timestamps, size of
+# user ids, and wall clock / rate limiter clock time the snapshot was taken at
+MAGIC = b"RLSNAP01"
+HEADER = struct.Struct("=8sQQQQdd")
+
+
+def save_snapshot(rate_limiter, path):
+    """
+    Write users and window state of a SlidingWindowLogsRateLimiter to path,
+    returns number of users written
+    Snapshot is laid out in columns after the header, in native byte order:
+        num_requests ('q') and window_time_in_sec ('d') of each tier,
+        timestamps ('d') of all tiers' logs, oldest first,
+        tier count ('I') of each user, 0 for users with a single limit,
+        number of timestamps ('I') in each tier's log,
+        user ids, NUL separated utf-8
+    so it is restored with a few bulk copies rather than parsing per user.
+    File is replaced atomically, a crash while saving leaves the previous snapshot.
+    """
+    if not isinstance(rate_limiter, SlidingWindowLogsRateLimiter):
+        raise ValueError("Only sliding window log rate limiters can be snapshotted")
+    user_ids, user_states = rate_limiter.user_map.ids_and_states()
+    # Users yet to make a request since restored are saved as their empty prototype
+    user_states = [
+        user_state.prototype if type(user_state) is LazyUserState else user_state
+        for user_state in user_states
+    ]
+    tier_counts = array("I")
+    tiers = []
+    for user_state in user_states:
+        if type(user_state) is UserLimitTiers:
+            tier_counts.append(len(user_state.tiers))
+            tiers.extend(user_state.tiers)
+        else:
+            tier_counts.append(0)
+            tiers.append(user_state)
+    # Limits don't change once a user is added, so they are read without locks
+    num_requests = array("q", map(attrgetter("num_requests"), tiers))
+    window_times = array("d", map(attrgetter("window_time_in_sec"), tiers))
+    sizes = array("I", bytes(4 * len(tiers)))
+    timestamps = array("d")
+    # Loop over users only adds to arrays, whose items aren't objects,
+    # so it sets off no garbage collection however many users there are.
+    # Users with no requests in their log are most, and are skipped
+    # without taking their lock, as if they were read just before a request.
+    tier = 0
+    for user_state, tier_count in zip(user_states, tier_counts):
+        if not tier_count:
+            if user_state.size:
+                with user_state.lock:
+                    sizes[tier] = user_state.size
+                    user_state.copy_timestamps(timestamps)
+            tier += 1
+            continue
+        with user_state.lock:
+            for tier_state in user_state.tiers:
+                sizes[tier] = tier_state.size
+                tier_state.copy_timestamps(timestamps)
+                tier += 1
+    encoded_user_ids = "\0".join(user_ids).encode()
+    if encoded_user_ids.count(b"\0") != max(0, len(user_ids) - 1):
+        raise ValueError("User ids with NUL characters can't be snapshotted")
+    header = HEADER.pack(
+        MAGIC,
+        len(user_ids),
+        len(sizes),
+        len(timestamps),
+        len(encoded_user_ids),
+        time.time(),
+        rate_limiter.get_current_timestamp_sec(),
+    )
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(header)
+        for column in (num_requests, window_times, timestamps, tier_counts, sizes):
+            column.tofile(file)
+        file.write(encoded_user_ids)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+    return len(user_ids)
+
+
+def restore_snapshot(rate_limiter, path):
+    """
+    Add users of a snapshot to a SlidingWindowLogsRateLimiter, replacing
+    state of users already present, returns number of users restored
+    Timestamps are moved to the rate limiter's clock as of their age when
+    snapshot was taken plus wall clock time since, so restoring works across
+    clocks (e.g. MonotonicClock of a previous process) and time spent down
+    counts towards windows.
+    Users with no timestamps in the snapshot, usually most of them, get their
+    state on first lookup, so restoring is mostly reading ids and adding them
+    to the registry, e.g. about 0.8s for a million users of which 100k have
+    requests in their windows (over 2s when every user's state was created upfront).
+    """
+    if not isinstance(rate_limiter, SlidingWindowLogsRateLimiter):
+        raise ValueError("Only sliding window log rate limiters can be restored")
+    with open(path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as buffer:
+        (
+            magic,
+            num_users,
+            num_tiers,
+            num_timestamps,
+            user_ids_size,
+            saved_at,
+            snapshot_timestamp,
+        ) = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError("Not a rate limiter snapshot: " + path)
+        current_timestamp = rate_limiter.get_current_timestamp_sec()
+        shift = current_timestamp - max(0, time.time() - saved_at) - snapshot_timestamp
+        columns = []
+        offset = HEADER.size
+        for typecode, length in (
+            ("q", num_tiers),
+            ("d", num_tiers),
+            ("d", num_timestamps),
+            ("I", num_users),
+            ("I", num_tiers),
+        ):
+            size = length * array(typecode).itemsize
+            # Copied out of the mapping, as it is closed once restored
+            columns.append(array(typecode, buffer[offset : offset + size]))
+            offset += size
+        user_ids = (
+            buffer[offset : offset + user_ids_size].decode().split("\0")
+            if num_users
+            else []
+        )
+    num_requests, window_times, timestamps, tier_counts, sizes = columns
+    if shift:
+        timestamps = array("d", [timestamp + shift for timestamp in timestamps])
+
+    with paused_gc():
+        user_states = _create_user_states(
+            tier_counts,
+            num_requests,
+            window_times,
+            sizes,
+            timestamps,
+            current_timestamp,
+        )
+        rate_limiter.user_map.put_many(user_ids, user_states)
+    return len(user_ids)
+
+
+def _create_user_states(
+    tier_counts, num_requests, window_times, sizes, timestamps, current_timestamp
+):
+    """
+    State of each user from columns of a snapshot, without timestamps which
+    have since left their window
+    Tiers with no timestamps share a LazyUserState per distinct limits, mapped
+    onto all of them at once, so only tiers with timestamps and users with
+    several tiers are looped over.
+    """
+    lazy_states = {
+        limit: LazyUserState(UserLog(*limit), partial(UserLog, *limit))
+        for limit in set(zip(num_requests, window_times))
+    }
+    tier_states = list(map(lazy_states.__getitem__, zip(num_requests, window_times)))
+    position = 0
+    for tier in compress(range(len(sizes)), sizes):
+        size = sizes[tier]
+        user_log = UserLog(num_requests[tier], window_times[tier])
+        user_log.log = timestamps[position : position + size]
+        user_log.size = size
+        user_log.evict_older_timestamps(current_timestamp)
+        tier_states[tier] = user_log
+        position += size
+    if not any(tier_counts):
+        return tier_states
+    # Users with several tiers take that many consecutive tier states
+    first_tiers = list(accumulate((count or 1 for count in tier_counts), initial=0))
+    user_states = list(map(tier_states.__getitem__, first_tiers[:-1]))
+    lazy_tiers = {}
+    for user in compress(range(len(tier_counts)), tier_counts):
+        first_tier = first_tiers[user]
+        last_tier = first_tiers[user + 1]
+        if not any(sizes[first_tier:last_tier]):
+            user_limits = tuple(
+                zip(
+                    num_requests[first_tier:last_tier],
+                    window_times[first_tier:last_tier],
+                )
+            )
+            if user_limits not in lazy_tiers:
+                lazy_tiers[user_limits] = LazyUserState(
+                    _create_tiers(user_limits), partial(_create_tiers, user_limits)
+                )
+            user_states[user] = lazy_tiers[user_limits]
+            continue
+        user_states[user] = UserLimitTiers(
+            [
+                tier_state.create() if type(tier_state) is LazyUserState else tier_state
+                for tier_state in tier_states[first_tier:last_tier]
+            ]
+        )
+    return user_states
+
+
+def _create_tiers(limits):
+    return UserLimitTiers([UserLog(*limit) for limit in limits])
+
+
+class Snapshotter:
+    """
+    Saves snapshots of a rate limiter every interval_sec in a background
+    daemon thread, and a last one when stopped
+    Saving is pure Python work of about 1.5 us per user (and per tier) holding
+    the GIL, e.g. 1.5s for a million users, so threads serving requests get
+    that much less of the interpreter; interval_sec should be well above it.
+    """
+
+    DEFAULT_INTERVAL_SEC = 60
+
+    def __init__(self, rate_limiter, path, interval_sec=DEFAULT_INTERVAL_SEC):
+        self.rate_limiter = rate_limiter
+        self.path = path
+        self.interval_sec = interval_sec
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def save(self):
+        try:
+            save_snapshot(self.rate_limiter, self.path)
+        except Exception:
+            logging.exception("Failed to save snapshot to %s", self.path)
+
+    def start(self):
+        if self.thread is not None:
+            raise Exception("Snapshotter already running")
+        self.stopped.clear()
+
+        def _save_periodically():
+            while not self.stopped.wait(self.interval_sec):
+                self.save()
+
+        self.thread = threading.Thread(target=_save_periodically, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            self.save()
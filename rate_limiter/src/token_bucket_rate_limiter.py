@@ -0,0 +1,94 @@
+import threading
+
+from in_memory_rate_limiter import InMemoryRateLimiter
+
+
+class UserTokenBucket:
+    """
+    Token bucket of each user, refilled lazily on every request
+    """
+
+    __slots__ = (
+        "lock",
+        "bucket_size",
+        "refill_rate",
+        "window_time_in_sec",
+        "tokens",
+        "last_refill",
+    )
+
+    def __init__(self, bucket_size, refill_rate, window_time_in_sec, current_timestamp):
+        self.lock = threading.Lock()
+        self.bucket_size = bucket_size
+        # Tokens added per second
+        self.refill_rate = refill_rate
+        self.window_time_in_sec = window_time_in_sec
+        self.tokens = bucket_size
+        self.last_refill = current_timestamp
+
+    def refill(self, current_timestamp):
+        """
+        Add tokens accumulated since last refill, capped at bucket size
+        """
+        elapsed = current_timestamp - self.last_refill
+        if elapsed > 0:
+            self.tokens = min(
+                self.bucket_size, self.tokens + elapsed * self.refill_rate
+            )
+            self.last_refill = current_timestamp
+
+    def can_acquire(self, current_timestamp):
+        self.refill(current_timestamp)
+        # Check if a token is available
+        return self.tokens >= 1
+
+    def acquire(self, current_timestamp):
+        self.tokens -= 1
+
+    def get_quota(self, current_timestamp):
+        """
+        (limit, remaining, reset_at, retry_after) as of current timestamp
+        """
+        self.refill(current_timestamp)
+        if self.refill_rate <= 0:
+            # Bucket of a zero quota user is never refilled
+            reset_at = current_timestamp
+            if self.tokens < self.bucket_size:
+                reset_at += self.window_time_in_sec
+            retry_after = 0 if self.tokens >= 1 else self.window_time_in_sec
+            return self.bucket_size, int(self.tokens), reset_at, retry_after
+        reset_at = (
+            current_timestamp + (self.bucket_size - self.tokens) / self.refill_rate
+        )
+        retry_after = 0
+        if self.tokens < 1:
+            retry_after = (1 - self.tokens) / self.refill_rate
+        return self.bucket_size, int(self.tokens), reset_at, retry_after
+
+    def try_acquire(self, current_timestamp):
+        if not self.can_acquire(current_timestamp):
+            return False
+        self.acquire(current_timestamp)
+        return True
+
+
+class TokenBucketRateLimiter(InMemoryRateLimiter):
+    """
+    Implementation of Token bucket rate limiter
+    Bucket holds upto bucket_size tokens (burst) and is refilled at
+    num_requests / window_time_in_sec tokens per second (sustained rate).
+    Each allowed request consumes one token.
+    Refill is computed from the limiter's clock when user makes a request,
+    so there are no background timers.
+    """
+
+    @classmethod
+    def create_user_state(
+        cls, num_requests, window_time_in_sec, current_timestamp, bucket_size=None
+    ):
+        return UserTokenBucket(
+            num_requests if bucket_size is None else bucket_size,
+            num_requests / window_time_in_sec,
+            window_time_in_sec,
+            current_timestamp,
+        )
@@ -0,0 +1,89 @@
+import csv
+import json
+import os
+from itertools import islice
+
+from gc_pause import paused_gc
+
+# Users added per add_users_bulk call, bounds memory and how long locks are held
+DEFAULT_CHUNK_SIZE = 10000
+FIELDS = ("user_id", "num_requests", "window_time_in_sec")
+
+
+def parse_number(value):
+    """
+    int for whole numbers (as written in CSV or JSON), float otherwise
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def read_users(path, file_format=None):
+    """
+    Stream (user_id, num_requests, window_time_in_sec) of users in a quota file
+    Files are CSV with a user_id,num_requests,window_time_in_sec header row,
+    or JSONL with an object of those keys per line; format is told by the
+    file extension unless given.
+    """
+    if file_format is None:
+        file_format = os.path.splitext(path)[1].lstrip(".").lower()
+    if file_format not in ("csv", "jsonl"):
+        raise ValueError("Unknown quota file format: " + file_format)
+    with open(path, newline="") as file:
+        if file_format == "csv":
+            rows = csv.reader(file)
+            header = next(rows, [])
+            if not set(FIELDS) <= set(header):
+                raise ValueError("CSV quota file needs columns: " + ",".join(FIELDS))
+            # Rows are lists, looked up by position of the columns
+            user_id_key, num_requests_key, window_key = map(header.index, FIELDS)
+            rows = (row for row in rows if row)
+        else:
+            user_id_key, num_requests_key, window_key = FIELDS
+            rows = (json.loads(line) for line in file if line.strip())
+        for line_number, row in enumerate(rows, 1):
+            try:
+                yield (
+                    row[user_id_key],
+                    parse_number(row[num_requests_key]),
+                    parse_number(row[window_key]),
+                )
+            except (IndexError, KeyError, TypeError, ValueError):
+                raise ValueError("Invalid user in %s, row %d" % (path, line_number))
+
+
+def load_users(rate_limiter, path, file_format=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Add users of a quota file to a rate limiter, chunk_size users at a time,
+    returns number of users added
+    """
+    users = read_users(path, file_format)
+    num_users = 0
+    with paused_gc():
+        while True:
+            chunk = list(islice(users, chunk_size))
+            if not chunk:
+                return num_users
+            rate_limiter.add_users_bulk(chunk)
+            num_users += len(chunk)
+
+
+async def load_users_async(
+    rate_limiter, path, file_format=None, chunk_size=DEFAULT_CHUNK_SIZE
+):
+    """
+    load_users for an AsyncRateLimiter
+    """
+    users = read_users(path, file_format)
+    num_users = 0
+    with paused_gc():
+        while True:
+            chunk = list(islice(users, chunk_size))
+            if not chunk:
+                return num_users
+            await rate_limiter.add_users_bulk(chunk)
+            num_users += len(chunk)
@@ -0,0 +1,263 @@
+import contextlib
+import threading
+from collections import OrderedDict
+
+
+class UserRegistryShard:
+    """
+    Subset of users guarded by its own lock
+    """
+
+    __slots__ = ("lock", "users", "last_access")
+
+    def __init__(self, ordered):
+        self.lock = threading.Lock()
+        # Users are kept in least recently used first order only when
+        # registry is bounded, since it costs a move on every lookup
+        self.users = OrderedDict() if ordered else {}
+        self.last_access = {}
+
+
+class LazyUserState:
+    """
+    Stand-in for state of a user with no requests yet, replaced by the state
+    create() returns on the user's first lookup. Users with the same limits
+    share one, so holding many users who make no requests costs a reference each.
+    prototype: state create() returns a copy of, it is never changed
+    """
+
+    __slots__ = ("prototype", "create")
+
+    def __init__(self, prototype, create):
+        self.prototype = prototype
+        self.create = create
+
+
+class ShardedUserRegistry:
+    """
+    Map of user_id to per user rate limiting state, split into shards
+    Users are assigned to a shard by hash of user_id, so threads handling
+    users in different shards don't contend on the same lock.
+    Registry can optionally be bounded:
+        max_users: users are dropped once there are more than this many,
+            the least recently used one of the largest shard at a time.
+            Shards are balanced by hashing, so this approximates dropping
+            the least recently used users overall. Registry has at most
+            max_users shards, so the largest one has a user other than the
+            one just added to drop.
+        idle_ttl_sec: users not seen for this long are dropped,
+            a few at a time on each lookup and fully on evict_idle_users.
+            Should be longer than users' windows, as a dropped user
+            starts afresh with full quota when added again.
+    Dropped users have to be added again before they can make requests.
+    """
+
+    DEFAULT_NUM_SHARDS = 16
+    # Idle users dropped from a shard per lookup, keeps lookups O(1)
+    IDLE_USERS_DROPPED_PER_LOOKUP = 2
+
+    def __init__(
+        self,
+        num_shards=DEFAULT_NUM_SHARDS,
+        max_users=None,
+        idle_ttl_sec=None,
+        clock=None,
+    ):
+        if num_shards < 1:
+            raise ValueError("num_shards must be at least 1")
+        if max_users is not None and max_users < 1:
+            raise ValueError("max_users must be at least 1")
+        if idle_ttl_sec is not None and clock is None:
+            raise ValueError("clock is required to drop idle users")
+        if max_users is not None:
+            num_shards = min(num_shards, max_users)
+        self.num_shards = num_shards
+        self.max_users = max_users
+        # Serializes dropping users beyond max_users, taken before any shard lock
+        self.eviction_lock = threading.Lock()
+        self.idle_ttl_sec = idle_ttl_sec
+        self.clock = clock
+        self.ordered = max_users is not None or idle_ttl_sec is not None
+        self.shards = [UserRegistryShard(self.ordered) for _ in range(num_shards)]
+        # Records shard lock waits of lookups when set (RateLimiterMetrics)
+        self.metrics = None
+
+    def get_shard(self, user_id):
+        return self.shards[hash(user_id) % self.num_shards]
+
+    def add(self, user_id, user_state):
+        shard = self.get_shard(user_id)
+        with shard.lock:
+            if user_id in shard.users:
+                raise Exception("User already present")
+            shard.users[user_id] = user_state
+            if self.idle_ttl_sec is not None:
+                shard.last_access[user_id] = self.clock.now()
+        self._drop_users_beyond_max()
+
+    def group_by_shard(self, items):
+        """
+        Map index of shard to (user_id, user state) pairs of its users
+        """
+        items_by_shard = {}
+        for item in items:
+            items_by_shard.setdefault(hash(item[0]) % self.num_shards, []).append(item)
+        return items_by_shard
+
+    def _insert(self, shard, shard_items):
+        """
+        Add or replace users of a shard, caller must hold shard lock
+        """
+        shard.users.update(shard_items)
+        if self.idle_ttl_sec is not None:
+            current_timestamp = self.clock.now()
+            shard.last_access.update(
+                (user_id, current_timestamp) for user_id, _ in shard_items
+            )
+
+    def _drop_users_beyond_max(self):
+        """
+        Drop least recently used users of the largest shards till there are
+        at most max_users, caller must not hold any shard lock
+        """
+        if self.max_users is None:
+            return
+        with self.eviction_lock:
+            while len(self) > self.max_users:
+                shard = max(self.shards, key=lambda shard: len(shard.users))
+                with shard.lock:
+                    if shard.users:
+                        lru_user_id, _ = shard.users.popitem(last=False)
+                        shard.last_access.pop(lru_user_id, None)
+
+    def add_many(self, items):
+        """
+        Add many (user_id, user state) pairs, taking each shard's lock once
+        Locks of all shards involved are held together (taken in shard order),
+        so no user is added if any of them is already present.
+        """
+        items_by_shard = self.group_by_shard(items)
+        with contextlib.ExitStack() as stack:
+            for index in sorted(items_by_shard):
+                stack.enter_context(self.shards[index].lock)
+            for index, shard_items in items_by_shard.items():
+                users = self.shards[index].users
+                if len({user_id for user_id, _ in shard_items}) < len(
+                    shard_items
+                ) or any(user_id in users for user_id, _ in shard_items):
+                    raise Exception("User already present")
+            for index, shard_items in items_by_shard.items():
+                self._insert(self.shards[index], shard_items)
+        self._drop_users_beyond_max()
+
+    def put_many(self, user_ids, user_states):
+        """
+        Add or replace state of many users, given as two lists in the same order
+        (like ids_and_states returns them), holding locks of all shards
+        """
+        shard_users = [shard.users for shard in self.shards]
+        num_shards = self.num_shards
+        with contextlib.ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.lock)
+            for user_id, user_state in zip(user_ids, user_states):
+                shard_users[hash(user_id) % num_shards][user_id] = user_state
+            if self.idle_ttl_sec is not None:
+                current_timestamp = self.clock.now()
+                for user_id in user_ids:
+                    self.get_shard(user_id).last_access[user_id] = current_timestamp
+        self._drop_users_beyond_max()
+
+    def remove(self, user_id):
+        shard = self.get_shard(user_id)
+        with shard.lock:
+            if user_id in shard.users:
+                del shard.users[user_id]
+                shard.last_access.pop(user_id, None)
+
+    def get(self, user_id):
+        shard = self.get_shard(user_id)
+        with (
+            shard.lock
+            if self.metrics is None
+            else self.metrics.timed_lock(shard.lock, "registry_lock_wait_seconds")
+        ):
+            if user_id not in shard.users:
+                raise Exception("User not present")
+            user_state = shard.users[user_id]
+            if type(user_state) is LazyUserState:
+                user_state = shard.users[user_id] = user_state.create()
+            if self.ordered:
+                shard.users.move_to_end(user_id)
+            if self.idle_ttl_sec is not None:
+                current_timestamp = self.clock.now()
+                shard.last_access[user_id] = current_timestamp
+                self._drop_idle_users(
+                    shard, current_timestamp, self.IDLE_USERS_DROPPED_PER_LOOKUP
+                )
+            return user_state
+
+    def _drop_idle_users(self, shard, current_timestamp, max_dropped=None):
+        """
+        Drop users idle for longer than idle_ttl_sec from the least recently used end
+        Caller must hold shard lock
+        """
+        num_dropped = 0
+        idle_before = current_timestamp - self.idle_ttl_sec
+        while shard.users and (max_dropped is None or num_dropped < max_dropped):
+            lru_user_id = next(iter(shard.users))
+            if shard.last_access[lru_user_id] > idle_before:
+                break
+            del shard.users[lru_user_id]
+            del shard.last_access[lru_user_id]
+            num_dropped += 1
+        return num_dropped
+
+    def evict_idle_users(self):
+        """
+        Drop all users idle for longer than idle_ttl_sec, returns number dropped
+        """
+        if self.idle_ttl_sec is None:
+            return 0
+        num_dropped = 0
+        for shard in self.shards:
+            with shard.lock:
+                num_dropped += self._drop_idle_users(shard, self.clock.now())
+        return num_dropped
+
+    def values(self):
+        """
+        Snapshot of all users' state, taken one shard at a time,
+        users whose state is yet to be created are left out
+        """
+        user_states = []
+        for shard in self.shards:
+            with shard.lock:
+                user_states.extend(
+                    user_state
+                    for user_state in shard.users.values()
+                    if type(user_state) is not LazyUserState
+                )
+        return user_states
+
+    def ids_and_states(self):
+        """
+        Snapshot of all user ids and their states as two lists in the same order,
+        taken one shard at a time without creating a pair per user,
+        states yet to be created are LazyUserState
+        """
+        user_ids = []
+        user_states = []
+        for shard in self.shards:
+            with shard.lock:
+                user_ids.extend(shard.users)
+                user_states.extend(shard.users.values())
+        return user_ids, user_states
+
+    def __contains__(self, user_id):
+        shard = self.get_shard(user_id)
+        with shard.lock:
+            return user_id in shard.users
+
+    def __len__(self):
+        return sum(len(shard.users) for shard in self.shards)
@@ -0,0 +1,41 @@
+"""Test rate limiter benchmark harness on a small workload."""
+from collections import Counter
+
+import pytest
+import benchmark
+from benchmark import RATE_LIMITER_FACTORIES, benchmark_rate_limiter, generate_requests
+
+
+def test_zipfian_requests_skewed_to_top_users():
+    """With zipfian skew first user sends the most requests"""
+    user_ids, requests = generate_requests(100, 10000, "zipfian", 1.1, seed=0)
+    assert len(requests) == 10000
+    assert Counter(requests).most_common(1)[0][0] == user_ids[0]
+
+
+@pytest.mark.parametrize(
+    "rate_limiter_algorithm", ["sliding_window_log", "token_bucket"]
+)
+def test_benchmark_rate_limiter(rate_limiter_algorithm):
+    """Benchmark reports throughput, latency percentiles and memory per user"""
+    user_ids, requests = generate_requests(10, 1000, "uniform", 1.1, seed=0)
+    result = benchmark_rate_limiter(
+        RATE_LIMITER_FACTORIES[rate_limiter_algorithm],
+        user_ids,
+        requests,
+        num_threads=2,
+        limit=50,
+        window_time_in_sec=60,
+    )
+    assert result["decisions_per_sec"] > 0
+    assert result["p50_us"] <= result["p99_us"] <= result["p999_us"]
+    assert result["allowed_ratio"] == pytest.approx(0.5)
+    assert result["memory_per_user_bytes"] > 0
+
+
+def test_default_algorithms_leave_out_redis_without_fakeredis(monkeypatch):
+    """Benchmark runs by default without fakeredis, skipping Redis limiters"""
+    monkeypatch.setattr(benchmark.importlib.util, "find_spec", lambda name: None)
+    algorithms = benchmark.get_default_rate_limiter_algorithms()
+    assert "sliding_window_log" in algorithms
+    assert not set(algorithms) & set(benchmark.REDIS_RATE_LIMITER_FACTORIES)
@@ -0,0 +1,437 @@
+"""Test rate limiters' allow and throttle scenarios."""
+import asyncio
+import time
+from concurrent import futures
+
+import pytest
+from async_in_memory_rate_limiter import AsyncInMemoryRateLimiter
+from clock import ManualClock
+from context import AsyncContext, Context
+from leaky_bucket_rate_limiter import LeakyBucketRateLimiter
+from sliding_window_counter_rate_limiter import SlidingWindowCounterRateLimiter
+from sliding_window_logs_rate_limiter import SlidingWindowLogsRateLimiter
+from token_bucket_rate_limiter import TokenBucketRateLimiter
+from user_registry import ShardedUserRegistry
+
+RATE_LIMITER_CLASSES = [
+    SlidingWindowLogsRateLimiter,
+    SlidingWindowCounterRateLimiter,
+    TokenBucketRateLimiter,
+    LeakyBucketRateLimiter,
+]
+
+
+@pytest.fixture
+def clock():
+    return ManualClock(1000)
+
+
+@pytest.mark.parametrize("rate_limiter_class", RATE_LIMITER_CLASSES)
+class TestRateLimiter:
+    """Tests common to all in-memory rate limiters"""
+
+    def test_requests_within_limit_allowed(self, rate_limiter_class, clock):
+        """Requests up to the limit are allowed, next one is throttled"""
+        rate_limiter = rate_limiter_class(clock=clock)
+        rate_limiter.add_user("user1", 3, 10)
+        assert [rate_limiter.is_allowed("user1") for _ in range(4)] == [
+            True,
+            True,
+            True,
+            False,
+        ]
+
+    def test_requests_allowed_after_window(self, rate_limiter_class, clock):
+        """Throttled user is allowed again once the window has passed"""
+        rate_limiter = rate_limiter_class(clock=clock)
+        rate_limiter.add_user("user1", 2, 10)
+        rate_limiter.is_allowed("user1")
+        rate_limiter.is_allowed("user1")
+        assert not rate_limiter.is_allowed("user1")
+        clock.advance(25)
+        assert rate_limiter.is_allowed("user1")
+
+    def test_users_limited_independently(self, rate_limiter_class, clock):
+        """One user's requests do not count against another user"""
+        rate_limiter = rate_limiter_class(clock=clock)
+        rate_limiter.add_user("user1", 1, 10)
+        rate_limiter.add_user("user2", 1, 10)
+        assert rate_limiter.is_allowed("user1")
+        assert rate_limiter.is_allowed("user2")
+        assert not rate_limiter.is_allowed("user1")
+
+    def test_unknown_user(self, rate_limiter_class, clock):
+        """Requests of unregistered or removed users are rejected"""
+        rate_limiter = rate_limiter_class(clock=clock)
+        rate_limiter.add_user("user1", 1, 10)
+        rate_limiter.remove_user("user1")
+        with pytest.raises(Exception):
+            rate_limiter.is_allowed("user1")
+
+    def test_duplicate_user(self, rate_limiter_class, clock):
+        """Registering the same user twice is rejected"""
+        rate_limiter = rate_limiter_class(clock=clock)
+        rate_limiter.add_user("user1", 1, 10)
+        with pytest.raises(Exception):
+            rate_limiter.add_user("user1", 1, 10)
+
+    def test_add_users_bulk(self, rate_limiter_class, clock):
+        """Users are added together, or none of them if any is already present"""
+        rate_limiter = rate_limiter_class(num_shards=4, clock=clock)
+        rate_limiter.add_users_bulk(
+            [("user" + str(i), i + 1, 10) for i in range(8)] + [("user8", 0, 10)]
+        )
+        assert len(rate_limiter.user_map) == 9
+        assert [rate_limiter.is_allowed("user1") for _ in range(3)] == [
+            True,
+            True,
+            False,
+        ]
+        assert not rate_limiter.is_allowed("user8")
+        with pytest.raises(Exception):
+            rate_limiter.add_users_bulk([("user9", 1, 10), ("user1", 1, 10)])
+        with pytest.raises(Exception):
+            rate_limiter.add_users_bulk([("user10", 1, 10), ("user10", 1, 10)])
+        assert "user9" not in rate_limiter.user_map
+        assert "user10" not in rate_limiter.user_map
+
+    def test_concurrent_requests(self, rate_limiter_class, clock):
+        """Concurrent requests of users spread across shards are limited exactly"""
+        rate_limiter = rate_limiter_class(num_shards=4, clock=clock)
+        user_ids = ["user" + str(i) for i in range(16)]
+        for user_id in user_ids:
+            rate_limiter.add_user(user_id, 5, 10)
+        with futures.ThreadPoolExecutor(max_workers=32) as executor:
+            decisions = list(executor.map(rate_limiter.is_allowed, user_ids * 10))
+        assert sum(decisions) == 5 * len(user_ids)
+
+
+def test_sliding_window_counter_weights_previous_window(clock):
+    """Previous window's count is weighted by its overlap with the sliding window"""
+    rate_limiter = SlidingWindowCounterRateLimiter(clock=clock)
+    rate_limiter.add_user("user1", 10, 10)
+    clock.set(1000)
+    for _ in range(10):
+        assert rate_limiter.is_allowed("user1")
+    # 30% into the next window, 70% of previous window's 10 requests still count
+    clock.set(1013)
+    assert [rate_limiter.is_allowed("user1") for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+
+
+def test_sliding_window_log_ring_buffer(clock):
+    """Log grows only as needed, wraps around and evicts only expired timestamps"""
+    rate_limiter = SlidingWindowLogsRateLimiter(clock=clock)
+    rate_limiter.add_user("user1", 20, 10)
+    user_log = rate_limiter.user_map.get("user1")
+    assert rate_limiter.is_allowed("user1")
+    assert len(user_log.log) == user_log.INITIAL_CAPACITY
+    for _ in range(19):
+        clock.advance(1)
+        rate_limiter.is_allowed("user1")
+    assert len(user_log) == 11
+    assert len(user_log.log) == 16
+    # Denied requests are not logged, log never grows past num_requests
+    for _ in range(20):
+        rate_limiter.is_allowed("user1")
+    assert len(user_log) == 20
+    assert len(user_log.log) == 20
+    assert not rate_limiter.is_allowed("user1")
+    # Window slides over a log which has wrapped around the buffer
+    clock.advance(1)
+    assert rate_limiter.is_allowed("user1")
+    assert user_log.head == 1
+    assert user_log.timestamps() == (
+        [float(ts) for ts in range(1010, 1019)] + [1019.0] * 10 + [1020.0]
+    )
+
+
+@pytest.mark.parametrize(
+    "rate_limiter_class", [TokenBucketRateLimiter, LeakyBucketRateLimiter]
+)
+def test_bucket_burst_and_sustained_rate(rate_limiter_class, clock):
+    """Burst upto bucket size is allowed, then requests are admitted at the refill rate"""
+    rate_limiter = rate_limiter_class(clock=clock)
+    # Sustained rate of 1 request/sec with bursts of 5
+    rate_limiter.add_user("user1", 10, 10, bucket_size=5)
+    assert [rate_limiter.is_allowed("user1") for _ in range(6)] == [True] * 5 + [False]
+    clock.advance(2)
+    assert [rate_limiter.is_allowed("user1") for _ in range(3)] == [
+        True,
+        True,
+        False,
+    ]
+
+
+@pytest.mark.parametrize("rate_limiter_class", RATE_LIMITER_CLASSES)
+def test_is_allowed_many(rate_limiter_class, clock):
+    """Batch decisions match sequential is_allowed calls"""
+    rate_limiter = rate_limiter_class(clock=clock)
+    rate_limiter.add_user("user1", 2, 10)
+    rate_limiter.add_user("user2", 1, 10)
+    context = Context(rate_limiter)
+    assert context.send_requests(["user1", "user2", "user1", "user2", "user1"]) == [
+        "HTTP 200",
+        "HTTP 200",
+        "HTTP 200",
+        "HTTP 429: Too Many Requests",
+        "HTTP 429: Too Many Requests",
+    ]
+
+
+@pytest.mark.parametrize("rate_limiter_class", RATE_LIMITER_CLASSES)
+def test_async_in_memory_rate_limiter(rate_limiter_class, clock):
+    """asyncio limiter decides requests same as the thread safe one"""
+
+    async def _send_requests():
+        context = AsyncContext(AsyncInMemoryRateLimiter(rate_limiter_class, clock))
+        await context.add_users(
+            [
+                {"user_id": "user1", "num_requests": 2, "window_time_in_sec": 10},
+                {"user_id": "user2", "num_requests": 1, "window_time_in_sec": 10},
+            ]
+        )
+        responses = [await context.send_request("user1")]
+        responses += await context.send_requests(["user2", "user1", "user1"])
+        await context.rate_limiter.remove_user("user1")
+        with pytest.raises(Exception):
+            await context.send_request("user1")
+        return responses
+
+    assert asyncio.run(_send_requests()) == [
+        "HTTP 200",
+        "HTTP 200",
+        "HTTP 200",
+        "HTTP 429: Too Many Requests",
+    ]
+
+
+@pytest.mark.parametrize("rate_limiter_class", RATE_LIMITER_CLASSES)
+def test_millisecond_window(rate_limiter_class, clock):
+    """Windows can be shorter than a second, e.g. 2 requests per 100ms"""
+    rate_limiter = rate_limiter_class(clock=clock)
+    rate_limiter.add_user("user1", 2, 0.1)
+    assert [rate_limiter.is_allowed("user1") for _ in range(3)] == [
+        True,
+        True,
+        False,
+    ]
+    clock.advance(0.25)
+    assert rate_limiter.is_allowed("user1")
+
+
+@pytest.mark.parametrize("rate_limiter_class", RATE_LIMITER_CLASSES)
+def test_limit_tiers(rate_limiter_class, clock):
+    """Request is allowed only if every tier allows it, decision reports tier denying it"""
+    rate_limiter = rate_limiter_class(clock=clock)
+    rate_limiter.add_user_limits("user1", [(2, 1), (3, 60)])
+    assert [rate_limiter.is_allowed_tiered("user1") for _ in range(3)] == [
+        (True, None),
+        (True, None),
+        (False, 0),
+    ]
+    clock.advance(2.5)
+    assert rate_limiter.is_allowed_tiered("user1") == (True, None)
+    assert rate_limiter.is_allowed_tiered("user1") == (False, 1)
+    assert not rate_limiter.is_allowed("user1")
+
+    rate_limiter.add_user("user2", 1, 10)
+    assert rate_limiter.is_allowed_tiered("user2") == (True, None)
+    assert rate_limiter.is_allowed_tiered("user2") == (False, 0)
+
+    async_rate_limiter = AsyncInMemoryRateLimiter(rate_limiter_class, clock=clock)
+    asyncio.run(async_rate_limiter.add_user_limits("user1", [(1, 1), (2, 60)]))
+    assert [
+        asyncio.run(async_rate_limiter.is_allowed_tiered("user1")) for _ in range(2)
+    ] == [(True, None), (False, 0)]
+
+
+@pytest.mark.parametrize(
+    "rate_limiter_class, retry_after",
+    [
+        (SlidingWindowLogsRateLimiter, 10),
+        (SlidingWindowCounterRateLimiter, 15),
+        (TokenBucketRateLimiter, 5),
+        (LeakyBucketRateLimiter, 5),
+    ],
+)
+def test_check_reports_quota(rate_limiter_class, retry_after, clock):
+    """Decision carries remaining quota and when a throttled user can retry"""
+    rate_limiter = rate_limiter_class(clock=clock)
+    rate_limiter.add_user("user1", 2, 10)
+    decisions = [rate_limiter.check("user1") for _ in range(3)]
+    assert [decision.allowed for decision in decisions] == [True, True, False]
+    assert [decision.remaining for decision in decisions] == [1, 0, 0]
+    assert [decision.limit for decision in decisions] == [2, 2, 2]
+    assert decisions[0].retry_after == 0
+    assert decisions[2].retry_after == pytest.approx(retry_after)
+    assert decisions[2].reset_at > clock.now()
+    clock.advance(retry_after + 0.001)
+    assert rate_limiter.check("user1").allowed
+    # User with a zero quota is denied for a window at a time
+    rate_limiter.add_user("user2", 0, 10)
+    decision = rate_limiter.check("user2")
+    assert (decision.allowed, decision.limit, decision.remaining) == (False, 0, 0)
+    assert decision.retry_after == 10
+
+
+@pytest.mark.parametrize(
+    "rate_limiter_class", [TokenBucketRateLimiter, LeakyBucketRateLimiter]
+)
+def test_check_zero_quota_with_burst(rate_limiter_class, clock):
+    """Zero quota user with a burst spends it once, as the bucket never recovers"""
+    rate_limiter = rate_limiter_class(clock=clock)
+    rate_limiter.add_user("user1", 0, 10, bucket_size=2)
+    decisions = [rate_limiter.check("user1") for _ in range(3)]
+    assert [decision.allowed for decision in decisions] == [True, True, False]
+    assert [decision.remaining for decision in decisions] == [1, 0, 0]
+    assert decisions[0].reset_at == clock.now() + 10
+    assert decisions[2].retry_after == 10
+
+
+def test_check_reports_most_constrained_tier(clock):
+    """Quota of the tier with least of it remaining is reported"""
+    rate_limiter = SlidingWindowLogsRateLimiter(clock=clock)
+    rate_limiter.add_user_limits("user1", [(5, 1), (3, 60)])
+    decision = rate_limiter.check("user1")
+    assert (decision.limit, decision.remaining) == (3, 2)
+    assert decision.reset_at == 1060
+    rate_limiter.check("user1")
+    rate_limiter.check("user1")
+    decision = rate_limiter.check("user1")
+    assert not decision.allowed
+    assert decision.retry_after == 60
+
+
+def test_context_rate_limit_headers(clock):
+    """Throttled responses tell clients when to retry"""
+    context = Context(SlidingWindowLogsRateLimiter(clock=clock))
+    context.add_users(
+        [{"user_id": "user1", "num_requests": 2, "window_time_in_sec": 10}]
+    )
+    assert context.send_request_with_headers("user1") == (
+        "HTTP 200",
+        {
+            "X-RateLimit-Limit": "2",
+            "X-RateLimit-Remaining": "1",
+            "X-RateLimit-Reset": "10",
+        },
+    )
+    clock.advance(0.5)
+    context.send_request_with_headers("user1")
+    assert context.send_request_with_headers("user1") == (
+        "HTTP 429: Too Many Requests",
+        {
+            "X-RateLimit-Limit": "2",
+            "X-RateLimit-Remaining": "0",
+            "X-RateLimit-Reset": "10",
+            "Retry-After": "10",
+        },
+    )
+
+    async_context = AsyncContext(AsyncInMemoryRateLimiter(clock=clock))
+    asyncio.run(
+        async_context.add_users(
+            [{"user_id": "user1", "num_requests": 1, "window_time_in_sec": 10}]
+        )
+    )
+    response, headers = asyncio.run(async_context.send_request_with_headers("user1"))
+    assert response == "HTTP 200"
+    assert headers["X-RateLimit-Remaining"] == "0"
+
+
+def test_metrics(clock):
+    """Decisions and lock waits are recorded only once metrics are enabled"""
+    rate_limiter = SlidingWindowLogsRateLimiter(clock=clock)
+    rate_limiter.add_user("user1", 2, 10)
+    rate_limiter.is_allowed("user1")
+    metrics = rate_limiter.enable_metrics()
+    rate_limiter.is_allowed("user1")
+    rate_limiter.is_allowed_many(["user1", "user1"])
+    rate_limiter.check("user1")
+
+    snapshot = metrics.to_dict()
+    assert (snapshot["allowed"], snapshot["denied"]) == (1, 3)
+    assert snapshot["registry_lock_wait_seconds"]["count"] == 3
+    assert snapshot["user_lock_wait_seconds"]["count"] == 3
+    assert snapshot["user_lock_wait_seconds"]["buckets"][-1] == (None, 3)
+    assert snapshot["redis_round_trip_seconds"]["count"] == 0
+    text = metrics.to_prometheus()
+    assert 'rate_limiter_requests_total{decision="denied"} 3\n' in text
+    assert 'rate_limiter_user_lock_wait_seconds_bucket{le="+Inf"} 3\n' in text
+    assert "rate_limiter_user_lock_wait_seconds_count 3\n" in text
+
+
+@pytest.mark.parametrize("rate_limiter_class", RATE_LIMITER_CLASSES)
+def test_max_users_drops_least_recently_used(rate_limiter_class, clock):
+    """Beyond max_users, least recently used user is dropped"""
+    rate_limiter = rate_limiter_class(num_shards=1, clock=clock, max_users=2)
+    rate_limiter.add_user("user1", 5, 10)
+    rate_limiter.add_user("user2", 5, 10)
+    rate_limiter.is_allowed("user1")
+    rate_limiter.add_user("user3", 5, 10)
+    assert len(rate_limiter.user_map) == 2
+    assert rate_limiter.is_allowed("user1")
+    with pytest.raises(Exception):
+        rate_limiter.is_allowed("user2")
+
+
+def test_max_users_enforced_across_shards(clock):
+    """Users are only dropped once max_users is exceeded, however they're sharded"""
+    rate_limiter = SlidingWindowLogsRateLimiter(num_shards=4, clock=clock, max_users=4)
+    user_ids = ["user" + str(i) for i in range(8)]
+    for user_id in user_ids[:4]:
+        rate_limiter.add_user(user_id, 5, 10)
+    # Cap reached but not exceeded, every user can make requests
+    assert all(rate_limiter.is_allowed(user_id) for user_id in user_ids[:4])
+    for user_id in user_ids[4:]:
+        rate_limiter.add_user(user_id, 5, 10)
+        assert len(rate_limiter.user_map) == 4
+        assert rate_limiter.is_allowed(user_id)
+    rate_limiter.add_users_bulk([("user8", 5, 10), ("user9", 5, 10)])
+    assert len(rate_limiter.user_map) == 4
+    # Registry has no more shards than users it can hold
+    assert ShardedUserRegistry(num_shards=16, max_users=2).num_shards == 2
+
+
+@pytest.mark.parametrize("rate_limiter_class", RATE_LIMITER_CLASSES)
+def test_idle_users_dropped_on_request_path(rate_limiter_class, clock):
+    """Users idle beyond idle_ttl_sec are dropped while serving other users"""
+    rate_limiter = rate_limiter_class(num_shards=1, clock=clock, idle_ttl_sec=60)
+    rate_limiter.add_user("user1", 5, 10)
+    rate_limiter.add_user("user2", 5, 10)
+    clock.advance(30)
+    rate_limiter.is_allowed("user1")
+    clock.advance(40)
+    rate_limiter.is_allowed("user1")
+    assert "user1" in rate_limiter.user_map
+    assert "user2" not in rate_limiter.user_map
+
+
+def test_sweeper_trims_logs_and_drops_idle_users(clock):
+    """Background sweep frees expired timestamps and idle users"""
+    rate_limiter = SlidingWindowLogsRateLimiter(clock=clock, idle_ttl_sec=60)
+    rate_limiter.add_user("user1", 100, 10)
+    rate_limiter.add_user("user2", 100, 10)
+    rate_limiter.is_allowed_many(["user1"] * 50)
+    user_log = rate_limiter.user_map.get("user1")
+    clock.advance(11)
+    rate_limiter.sweep()
+    assert len(user_log) == 0
+    assert len(user_log.log) == user_log.INITIAL_CAPACITY
+    assert len(rate_limiter.user_map) == 2
+
+    clock.advance(60)
+    rate_limiter.start_sweeper(interval_sec=0.01)
+    try:
+        for _ in range(100):
+            if len(rate_limiter.user_map) == 0:
+                break
+            time.sleep(0.01)
+    finally:
+        rate_limiter.stop_sweeper()
+    assert len(rate_limiter.user_map) == 0
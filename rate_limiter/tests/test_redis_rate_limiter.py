@@ -0,0 +1,417 @@
+"""Test Redis backed rate limiter against an in-process Redis stand-in."""
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from async_sliding_window_logs_redis_rate_limiter import (
+    AsyncSlidingWindowLogsRedisRateLimiter,
+)
+from clock import ManualClock
+from hybrid_redis_rate_limiter import HybridRedisRateLimiter
+from near_cache import NearCache
+from sliding_window_logs_rate_limiter import SlidingWindowLogsRateLimiter
+from redis_connection import get_async_connection_pool, get_connection
+from sliding_window_logs_redis_rate_limiter import SlidingWindowLogsRedisRateLimiter
+
+
+@pytest.fixture
+def clock():
+    return ManualClock(1000)
+
+
+@pytest.fixture(params=[False, True], ids=["transaction", "script"])
+def rate_limiter(request, clock):
+    return SlidingWindowLogsRedisRateLimiter(
+        conn=fakeredis.FakeRedis(decode_responses=True),
+        use_script=request.param,
+        clock=clock,
+    )
+
+
+def test_requests_within_limit_allowed(rate_limiter, clock):
+    """Requests in the same second are counted separately"""
+    rate_limiter.add_user("user1", 2, 10)
+    assert [rate_limiter.is_allowed("user1") for _ in range(3)] == [
+        True,
+        True,
+        False,
+    ]
+    clock.advance(11)
+    assert rate_limiter.is_allowed("user1")
+
+
+def test_unknown_user(rate_limiter, clock):
+    """Requests of unregistered users are rejected"""
+    with pytest.raises(Exception):
+        rate_limiter.is_allowed("user1")
+
+
+def test_is_allowed_many(rate_limiter, clock):
+    """Batch decisions match sequential is_allowed calls"""
+    rate_limiter.add_user("user1", 2, 10)
+    rate_limiter.add_user("user2", 1, 10)
+    assert rate_limiter.is_allowed_many(
+        ["user1", "user2", "user1", "user2", "user1"]
+    ) == [
+        True,
+        True,
+        True,
+        False,
+        False,
+    ]
+
+
+def test_script_loaded_on_first_use(clock):
+    """Script is sent with EVAL when redis doesn't have it, EVALSHA afterwards"""
+    conn = fakeredis.FakeRedis(decode_responses=True)
+    rate_limiter = SlidingWindowLogsRedisRateLimiter(
+        conn=conn, use_script=True, clock=clock
+    )
+    rate_limiter.add_user("user1", 1, 10)
+    sha = SlidingWindowLogsRedisRateLimiter.IS_ALLOWED_SCRIPT_SHA
+    assert conn.script_exists(sha) == [False]
+    assert rate_limiter.is_allowed("user1")
+    assert conn.script_exists(sha) == [True]
+    assert not rate_limiter.is_allowed("user1")
+
+
+def test_script_expires_idle_timestamps(clock):
+    """Timestamps of a user expire from redis once the window has passed"""
+    conn = fakeredis.FakeRedis(decode_responses=True)
+    rate_limiter = SlidingWindowLogsRedisRateLimiter(
+        conn=conn, use_script=True, clock=clock
+    )
+    rate_limiter.add_user("user1", 1, 10)
+    rate_limiter.is_allowed("user1")
+    assert 0 < conn.ttl("user1" + rate_limiter.TIMESTAMPS_SUFFIX) <= 11
+
+
+def test_async_rate_limiter(clock):
+    """asyncio limiter decides requests same as the blocking one"""
+
+    async def _send_requests():
+        rate_limiter = AsyncSlidingWindowLogsRedisRateLimiter(
+            conn=fakeredis.FakeAsyncRedis(decode_responses=True), clock=clock
+        )
+        await rate_limiter.add_user("user1", 2, 10)
+        assert await rate_limiter.get_user_rate("user1") == (2, 10)
+        decisions = [await rate_limiter.is_allowed("user1") for _ in range(2)]
+        decisions += await rate_limiter.is_allowed_many(["user1", "user1"])
+        await rate_limiter.remove_user("user1")
+        with pytest.raises(Exception):
+            await rate_limiter.is_allowed("user1")
+        return decisions
+
+    assert asyncio.run(_send_requests()) == [True, True, False, False]
+
+
+def test_limit_tiers(clock):
+    """Every tier is checked in one script call, denials are cached with their tier"""
+    rate_limiter = SlidingWindowLogsRedisRateLimiter(
+        conn=fakeredis.FakeRedis(decode_responses=True),
+        use_script=True,
+        near_cache_size=10,
+        clock=clock,
+    )
+    rate_limiter.add_user_limits("user1", [(2, 1), (3, 60)])
+    assert [rate_limiter.is_allowed_tiered("user1") for _ in range(3)] == [
+        (True, None),
+        (True, None),
+        (False, 0),
+    ]
+    # Denied request wasn't logged, so it doesn't count against the per minute tier
+    clock.advance(2)
+    assert rate_limiter.is_allowed_tiered("user1") == (True, None)
+    assert rate_limiter.is_allowed_tiered("user1") == (False, 1)
+    assert rate_limiter.get_locally_denied_decision("user1", clock.now())[0] == 1
+    assert rate_limiter.is_allowed_tiered("user1") == (False, 1)
+    clock.advance(60)
+    assert rate_limiter.is_allowed_many(["user1", "user1", "user1"]) == [
+        True,
+        True,
+        False,
+    ]
+
+
+def test_limit_tiers_need_script(clock):
+    """Without the script, users can only have a single tier"""
+    rate_limiter = SlidingWindowLogsRedisRateLimiter(
+        conn=fakeredis.FakeRedis(decode_responses=True), clock=clock
+    )
+    with pytest.raises(ValueError):
+        rate_limiter.add_user_limits("user1", [(2, 1), (3, 60)])
+    rate_limiter.add_user_limits("user1", [(1, 10)])
+    assert rate_limiter.is_allowed_tiered("user1") == (True, None)
+    assert rate_limiter.is_allowed_tiered("user1") == (False, 0)
+
+
+def test_async_limit_tiers(clock):
+    """asyncio limiter reports tier denying a request"""
+
+    async def _send_requests():
+        rate_limiter = AsyncSlidingWindowLogsRedisRateLimiter(
+            conn=fakeredis.FakeAsyncRedis(decode_responses=True), clock=clock
+        )
+        await rate_limiter.add_user_limits("user1", [(5, 1), (1, 60)])
+        return [await rate_limiter.is_allowed_tiered("user1") for _ in range(2)]
+
+    assert asyncio.run(_send_requests()) == [(True, None), (False, 1)]
+
+
+@pytest.mark.parametrize("use_script", [False, True], ids=["transaction", "script"])
+def test_check_reports_quota(use_script, clock):
+    """Decision carries remaining quota, near cache remembers when to retry"""
+    rate_limiter = SlidingWindowLogsRedisRateLimiter(
+        conn=fakeredis.FakeRedis(decode_responses=True),
+        use_script=use_script,
+        near_cache_size=10,
+        clock=clock,
+    )
+    rate_limiter.add_user("user1", 2, 10)
+    decisions = [rate_limiter.check("user1") for _ in range(3)]
+    assert [decision.allowed for decision in decisions] == [True, True, False]
+    assert [decision.remaining for decision in decisions] == [1, 0, 0]
+    assert [decision.limit for decision in decisions] == [2, 2, 2]
+    assert decisions[0].reset_at == 1010
+    assert decisions[2].retry_after == 10
+    clock.advance(4)
+    decision = rate_limiter.check("user1")
+    assert not decision.allowed
+    assert (decision.limit, decision.retry_after) == (2, 6)
+    rate_limiter.add_user("user2", 0, 10)
+    decision = rate_limiter.check("user2")
+    assert (decision.allowed, decision.limit, decision.remaining) == (False, 0, 0)
+    assert decision.retry_after == 10
+
+
+def test_async_check(clock):
+    """asyncio limiter reports remaining quota"""
+
+    async def _send_requests():
+        rate_limiter = AsyncSlidingWindowLogsRedisRateLimiter(
+            conn=fakeredis.FakeAsyncRedis(decode_responses=True), clock=clock
+        )
+        await rate_limiter.add_user("user1", 1, 10)
+        return [await rate_limiter.check("user1") for _ in range(2)]
+
+    allowed, denied = asyncio.run(_send_requests())
+    assert (allowed.allowed, allowed.remaining) == (True, 0)
+    assert (denied.allowed, denied.retry_after) == (False, 10)
+
+
+def test_metrics(rate_limiter, clock):
+    """Each call to redis is timed"""
+    metrics = rate_limiter.enable_metrics()
+    rate_limiter.add_user("user1", 1, 10)
+    rate_limiter.is_allowed("user1")
+    rate_limiter.is_allowed_many(["user1", "user1"])
+    snapshot = metrics.to_dict()
+    assert (snapshot["allowed"], snapshot["denied"]) == (1, 2)
+    # script decides in a single call (after a first EVALSHA missing the script),
+    # transaction fetches metadata, then counts and adds in an optimistic transaction
+    expected_round_trips = 3 if rate_limiter.use_script else 4
+    assert snapshot["redis_round_trip_seconds"]["count"] == expected_round_trips
+
+
+def test_add_users_bulk(rate_limiter, clock):
+    """Users are added in a single round trip"""
+    metrics = rate_limiter.enable_metrics()
+    rate_limiter.add_users_bulk([("user1", 1, 10), ("user2", 2, 10)])
+    assert metrics.to_dict()["redis_round_trip_seconds"]["count"] == 1
+    assert rate_limiter.is_allowed_many(["user1", "user1", "user2", "user2"]) == [
+        True,
+        False,
+        True,
+        True,
+    ]
+
+    async def _add_users():
+        async_rate_limiter = AsyncSlidingWindowLogsRedisRateLimiter(
+            conn=fakeredis.FakeAsyncRedis(decode_responses=True), clock=clock
+        )
+        await async_rate_limiter.add_users_bulk([("user1", 1, 10)])
+        return [await async_rate_limiter.is_allowed("user1") for _ in range(2)]
+
+    assert asyncio.run(_add_users()) == [True, False]
+
+
+def test_hybrid_rate_limiter_leases_quota(clock):
+    """Processes spend leased chunks locally, together admitting no more than the limit"""
+    conn = fakeredis.FakeRedis(decode_responses=True)
+    rate_limiters = [
+        HybridRedisRateLimiter(conn=conn, chunk_size=4, lease_ttl_sec=1, clock=clock)
+        for _ in range(2)
+    ]
+    metrics = rate_limiters[0].enable_metrics()
+    rate_limiters[0].add_user("user1", 10, 1000)
+    decisions = [
+        rate_limiter.is_allowed("user1")
+        for _ in range(6)
+        for rate_limiter in rate_limiters
+    ]
+    assert sum(decisions) == 10
+    # first process went to redis only for its first chunk
+    # (EVALSHA missing the script, then EVAL) and for the last 2 tokens
+    assert metrics.to_dict()["redis_round_trip_seconds"]["count"] == 3
+    decision = rate_limiters[1].check("user1")
+    assert (decision.allowed, decision.limit, decision.remaining) == (False, 10, 0)
+    assert 0 < decision.retry_after <= 1
+
+    with pytest.raises(Exception):
+        rate_limiters[0].is_allowed("user2")
+
+
+def test_hybrid_rate_limiter_zero_quota(clock):
+    """User with a zero limit is denied till the lease expires, not crashed on"""
+    rate_limiter = HybridRedisRateLimiter(
+        conn=fakeredis.FakeRedis(decode_responses=True), lease_ttl_sec=1, clock=clock
+    )
+    rate_limiter.add_user("user1", 0, 10)
+    assert not rate_limiter.is_allowed("user1")
+    decision = rate_limiter.check("user1")
+    assert (decision.allowed, decision.limit, decision.remaining) == (False, 0, 0)
+    assert decision.retry_after == 1
+    assert decision.reset_at == clock.now()
+    clock.advance(2)
+    assert not rate_limiter.is_allowed("user1")
+
+
+def test_hybrid_rate_limiter_returns_unspent_tokens(clock):
+    """Expired and released leases give their unspent tokens back to the shared bucket"""
+    conn = fakeredis.FakeRedis(decode_responses=True)
+    first, second = [
+        HybridRedisRateLimiter(conn=conn, chunk_size=5, lease_ttl_sec=1, clock=clock)
+        for _ in range(2)
+    ]
+    first.add_user("user1", 10, 1000)
+    assert first.is_allowed("user1")
+    assert sum(second.is_allowed("user1") for _ in range(6)) == 5
+    clock.advance(2)
+    # 4 tokens returned by the expired lease are leased again
+    assert sum(first.is_allowed("user1") for _ in range(2)) == 2
+    first.release_leases()
+    assert sum(second.is_allowed("user1") for _ in range(6)) == 2
+    assert sum(first.is_allowed("user1") for _ in range(6)) == 0
+
+
+def test_connections_share_pool():
+    """Connections with the same pool options share one pool"""
+    conn = get_connection(max_connections=7)
+    assert conn.connection_pool is get_connection(max_connections=7).connection_pool
+    assert conn.connection_pool.max_connections == 7
+    assert conn.connection_pool is not get_connection().connection_pool
+
+
+def test_async_connections_share_pool_per_event_loop():
+    """asyncio pools are shared on an event loop, but not across event loops"""
+    rate_limiter = AsyncSlidingWindowLogsRedisRateLimiter()
+
+    async def _get_pools():
+        pool = get_async_connection_pool(max_connections=7)
+        assert pool is get_async_connection_pool(max_connections=7)
+        assert rate_limiter.conn is rate_limiter.conn
+        return pool, rate_limiter.conn.connection_pool
+
+    first_pool, first_rate_limiter_pool = asyncio.run(_get_pools())
+    second_pool, second_rate_limiter_pool = asyncio.run(_get_pools())
+    assert first_pool is not second_pool
+    assert first_rate_limiter_pool is not second_rate_limiter_pool
+
+
+@pytest.mark.parametrize("use_script", [False, True], ids=["transaction", "script"])
+def test_near_cache_rejects_throttled_users_locally(use_script, clock):
+    """Throttled user is rejected without redis till the oldest request leaves the window"""
+    conn = fakeredis.FakeRedis(decode_responses=True)
+    rate_limiter = SlidingWindowLogsRedisRateLimiter(
+        conn=conn,
+        use_script=use_script,
+        near_cache_size=10,
+        near_cache_ttl_sec=60,
+        clock=clock,
+    )
+    rate_limiter.add_user("user1", 2, 10)
+    timestamps_key = "user1" + rate_limiter.TIMESTAMPS_SUFFIX
+    assert rate_limiter.is_allowed("user1")
+    clock.advance(5)
+    assert rate_limiter.is_allowed_many(["user1", "user1", "user1"]) == [
+        True,
+        False,
+        False,
+    ]
+    # Throttled requests aren't logged
+    assert conn.zcard(timestamps_key) == 2
+    # User has to wait till the request made at 1000 leaves the window
+    clock.set(1009)
+    assert not rate_limiter.is_allowed("user1")
+    # Throttled request was not sent to redis
+    assert conn.zcard(timestamps_key) == 2
+    clock.set(1010)
+    assert rate_limiter.is_allowed("user1")
+
+
+def test_throttled_requests_not_logged(rate_limiter, clock):
+    """Transaction and script make the same decisions, throttled requests
+    don't count against the window"""
+    rate_limiter.add_user("user1", 2, 10)
+    decisions = [rate_limiter.is_allowed("user1") for _ in range(2)]
+    clock.advance(5)
+    decisions += rate_limiter.is_allowed_many(["user1", "user1"])
+    clock.advance(5.5)
+    decisions.append(rate_limiter.is_allowed("user1"))
+    assert decisions == [True, True, False, False, True]
+
+
+def test_near_cache_lru_and_ttl():
+    """Least recently used entry is evicted beyond max size, entries expire after TTL"""
+    near_cache = NearCache(max_size=2, ttl_sec=10)
+    near_cache.put("user1", 1, current_timestamp=0)
+    near_cache.put("user2", 2, current_timestamp=0)
+    assert near_cache.get("user1", current_timestamp=1) == 1
+    near_cache.put("user3", 3, current_timestamp=1)
+    assert near_cache.get("user2", current_timestamp=1) is None
+    near_cache.put("user4", 4, current_timestamp=1, expires_at=5)
+    assert near_cache.get("user4", current_timestamp=4) == 4
+    assert near_cache.get("user4", current_timestamp=5) is None
+    assert near_cache.get("user3", current_timestamp=11) is None
+
+
+def test_millisecond_window(rate_limiter, clock):
+    """Windows can be shorter than a second, e.g. 1 request per 100ms"""
+    rate_limiter.add_user("user1", 1, 0.1)
+    assert rate_limiter.is_allowed("user1")
+    clock.advance(0.05)
+    assert not rate_limiter.is_allowed("user1")
+    clock.advance(0.2)
+    assert rate_limiter.is_allowed("user1")
+
+
+def test_limit_tiers_match_in_memory_rate_limiter(clock):
+    """Under sustained over-limit traffic, requests denied by the short tier
+    don't use up the long tier, same as the in-memory rate limiter"""
+    redis_rate_limiter = SlidingWindowLogsRedisRateLimiter(
+        conn=fakeredis.FakeRedis(decode_responses=True),
+        use_script=True,
+        clock=clock,
+    )
+    in_memory_rate_limiter = SlidingWindowLogsRateLimiter(clock=clock)
+    decisions = {}
+    for rate_limiter in (redis_rate_limiter, in_memory_rate_limiter):
+        clock.set(1000)
+        rate_limiter.add_user_limits("user1", [(2, 1), (10, 3600)])
+        decisions[rate_limiter] = []
+        # 20 requests per second for 10 seconds
+        for _ in range(200):
+            decisions[rate_limiter].append(rate_limiter.check("user1"))
+            clock.advance(0.05)
+    assert [decision.allowed for decision in decisions[redis_rate_limiter]] == [
+        decision.allowed for decision in decisions[in_memory_rate_limiter]
+    ]
+    assert sum(decision.allowed for decision in decisions[redis_rate_limiter]) == 10
+    last_redis, last_in_memory = (
+        decisions[redis_rate_limiter][-1],
+        decisions[in_memory_rate_limiter][-1],
+    )
+    assert (last_redis.limit, last_redis.remaining) == (10, 0)
+    assert last_redis.retry_after == pytest.approx(last_in_memory.retry_after)
@@ -0,0 +1,154 @@
+"""Test HTTP front end of the rate limiter and its load generator."""
+import asyncio
+import json
+
+from clock import ManualClock
+from server import RateLimiterServer, read_response, request, run_load, send_request
+from sliding_window_logs_rate_limiter import SlidingWindowLogsRateLimiter
+
+
+def _serve(test, clock=None):
+    """Run test(port, rate_limiter) against a server on a free port"""
+    rate_limiter = SlidingWindowLogsRateLimiter(clock=clock)
+
+    async def _run():
+        server = await RateLimiterServer(rate_limiter).start("127.0.0.1", 0)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            return await test(port, rate_limiter)
+
+    return asyncio.run(_run())
+
+
+def test_check_on_kept_alive_connection():
+    """Users are added, checked and removed over a single connection"""
+
+    async def _test(port, rate_limiter):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        user = {"user_id": "user 1", "num_requests": 2, "window_time_in_sec": 10}
+        status, _, body = await request(reader, writer, "POST", "/users", user)
+        assert (status, json.loads(body)) == (201, {"added": 1})
+        status, _, _ = await request(reader, writer, "POST", "/users", user)
+        assert status == 409
+        statuses = []
+        for _ in range(3):
+            status, headers, _ = await request(reader, writer, "GET", "/check/user%201")
+            statuses.append(status)
+        assert statuses == [200, 200, 429]
+        assert headers["x-ratelimit-remaining"] == "0"
+        assert headers["retry-after"] == "10"
+        status, _, _ = await request(reader, writer, "DELETE", "/users/user%201")
+        assert status == 204
+        status, _, _ = await request(reader, writer, "GET", "/check/user%201")
+        assert status == 404
+        status, _, _ = await request(reader, writer, "GET", "/nowhere")
+        assert status == 404
+        status, _, _ = await request(reader, writer, "POST", "/check/user1")
+        assert status == 405
+        writer.close()
+
+    _serve(_test, ManualClock(1000))
+
+
+def test_pipelined_requests_answered_in_order():
+    """Requests sent back to back are answered in order on the same connection"""
+
+    async def _test(port, rate_limiter):
+        rate_limiter.add_user("user1", 2, 10)
+        rate_limiter.add_user("user2", 1, 10)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for user_id in ["user1", "user2", "user1", "user2", "user1"]:
+            send_request(writer, "GET", "/check/" + user_id)
+        send_request(writer, "POST", "/batch", {"user_ids": ["user1", "user2"]})
+        send_request(writer, "POST", "/batch", "not a batch")
+        await writer.drain()
+        responses = [await read_response(reader) for _ in range(7)]
+        assert [status for status, _, _ in responses] == [
+            200,
+            200,
+            200,
+            429,
+            429,
+            200,
+            400,
+        ]
+        assert json.loads(responses[5][2]) == {"allowed": [False, False]}
+        status, _, body = await request(reader, writer, "GET", "/metrics")
+        assert status == 200
+        assert 'rate_limiter_requests_total{decision="allowed"} 3' in body.decode()
+        writer.close()
+
+    _serve(_test, ManualClock(1000))
+
+
+def test_connection_closed_when_asked():
+    """Server closes the connection after answering a request asking it to"""
+
+    async def _test(port, rate_limiter):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n")
+        status, headers, _ = await read_response(reader)
+        assert (status, headers["connection"]) == (200, "close")
+        assert await reader.read() == b""
+        writer.close()
+
+    _serve(_test)
+
+
+def test_load_generator():
+    """Load generator asks for every decision, singly and in batches"""
+
+    async def _test(port, rate_limiter):
+        user_ids = ["user" + str(i) for i in range(10)]
+        for user_id in user_ids:
+            rate_limiter.add_user(user_id, 100, 60)
+        _, num_requests, num_allowed = await run_load(
+            "127.0.0.1", port, user_ids, 40, 2, 4, 1
+        )
+        assert (num_requests, num_allowed) == (40, 40)
+        _, num_requests, num_allowed = await run_load(
+            "127.0.0.1", port, user_ids, 40, 2, 4, 5
+        )
+        assert (num_requests, num_allowed) == (8, 40)
+
+    _serve(_test)
+
+
+def test_invalid_users_and_errors():
+    """Users with invalid limits are rejected with 400, unexpected errors are
+    reported as 500 without details"""
+
+    async def _test(port, rate_limiter):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for user in [
+            {"user_id": "x", "num_requests": "a", "window_time_in_sec": 10},
+            {"user_id": "x", "num_requests": 0, "window_time_in_sec": 10},
+            {"user_id": "x", "num_requests": 1.5, "window_time_in_sec": 10},
+            {"user_id": "x", "num_requests": 2, "window_time_in_sec": True},
+            {"user_id": 1, "num_requests": 2, "window_time_in_sec": 10},
+            {"user_id": "x", "num_requests": 2},
+            [["x", 2, 10]],
+        ]:
+            status, _, _ = await request(reader, writer, "POST", "/users", user)
+            assert status == 400
+        status, _, _ = await request(reader, writer, "GET", "/check/x")
+        assert status == 404
+        status, _, _ = await request(
+            reader, writer, "POST", "/batch", {"user_ids": [{"user_id": "x"}]}
+        )
+        assert status == 400
+        status, _, body = await request(
+            reader, writer, "POST", "/batch", {"user_ids": ["x"]}
+        )
+        assert (status, json.loads(body)) == (404, {"error": "User not present"})
+
+        def _fail(user_id):
+            raise TypeError("'<' not supported")
+
+        rate_limiter.check = _fail
+        rate_limiter.add_user("x", 2, 0.5)
+        status, _, body = await request(reader, writer, "GET", "/check/x")
+        assert (status, json.loads(body)) == (500, {"error": "Internal server error"})
+        writer.close()
+
+    _serve(_test, ManualClock(1000))
@@ -0,0 +1,103 @@
+"""Test shared memory rate limiter, within a process and across forked workers."""
+import multiprocessing
+
+import pytest
+from clock import ManualClock
+from shared_memory_rate_limiter import SharedMemoryRateLimiter
+
+
+@pytest.fixture
+def clock():
+    return ManualClock(1000)
+
+
+@pytest.fixture
+def rate_limiter(clock):
+    rate_limiter = SharedMemoryRateLimiter(num_slots=8, num_locks=4, clock=clock)
+    yield rate_limiter
+    rate_limiter.close()
+    rate_limiter.unlink()
+
+
+def test_requests_within_limit_allowed(rate_limiter, clock):
+    """Requests up to the limit are allowed till the window slides past them"""
+    rate_limiter.add_user("user1", 2, 10)
+    rate_limiter.add_user("user2", 1, 10)
+    assert rate_limiter.is_allowed_many(["user1", "user2", "user1", "user1"]) == [
+        True,
+        True,
+        True,
+        False,
+    ]
+    decision = rate_limiter.check("user2")
+    assert (decision.allowed, decision.limit, decision.remaining) == (False, 1, 0)
+    clock.advance(20)
+    assert rate_limiter.is_allowed("user1")
+    rate_limiter.add_user("user3", 0, 10)
+    decision = rate_limiter.check("user3")
+    assert (decision.allowed, decision.limit, decision.remaining) == (False, 0, 0)
+    assert decision.retry_after == 10
+
+
+def test_users_added_and_removed(rate_limiter, clock):
+    """Slots of removed users are reused, unknown and duplicate users are rejected"""
+    for i in range(8):
+        rate_limiter.add_user("user" + str(i), 1, 10)
+    with pytest.raises(Exception):
+        rate_limiter.add_user("user8", 1, 10)
+    with pytest.raises(Exception):
+        rate_limiter.add_user("user1", 1, 10)
+    assert rate_limiter.is_allowed("user1")
+    rate_limiter.remove_user("user1")
+    with pytest.raises(Exception):
+        rate_limiter.is_allowed("user1")
+    rate_limiter.add_user("user8", 1, 10)
+    assert rate_limiter.is_allowed("user8")
+    assert len(rate_limiter.user_map) == 8
+    with pytest.raises(ValueError):
+        rate_limiter.add_user_limits("user9", [(1, 1), (10, 60)])
+
+
+def test_add_users_bulk(rate_limiter, clock):
+    """Users are added together, or none of them if any is already present"""
+    rate_limiter.add_users_bulk([("user1", 1, 10), ("user2", 2, 10)])
+    assert rate_limiter.is_allowed_many(["user1", "user1", "user2"]) == [
+        True,
+        False,
+        True,
+    ]
+    with pytest.raises(Exception):
+        rate_limiter.add_users_bulk([("user3", 1, 10), ("user2", 1, 10)])
+    with pytest.raises(Exception):
+        rate_limiter.add_users_bulk([("user3", 1, 10)] * 2)
+    assert "user3" not in rate_limiter.user_map
+
+
+def _send_requests(rate_limiter, num_requests, results):
+    results.put(sum(rate_limiter.is_allowed("user1") for _ in range(num_requests)))
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+def test_limit_shared_by_forked_workers():
+    """Workers forked after the limiter is created share each user's limit"""
+    rate_limiter = SharedMemoryRateLimiter(num_slots=16)
+    try:
+        rate_limiter.add_user("user1", 100, 60)
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        workers = [
+            context.Process(target=_send_requests, args=(rate_limiter, 50, results))
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        num_allowed = sum(results.get(timeout=10) for _ in workers)
+        for worker in workers:
+            worker.join()
+        assert num_allowed == 100
+        assert not rate_limiter.is_allowed("user1")
+    finally:
+        rate_limiter.close()
+        rate_limiter.unlink()
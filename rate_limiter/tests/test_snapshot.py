@@ -0,0 +1,128 @@
+"""Test snapshot and restore of sliding window log rate limiter state."""
+import pytest
+import snapshot
+from clock import ManualClock
+from snapshot import Snapshotter, restore_snapshot, save_snapshot
+from sliding_window_logs_rate_limiter import SlidingWindowLogsRateLimiter
+from token_bucket_rate_limiter import TokenBucketRateLimiter
+from user_registry import LazyUserState
+
+
+@pytest.fixture
+def clock():
+    return ManualClock(1000)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "rate_limiter.snapshot")
+
+
+def test_quota_survives_restart(clock, path):
+    """Restored users keep what they had used of their quota, and their limits"""
+    rate_limiter = SlidingWindowLogsRateLimiter(clock=clock)
+    rate_limiter.add_user("user1", 3, 10)
+    rate_limiter.add_user("user2", 1, 10)
+    rate_limiter.add_user_limits("user3", [(1, 1), (2, 60)])
+    rate_limiter.add_user("user4", 5, 10)
+    rate_limiter.is_allowed_many(["user1", "user1", "user2", "user3"])
+    clock.advance(5)
+    rate_limiter.is_allowed("user1")
+    assert save_snapshot(rate_limiter, path) == 4
+
+    # Restarted process whose clock counts from elsewhere
+    restarted_clock = ManualClock(50)
+    restored = SlidingWindowLogsRateLimiter(clock=restarted_clock)
+    assert restore_snapshot(restored, path) == 4
+    assert not restored.is_allowed("user1")
+    assert not restored.is_allowed("user2")
+    assert restored.is_allowed_tiered("user3") == (True, None)
+    assert restored.is_allowed_tiered("user3") == (False, 0)
+    assert [restored.is_allowed("user4") for _ in range(6)] == [True] * 5 + [False]
+    restarted_clock.advance(6)
+    assert restored.is_allowed("user1")
+    assert restored.is_allowed("user2")
+    assert restored.is_allowed_tiered("user3") == (False, 1)
+
+
+def test_downtime_counts_towards_windows(clock, path, monkeypatch):
+    """Wall clock time between snapshot and restore ages restored timestamps"""
+    rate_limiter = SlidingWindowLogsRateLimiter(clock=clock)
+    rate_limiter.add_user("user1", 1, 10)
+    rate_limiter.is_allowed("user1")
+    save_snapshot(rate_limiter, path)
+    saved_at = snapshot.time.time()
+    monkeypatch.setattr(snapshot.time, "time", lambda: saved_at + 20)
+    restored = SlidingWindowLogsRateLimiter(clock=ManualClock(0))
+    restore_snapshot(restored, path)
+    assert len(restored.user_map.get("user1")) == 0
+    assert restored.is_allowed("user1")
+
+
+def test_snapshot_replaces_state_and_rejects_other_rate_limiters(clock, path):
+    """Restoring replaces users already present, other algorithms are rejected"""
+    rate_limiter = SlidingWindowLogsRateLimiter(clock=clock)
+    rate_limiter.add_user("user1", 1, 10)
+    rate_limiter.is_allowed("user1")
+    save_snapshot(rate_limiter, path)
+    restored = SlidingWindowLogsRateLimiter(clock=clock)
+    restored.add_user("user1", 5, 10)
+    restored.add_user("user2", 5, 10)
+    assert restore_snapshot(restored, path) == 1
+    assert not restored.is_allowed("user1")
+    assert restored.is_allowed("user2")
+    with pytest.raises(ValueError):
+        save_snapshot(TokenBucketRateLimiter(clock=clock), path)
+    rate_limiter.add_user("user\0", 1, 10)
+    with pytest.raises(ValueError):
+        save_snapshot(rate_limiter, path)
+
+
+def test_snapshotter_saves_on_stop(clock, path):
+    """Snapshotter saves a last snapshot when stopped"""
+    rate_limiter = SlidingWindowLogsRateLimiter(clock=clock)
+    rate_limiter.add_user("user1", 1, 10)
+    snapshotter = Snapshotter(rate_limiter, path, 60)
+    snapshotter.start()
+    rate_limiter.is_allowed("user1")
+    snapshotter.stop()
+    restored = SlidingWindowLogsRateLimiter(clock=clock)
+    assert restore_snapshot(restored, path) == 1
+    assert not restored.is_allowed("user1")
+
+
+def test_users_without_requests_restored_lazily(clock, path):
+    """Users with nothing in their windows share state till their first request"""
+    rate_limiter = SlidingWindowLogsRateLimiter(clock=clock)
+    rate_limiter.add_users_bulk(
+        [("user1", 1, 10), ("user2", 1, 10), ("user3", 2, 10), ("user6", 1, 10)]
+    )
+    rate_limiter.add_user_limits("user4", [(1, 1), (2, 60)])
+    rate_limiter.add_user_limits("user5", [(1, 1), (2, 60)])
+    rate_limiter.is_allowed("user3")
+    save_snapshot(rate_limiter, path)
+
+    restored = SlidingWindowLogsRateLimiter(clock=clock)
+    assert restore_snapshot(restored, path) == 6
+    _, user_states = restored.user_map.ids_and_states()
+    assert sum(type(user_state) is LazyUserState for user_state in user_states) == 5
+    assert len(restored.user_map.values()) == 1
+    assert restored.is_allowed("user1")
+    assert not restored.is_allowed("user1")
+    assert restored.is_allowed("user2")
+    assert restored.is_allowed("user3")
+    assert not restored.is_allowed("user3")
+    assert restored.is_allowed_tiered("user4") == (True, None)
+    assert restored.is_allowed_tiered("user4") == (False, 0)
+    assert restored.is_allowed_tiered("user5") == (True, None)
+
+    # Users still to make a request are saved with their limits
+    restored.remove_user("user1")
+    save_snapshot(restored, path)
+    restored_again = SlidingWindowLogsRateLimiter(clock=clock)
+    restore_snapshot(restored_again, path)
+    assert "user1" not in restored_again.user_map
+    assert not restored_again.is_allowed("user2")
+    assert restored_again.is_allowed_tiered("user5") == (False, 0)
+    assert restored_again.is_allowed("user6")
+    assert not restored_again.is_allowed("user6")
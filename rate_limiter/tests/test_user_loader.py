@@ -0,0 +1,59 @@
+"""Test loading users from quota files."""
+import asyncio
+
+import pytest
+from async_in_memory_rate_limiter import AsyncInMemoryRateLimiter
+from clock import ManualClock
+from sliding_window_logs_rate_limiter import SlidingWindowLogsRateLimiter
+from user_loader import load_users, load_users_async, read_users
+
+
+@pytest.fixture
+def clock():
+    return ManualClock(1000)
+
+
+def test_read_csv_and_jsonl(tmp_path):
+    """Both formats are told by extension and give the same users"""
+    csv_path = tmp_path / "users.csv"
+    csv_path.write_text(
+        "user_id,num_requests,window_time_in_sec\nuser1,2,10\nuser2,5,0.5\n"
+    )
+    jsonl_path = tmp_path / "users.jsonl"
+    jsonl_path.write_text(
+        '{"user_id": "user1", "num_requests": 2, "window_time_in_sec": 10}\n\n'
+        '{"user_id": "user2", "num_requests": 5, "window_time_in_sec": 0.5}\n'
+    )
+    expected = [("user1", 2, 10), ("user2", 5, 0.5)]
+    assert list(read_users(str(csv_path))) == expected
+    assert list(read_users(str(jsonl_path))) == expected
+
+
+def test_invalid_quota_files(tmp_path):
+    """Unknown formats, missing columns and bad rows are rejected"""
+    path = tmp_path / "users.csv"
+    path.write_text("user_id,num_requests\nuser1,2\n")
+    with pytest.raises(ValueError):
+        list(read_users(str(path)))
+    path.write_text("user_id,num_requests,window_time_in_sec\nuser1,two,10\n")
+    with pytest.raises(ValueError):
+        list(read_users(str(path)))
+    with pytest.raises(ValueError):
+        list(read_users(str(path), "xml"))
+
+
+def test_load_users_in_chunks(tmp_path, clock):
+    """Users are added chunk by chunk to sync and async rate limiters"""
+    path = tmp_path / "users.csv"
+    path.write_text(
+        "user_id,num_requests,window_time_in_sec\n"
+        + "".join("user%d,%d,10\n" % (i, i + 1) for i in range(25))
+    )
+    rate_limiter = SlidingWindowLogsRateLimiter(clock=clock)
+    assert load_users(rate_limiter, str(path), chunk_size=10) == 25
+    assert len(rate_limiter.user_map) == 25
+    assert [rate_limiter.is_allowed("user1") for _ in range(3)] == [True, True, False]
+
+    async_rate_limiter = AsyncInMemoryRateLimiter(SlidingWindowLogsRateLimiter, clock)
+    assert asyncio.run(load_users_async(async_rate_limiter, str(path))) == 25
+    assert len(async_rate_limiter.user_map) == 25
@@ -1,6 +1,11 @@
+import collections
+import multiprocessing
 import threading
 import time
+import weakref
+from array import array
 from abc import ABCMeta, abstractmethod
+from multiprocessing import shared_memory
 from typing import Final
 
 
@@ -13,6 +18,32 @@ class Sequencer:
     def generate_id(self, node_id: int):
         pass
 
+    def generate_ids(self, node_id: int, n: int, as_array: bool = False):
+        """
+        Generate n IDs, as a list or an array('Q') of unsigned 64 bit ints
+        Implementations override this to amortize per ID overhead
+        """
+        ids = array("Q") if as_array else []
+        ids.extend(self.generate_id(node_id) for _ in range(n))
+        return ids
+
+
+class ClockRegressionPolicy:
+    """
+    What a sequencer does when the system clock steps back behind the
+    last timestamp it generated IDs for (e.g. during NTP adjustments)
+        FAIL: raise ValueError
+        WAIT: sleep till the clock catches up, if it is at most
+            max_clock_regression_ms behind (raise otherwise)
+        BORROW: keep generating IDs from the last timestamp onwards, a logical
+            clock running upto max_clock_regression_ms ahead of the system one.
+            Sequence exhaustion moves it to the next ms without waiting too.
+    """
+
+    FAIL: Final[str] = "fail"
+    WAIT: Final[str] = "wait"
+    BORROW: Final[str] = "borrow"
+
 
 class SnowflakeSequencer(Sequencer):
     """
@@ -20,7 +51,25 @@ class SnowflakeSequencer(Sequencer):
     Adapted from: https://www.callicoder.com/distributed-unique-id-sequence-number-generator/
     """
 
-    def __init__(self):
+    DEFAULT_MAX_CLOCK_REGRESSION_MS = 1000
+
+    def __init__(
+        self,
+        clock_regression_policy: str = ClockRegressionPolicy.FAIL,
+        max_clock_regression_ms: int = DEFAULT_MAX_CLOCK_REGRESSION_MS,
+    ):
+        if clock_regression_policy not in (
+            ClockRegressionPolicy.FAIL,
+            ClockRegressionPolicy.WAIT,
+            ClockRegressionPolicy.BORROW,
+        ):
+            raise ValueError(
+                f"Unknown clock regression policy: {clock_regression_policy}"
+            )
+        if max_clock_regression_ms < 0:
+            raise ValueError("max_clock_regression_ms must not be negative")
+        self.clock_regression_policy = clock_regression_policy
+        self.max_clock_regression_ms = max_clock_regression_ms
         self.UNUSED_BITS: Final[int] = 1
         self.EPOCH_BITS: Final[int] = 41
         self.NODE_ID_BITS: Final[int] = 10
@@ -35,40 +84,406 @@ class SnowflakeSequencer(Sequencer):
     def get_timestamp_since_epoch_ms(self):
         return round(time.time() * 1000) - self.EPOCH
 
-    def wait_till_next_ms(self, current_timestamp):
+    def sleep_till(self, timestamp: int):
         """
-        Block till next ms is generated,
-        used when sequence IDs are exhausted for current ms
+        Sleep till clock reaches timestamp (ms since epoch) rather than spinning
+        on it, returns current timestamp
         """
-        while current_timestamp == self.last_timestamp:
+        current_timestamp = self.get_timestamp_since_epoch_ms()
+        while current_timestamp < timestamp:
+            # Clock reads timestamp once time is within half a ms of it (rounded)
+            time.sleep(max(0, (timestamp + self.EPOCH - 0.5) / 1000 - time.time()))
             current_timestamp = self.get_timestamp_since_epoch_ms()
         return current_timestamp
 
+    def wait_till_next_ms(self, current_timestamp, last_timestamp=None):
+        """
+        Block till next ms is generated,
+        used when sequence IDs are exhausted for current ms
+        """
+        if last_timestamp is None:
+            last_timestamp = self.last_timestamp
+        if current_timestamp > last_timestamp:
+            return current_timestamp
+        return self.sleep_till(last_timestamp + 1)
+
+    def next_ms(self, current_timestamp, last_timestamp):
+        """
+        Timestamp to continue from once sequence IDs of last timestamp are exhausted
+        """
+        if self.clock_regression_policy == ClockRegressionPolicy.BORROW:
+            # Borrow the next ms, unless logical clock is already too far ahead
+            if last_timestamp + 1 - current_timestamp > self.max_clock_regression_ms:
+                current_timestamp = self.sleep_till(
+                    last_timestamp + 1 - self.max_clock_regression_ms
+                )
+            return max(current_timestamp, last_timestamp + 1)
+        return self.wait_till_next_ms(current_timestamp, last_timestamp)
+
+    def handle_clock_regression(self, current_timestamp, last_timestamp):
+        """
+        Timestamp to continue from when clock is behind last timestamp,
+        as per clock regression policy
+        """
+        if (
+            self.clock_regression_policy == ClockRegressionPolicy.FAIL
+            or last_timestamp - current_timestamp > self.max_clock_regression_ms
+        ):
+            raise ValueError("Non monotonically increasing system clock")
+        if self.clock_regression_policy == ClockRegressionPolicy.WAIT:
+            return self.sleep_till(last_timestamp)
+        return last_timestamp
+
+    def validate_node_id(self, node_id: int):
+        if node_id < 0 or node_id > self.MAX_NODE_ID:
+            raise ValueError(f"node_id must be between 0 and {self.MAX_NODE_ID}")
+
+    def reserve_sequences(self, state, count: int, max_sequence: int):
+        """
+        Reserve upto count sequence IDs of a single ms from state, which has
+        last_timestamp and last used sequence (guarded by the caller),
+        returns (timestamp, first sequence ID, number of IDs reserved)
+        """
+        current_timestamp = self.get_timestamp_since_epoch_ms()
+        if current_timestamp < state.last_timestamp:
+            current_timestamp = self.handle_clock_regression(
+                current_timestamp, state.last_timestamp
+            )
+
+        # If current timestamp is new ms, start sequence ID at 0
+        first_sequence = 0
+        # If same timestamp (ms), continue after last sequence ID
+        if current_timestamp == state.last_timestamp:
+            first_sequence = state.sequence + 1
+            # Sequence exhausted in current ms, move to next ms
+            if first_sequence > max_sequence:
+                current_timestamp = self.next_ms(
+                    current_timestamp, state.last_timestamp
+                )
+                first_sequence = 0
+        count = min(count, max_sequence + 1 - first_sequence)
+
+        state.sequence = first_sequence + count - 1
+        state.last_timestamp = current_timestamp
+        return current_timestamp, first_sequence, count
+
+    def extend_ids(self, ids, state, low_bits: int, n: int, max_sequence: int):
+        """
+        Append n IDs of state to ids, low_bits being node ID
+        (and any other bits) between timestamp and sequence ID
+        """
+        while n:
+            current_timestamp, first_sequence, count = self.reserve_sequences(
+                state, n, max_sequence
+            )
+            uid = current_timestamp << (self.NODE_ID_BITS + self.SEQUENCE_BITS)
+            uid |= low_bits
+            ids.extend(range(uid | first_sequence, uid + first_sequence + count))
+            n -= count
+
     def generate_id(self, node_id: int):
+        self.validate_node_id(node_id)
         with self.lock:
-            print(node_id)
-            print(self.MAX_NODE_ID)
-            if node_id < 0 or node_id > self.MAX_NODE_ID:
-                raise ValueError("node_id must be between 0 and {self.MAX_NODE_ID}")
+            current_timestamp, sequence, _ = self.reserve_sequences(
+                self, 1, self.MAX_SEQUENCE
+            )
+
+        uid = current_timestamp << (self.NODE_ID_BITS + self.SEQUENCE_BITS)
+        uid |= node_id << self.SEQUENCE_BITS
+        uid |= sequence
+        return uid
+
+    def generate_ids(self, node_id: int, n: int, as_array: bool = False):
+        """
+        Generate n IDs in increasing order under a single lock acquisition
+        Sequence range left in the current ms is reserved at once, spilling
+        into following ms (waiting for them) once it is exhausted,
+        so each ms costs a single clock read and bit packing.
+        """
+        self.validate_node_id(node_id)
+        if n < 0:
+            raise ValueError("n must not be negative")
+        ids = array("Q") if as_array else []
+        with self.lock:
+            self.extend_ids(
+                ids, self, node_id << self.SEQUENCE_BITS, n, self.MAX_SEQUENCE
+            )
+        return ids
 
-            current_timestamp = self.get_timestamp_since_epoch_ms()
-            if current_timestamp < self.last_timestamp:
-                raise ValueError("Non monotonically increasing system clock")
 
-            # If same timestamp (ms), increment sequence ID
-            if current_timestamp == self.last_timestamp:
-                self.sequence = (self.sequence + 1) % self.MAX_SEQUENCE
-                # Sequence exhausted in current ms, wait till next ms
-                if self.sequence == 0:
-                    current_timestamp = wait_till_next_ms(current_timestamp)
-            # If current timestamp is new ms, start sequence ID at 0
-            else:
-                self.sequence = 0
+class SequencerSlot:
+    """
+    Sequence state of a thread of ThreadLocalSnowflakeSequencer
+    """
 
-            self.last_timestamp = current_timestamp
+    __slots__ = ("slot", "last_timestamp", "sequence")
 
-            uid = current_timestamp << (self.NODE_ID_BITS + self.SEQUENCE_BITS)
-            uid |= node_id << self.SEQUENCE_BITS
-            uid |= self.sequence
+    def __init__(self, slot: int):
+        self.slot = slot
+        self.last_timestamp = -1
+        self.sequence = 0
+
+
+class SlotLease:
+    """
+    Kept in thread local storage, its slot is freed once its thread is gone
+    """
+
+    def __init__(self, slot: SequencerSlot):
+        self.slot = slot
 
+
+class ThreadLocalSnowflakeSequencer(SnowflakeSequencer):
+    """
+    Snowflake ID generator whose threads generate IDs without a shared lock
+    Sequence bits are split into a thread slot (high thread_bits) and
+    a sequence ID of the thread. Each thread takes a free slot on first use
+    and keeps its own last timestamp and sequence in it, so IDs of different
+    threads differ in slot bits and never collide. In exchange each thread
+    gets 2 ** (SEQUENCE_BITS - thread_bits) IDs per ms rather than 4096,
+    and IDs are only ordered by time across threads, not within a ms.
+    Slots go back to the pool when their thread exits, along with their last
+    timestamp so the next thread to take them can't repeat IDs.
+    Tasks of an asyncio event loop share their thread's slot safely,
+    as generating an ID never awaits.
+    """
+
+    DEFAULT_THREAD_BITS = 5
+
+    def __init__(self, thread_bits: int = DEFAULT_THREAD_BITS, **options):
+        """
+        options: clock regression options of SnowflakeSequencer
+        """
+        super().__init__(**options)
+        if thread_bits < 0 or thread_bits > self.SEQUENCE_BITS:
+            raise ValueError(f"thread_bits must be between 0 and {self.SEQUENCE_BITS}")
+        self.THREAD_BITS: Final[int] = thread_bits
+        self.THREAD_SEQUENCE_BITS: Final[int] = self.SEQUENCE_BITS - thread_bits
+        self.MAX_THREAD_SEQUENCE = 2**self.THREAD_SEQUENCE_BITS - 1
+        # deque appends / pops are atomic, so slots are taken and freed
+        # (from finalizers, which may run at any point) without a lock
+        self.free_slots = collections.deque(
+            SequencerSlot(slot) for slot in range(2**thread_bits)
+        )
+        self.local = threading.local()
+
+    def get_slot(self):
+        """
+        Slot of the calling thread, taken from the free ones on first use
+        """
+        try:
+            return self.local.slot
+        except AttributeError:
+            pass
+        try:
+            slot = self.free_slots.popleft()
+        except IndexError:
+            raise Exception(f"All {2**self.THREAD_BITS} thread slots are in use")
+        lease = SlotLease(slot)
+        weakref.finalize(lease, self.free_slots.append, slot)
+        self.local.lease = lease
+        self.local.slot = slot
+        return slot
+
+    def generate_id(self, node_id: int):
+        self.validate_node_id(node_id)
+        slot = self.get_slot()
+        current_timestamp, sequence, _ = self.reserve_sequences(
+            slot, 1, self.MAX_THREAD_SEQUENCE
+        )
+
+        uid = current_timestamp << (self.NODE_ID_BITS + self.SEQUENCE_BITS)
+        uid |= node_id << self.SEQUENCE_BITS
+        uid |= slot.slot << self.THREAD_SEQUENCE_BITS
+        uid |= sequence
         return uid
+
+    def generate_ids(self, node_id: int, n: int, as_array: bool = False):
+        self.validate_node_id(node_id)
+        if n < 0:
+            raise ValueError("n must not be negative")
+        ids = array("Q") if as_array else []
+        slot = self.get_slot()
+        self.extend_ids(
+            ids,
+            slot,
+            node_id << self.SEQUENCE_BITS | slot.slot << self.THREAD_SEQUENCE_BITS,
+            n,
+            self.MAX_THREAD_SEQUENCE,
+        )
+        return ids
+
+
+def _shared_field(index: int):
+    def get(self):
+        return self.fields[index]
+
+    def set(self, value):
+        self.fields[index] = value
+
+    return property(get, set)
+
+
+class SharedMemorySnowflakeSequencer(SnowflakeSequencer):
+    """
+    Snowflake ID generator whose state is shared by processes on a host
+    Last timestamp and sequence live in a shared memory block guarded by a
+    process shared lock, so worker processes forked after it is created
+    (e.g. by a pre-fork server) can all use the host's node ID without
+    colliding, rather than each being assigned a node ID of its own.
+    Creating process should close and unlink it on shutdown.
+    """
+
+    last_timestamp = _shared_field(0)
+    sequence = _shared_field(1)
+
+    def __init__(self, name: str = None, **options):
+        """
+        name: name of the shared memory block, random if not given
+        options: clock regression options of SnowflakeSequencer
+        """
+        self.shared_memory = shared_memory.SharedMemory(name=name, create=True, size=16)
+        self.fields = self.shared_memory.buf.cast("q")
+        try:
+            super().__init__(**options)
+        except BaseException:
+            # Invalid options, don't leave the block behind in /dev/shm
+            self.close()
+            self.unlink()
+            raise
+        self.lock = multiprocessing.Lock()
+
+    def close(self):
+        self.fields.release()
+        self.shared_memory.close()
+
+    def unlink(self):
+        self.shared_memory.unlink()
+
+
+class BufferedSequencer(Sequencer):
+    """
+    Wrapper handing out IDs of a node pre-generated by another sequencer
+    IDs are kept in a ring buffer (deque, whose appends and pops are atomic),
+    refilled in batches by a background thread once it drops below
+    low_water_mark, so next_id never waits on the sequencer's lock or
+    for the next ms when sequence IDs are exhausted. Should the buffer run
+    dry, IDs are generated directly. Buffered IDs carry the time they were
+    generated at, so the refill thread also drops IDs older than
+    max_age_ms / 2 every max_age_ms / 2 (refilling on the next demand rather
+    than right away), keeping IDs handed out at most about max_age_ms behind
+    those of unbuffered callers even at low traffic.
+    close() stops the refill thread.
+    """
+
+    DEFAULT_CAPACITY = 65536
+    # IDs generated per batch while refilling, the GIL is held for a batch
+    DEFAULT_BATCH_SIZE = 1024
+    DEFAULT_MAX_AGE_MS = 1000
+
+    def __init__(
+        self,
+        sequencer: Sequencer,
+        node_id: int,
+        capacity: int = DEFAULT_CAPACITY,
+        low_water_mark: int = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_age_ms: int = DEFAULT_MAX_AGE_MS,
+    ):
+        """
+        sequencer: SnowflakeSequencer (or a subclass) generating the IDs,
+            any Sequencer if max_age_ms is None
+        low_water_mark: buffered IDs below which it is refilled, capacity / 2 by default
+        batch_size: IDs generated at a time while refilling, keep it small enough
+            that callers of next_id aren't held up by the refill thread for long
+        max_age_ms: bound on how old IDs handed out may be, None to keep
+            buffered IDs however old they get
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        if low_water_mark is None:
+            low_water_mark = capacity // 2
+        if low_water_mark < 0 or low_water_mark >= capacity:
+            raise ValueError("low_water_mark must be between 0 and capacity - 1")
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        if max_age_ms is not None and max_age_ms < 2:
+            raise ValueError("max_age_ms must be at least 2")
+        self.sequencer = sequencer
+        self.node_id = node_id
+        self.capacity = capacity
+        self.low_water_mark = low_water_mark
+        self.batch_size = batch_size
+        self.max_age_ms = max_age_ms
+        self.check_interval_sec = None
+        if max_age_ms is not None:
+            self.check_interval_sec = max_age_ms // 2 / 1000
+            self.timestamp_shift = sequencer.NODE_ID_BITS + sequencer.SEQUENCE_BITS
+        self.buffer = collections.deque()
+        self.refill()
+        self.refill_needed = threading.Event()
+        self.stopped = False
+        self.refiller = threading.Thread(target=self._refill_when_needed, daemon=True)
+        self.refiller.start()
+
+    def refill(self):
+        """
+        Top up buffer to capacity, a batch at a time
+        """
+        missing = self.capacity - len(self.buffer)
+        while missing > 0:
+            batch = self.sequencer.generate_ids(
+                self.node_id, min(missing, self.batch_size)
+            )
+            self.buffer.extend(batch)
+            missing -= len(batch)
+
+    def drop_stale_ids(self):
+        """
+        Drop buffered IDs generated more than max_age_ms / 2 ago
+        IDs are in increasing order, so stale ones are at the head of the buffer.
+        Callers of next_id may pop it concurrently, so a fresh ID can be
+        dropped too, which only leaves a gap in the IDs handed out.
+        """
+        stale_before = (
+            self.sequencer.get_timestamp_since_epoch_ms() - self.max_age_ms // 2
+        ) << self.timestamp_shift
+        try:
+            while self.buffer[0] < stale_before:
+                self.buffer.popleft()
+        except IndexError:
+            pass
+
+    def _refill_when_needed(self):
+        while True:
+            self.refill_needed.wait(self.check_interval_sec)
+            if self.stopped:
+                return
+            if self.max_age_ms is not None:
+                self.drop_stale_ids()
+            if self.refill_needed.is_set():
+                self.refill_needed.clear()
+                self.refill()
+
+    def next_id(self):
+        try:
+            uid = self.buffer.popleft()
+        except IndexError:
+            # Drained faster than refilled
+            uid = self.sequencer.generate_id(self.node_id)
+        if len(self.buffer) < self.low_water_mark and not self.refill_needed.is_set():
+            self.refill_needed.set()
+        return uid
+
+    def generate_id(self, node_id: int):
+        if node_id == self.node_id:
+            return self.next_id()
+        return self.sequencer.generate_id(node_id)
+
+    def generate_ids(self, node_id: int, n: int, as_array: bool = False):
+        return self.sequencer.generate_ids(node_id, n, as_array)
+
+    def close(self):
+        self.stopped = True
+        self.refill_needed.set()
+        self.refiller.join()
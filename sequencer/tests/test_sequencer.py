@@ -1,5 +1,18 @@
+import multiprocessing
+import os
+import threading
+import time
+
 import pytest
-from src.sequencer import Sequencer, SnowflakeSequencer
+from src import sequencer
+from src.sequencer import (
+    BufferedSequencer,
+    ClockRegressionPolicy,
+    Sequencer,
+    SharedMemorySnowflakeSequencer,
+    SnowflakeSequencer,
+    ThreadLocalSnowflakeSequencer,
+)
 
 
 def test_sequencer_with_valid_nodeid():
@@ -12,3 +25,277 @@ def test_sequencer_with_invalid_nodeid():
     with pytest.raises(ValueError):
         seq = SnowflakeSequencer()
         uid = seq.generate_id(1025)
+
+
+def test_generate_ids():
+    seq = SnowflakeSequencer()
+    uids = seq.generate_ids(42, 10000)
+    assert len(set(uids)) == 10000
+    assert uids == sorted(uids)
+    assert all((uid >> 12) & ((1 << 10) - 1) == 42 for uid in uids)
+    assert seq.generate_id(42) > uids[-1]
+    assert seq.generate_ids(42, 0) == []
+    array_uids = seq.generate_ids(7, 5, as_array=True)
+    assert array_uids.typecode == "Q"
+    assert list(array_uids) == sorted(set(array_uids))
+
+
+def test_generate_ids_spills_into_next_ms():
+    seq = SnowflakeSequencer()
+    timestamps = iter([100, 100, 101, 101, 102])
+    seq.get_timestamp_since_epoch_ms = lambda: next(timestamps)
+    uids = seq.generate_ids(1, 5000, as_array=True)
+    assert uids.typecode == "Q"
+    assert [uid >> 22 for uid in (uids[0], uids[4095], uids[4096])] == [100, 100, 101]
+    assert uids[4096] & 4095 == 0
+    assert seq.generate_id(1) == (101 << 22) | (1 << 12) | 904
+
+
+def test_generate_ids_with_invalid_count():
+    with pytest.raises(ValueError):
+        SnowflakeSequencer().generate_ids(1, -1)
+
+
+def test_thread_local_sequencer_ids_unique_across_threads():
+    seq = ThreadLocalSnowflakeSequencer(thread_bits=3)
+    uids = [[] for _ in range(8)]
+
+    def _generate(index):
+        uids[index].extend(seq.generate_id(42) for _ in range(1000))
+        uids[index].extend(seq.generate_ids(42, 1000))
+
+    threads = [threading.Thread(target=_generate, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    all_uids = [uid for thread_uids in uids for uid in thread_uids]
+    assert len(set(all_uids)) == 16000
+    assert all((uid >> 12) & ((1 << 10) - 1) == 42 for uid in all_uids)
+    for thread_uids in uids:
+        assert thread_uids == sorted(thread_uids)
+        assert len({(uid >> 9) & 7 for uid in thread_uids}) == 1
+
+
+def test_thread_local_sequencer_reuses_slots_of_finished_threads():
+    seq = ThreadLocalSnowflakeSequencer(thread_bits=1)
+    seq.get_timestamp_since_epoch_ms = lambda: 100
+    seq.generate_id(1)
+    uids = []
+    thread = threading.Thread(target=lambda: uids.append(seq.generate_id(1)))
+    thread.start()
+    thread.join()
+    assert len(seq.free_slots) == 1
+    # Next thread taking the slot continues its sequence in the same ms
+    thread = threading.Thread(target=lambda: uids.append(seq.generate_id(1)))
+    thread.start()
+    thread.join()
+    assert uids[1] == uids[0] + 1
+
+    slot_taken = threading.Event()
+    release = threading.Event()
+
+    def _hold_slot():
+        seq.generate_id(1)
+        slot_taken.set()
+        release.wait()
+
+    thread = threading.Thread(target=_hold_slot)
+    thread.start()
+    slot_taken.wait()
+    errors = []
+
+    def _generate():
+        try:
+            seq.generate_id(1)
+        except Exception as e:
+            errors.append(e)
+
+    extra_thread = threading.Thread(target=_generate)
+    extra_thread.start()
+    extra_thread.join()
+    release.set()
+    thread.join()
+    assert len(errors) == 1
+
+
+def test_thread_local_sequencer_spills_into_next_ms():
+    seq = ThreadLocalSnowflakeSequencer(thread_bits=10)
+    timestamps = iter([100, 100, 101])
+    seq.get_timestamp_since_epoch_ms = lambda: next(timestamps)
+    uids = seq.generate_ids(1, 6)
+    assert [uid >> 22 for uid in uids] == [100] * 4 + [101] * 2
+    assert [uid & 3 for uid in uids] == [0, 1, 2, 3, 0, 1]
+    with pytest.raises(ValueError):
+        ThreadLocalSnowflakeSequencer(thread_bits=13)
+
+
+def _generate_ids(seq, results):
+    uids = [seq.generate_id(42) for _ in range(1000)]
+    uids.extend(seq.generate_ids(42, 5000))
+    results.put(uids)
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+def test_shared_memory_sequencer_ids_unique_across_processes():
+    seq = SharedMemorySnowflakeSequencer()
+    try:
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        workers = [
+            context.Process(target=_generate_ids, args=(seq, results)) for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        uids = [uid for _ in workers for uid in results.get(timeout=10)]
+        for worker in workers:
+            worker.join()
+        assert len(set(uids)) == 24000
+        assert seq.generate_id(42) > max(uids)
+    finally:
+        seq.close()
+        seq.unlink()
+
+
+def test_shared_memory_sequencer_invalid_options_release_block():
+    name = "sequencer_test_" + str(os.getpid())
+    with pytest.raises(ValueError):
+        SharedMemorySnowflakeSequencer(name=name, max_clock_regression_ms=-1)
+    # Block was unlinked, so the name can be created again
+    seq = SharedMemorySnowflakeSequencer(name=name)
+    seq.close()
+    seq.unlink()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(sequencer.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def _with_timestamps(seq, timestamps):
+    timestamps = iter(timestamps)
+    seq.get_timestamp_since_epoch_ms = lambda: next(timestamps)
+    return seq
+
+
+def test_clock_regression_fails_by_default():
+    seq = _with_timestamps(SnowflakeSequencer(), [100, 99])
+    seq.generate_id(1)
+    with pytest.raises(ValueError):
+        seq.generate_id(1)
+    with pytest.raises(ValueError):
+        SnowflakeSequencer(clock_regression_policy="ignore")
+
+
+def test_clock_regression_waits_for_clock(sleeps):
+    seq = SnowflakeSequencer(
+        clock_regression_policy=ClockRegressionPolicy.WAIT, max_clock_regression_ms=10
+    )
+    _with_timestamps(seq, [100, 95, 95, 100, 80])
+    first_uid = seq.generate_id(1)
+    assert seq.generate_id(1) == first_uid + 1
+    assert len(sleeps) == 1
+    # Clock further behind than max_clock_regression_ms
+    with pytest.raises(ValueError):
+        seq.generate_id(1)
+
+
+def test_clock_regression_borrows_from_future(sleeps):
+    seq = SnowflakeSequencer(
+        clock_regression_policy=ClockRegressionPolicy.BORROW,
+        max_clock_regression_ms=1,
+    )
+    _with_timestamps(seq, [100, 99, 99, 99, 80])
+    first_uid = seq.generate_id(1)
+    assert seq.generate_id(1) == first_uid + 1
+    # Sequence exhausted, logical clock moves a ms ahead of system clock
+    uids = seq.generate_ids(1, 4096)
+    assert [uid >> 22 for uid in (uids[0], uids[4093], uids[4094])] == [100, 100, 101]
+    assert not sleeps
+    with pytest.raises(ValueError):
+        seq.generate_id(1)
+
+    # Logical clock not allowed ahead, so exhaustion sleeps till next ms
+    seq = SnowflakeSequencer(
+        clock_regression_policy=ClockRegressionPolicy.BORROW,
+        max_clock_regression_ms=0,
+    )
+    _with_timestamps(seq, [100, 100, 100, 101])
+    assert seq.generate_ids(1, 4097)[-1] >> 22 == 101
+    assert len(sleeps) == 1
+
+
+def test_sequence_exhaustion_sleeps_till_next_ms(sleeps):
+    seq = _with_timestamps(SnowflakeSequencer(), [100, 100, 100, 101])
+    uids = seq.generate_ids(1, 4097)
+    assert uids[-1] >> 22 == 101
+    assert len(sleeps) == 1
+
+
+def test_buffered_sequencer_refills_below_low_water_mark():
+    seq = BufferedSequencer(SnowflakeSequencer(), 42, capacity=100, low_water_mark=50)
+    try:
+        assert len(seq.buffer) == 100
+        uids = [seq.next_id() for _ in range(60)]
+        assert uids == sorted(set(uids))
+        assert all((uid >> 12) & ((1 << 10) - 1) == 42 for uid in uids)
+        for _ in range(1000):
+            if len(seq.buffer) == 100:
+                break
+            time.sleep(0.001)
+        assert len(seq.buffer) == 100
+        uids += [seq.generate_id(42) for _ in range(200)]
+        uids += seq.generate_ids(42, 10)
+        uids.append(seq.generate_id(7))
+        assert len(set(uids)) == 271
+    finally:
+        seq.close()
+    assert not seq.refiller.is_alive()
+
+
+def test_buffered_sequencer_generates_directly_when_drained():
+    seq = BufferedSequencer(SnowflakeSequencer(), 42, capacity=10, low_water_mark=0)
+    seq.close()
+    uids = [seq.next_id() for _ in range(20)]
+    assert len(set(uids)) == 20
+    with pytest.raises(ValueError):
+        BufferedSequencer(SnowflakeSequencer(), 42, capacity=10, low_water_mark=10)
+
+
+def test_buffered_sequencer_drops_stale_ids():
+    now = [100]
+    seq = SnowflakeSequencer()
+    seq.get_timestamp_since_epoch_ms = lambda: now[0]
+    buffered = BufferedSequencer(
+        seq, 42, capacity=100, low_water_mark=50, max_age_ms=20
+    )
+    try:
+        first_uid = buffered.next_id()
+        assert first_uid >> 22 == 100
+        # Not stale yet
+        now[0] = 110
+        buffered.drop_stale_ids()
+        assert len(buffered.buffer) == 99
+        # Refill thread drops IDs older than max_age_ms / 2 by itself
+        now[0] = 111
+        for _ in range(1000):
+            if not buffered.buffer:
+                break
+            time.sleep(0.001)
+        assert not buffered.buffer
+        # Drained buffer is refilled on demand, with fresh IDs
+        uid = buffered.next_id()
+        assert uid >> 22 == 111 and uid > first_uid
+        for _ in range(1000):
+            if len(buffered.buffer) == 100:
+                break
+            time.sleep(0.001)
+        assert [uid >> 22 for uid in buffered.buffer] == [111] * 100
+    finally:
+        buffered.close()
+    with pytest.raises(ValueError):
+        BufferedSequencer(seq, 42, max_age_ms=1)